@@ -17,6 +17,7 @@
 This Python module contains a collection of algorithms used in PyRate.
 """
 import logging
+import numpy as np
 from numpy import sin, cos, unique, histogram, diag, dot
 from scipy.linalg import qr, solve, lstsq
 from pyrate.shared import EpochList, IfgException, PrereadIfg
@@ -224,3 +225,47 @@ def master_slave_ids(dates):
 
     dset = sorted(set(dates))
     return dict([(date_, i) for i, date_ in enumerate(dset)])
+
+
+def master_slave_indices(ifgs):
+    """
+    Returns the epoch indices of the master and slave of each interferogram,
+    with epochs numbered as in master_slave_ids.
+
+    :param ifgs: Sequence of interferogram objects
+
+    :return masters: Integer array of master epoch indices
+    :return slaves: Integer array of slave epoch indices
+    :return nepochs: Number of unique epochs
+    """
+    ifgs = list(ifgs)
+    ids = master_slave_ids(get_all_epochs(ifgs))
+    masters = np.array([ids[i.master] for i in ifgs], dtype=np.intp)
+    slaves = np.array([ids[i.slave] for i in ifgs], dtype=np.intp)
+    return masters, slaves, len(ids)
+
+
+def unique_mask_patterns(mask):
+    """
+    Groups the pixels of a stack of boolean masks by their pattern along
+    the first (interferogram) axis. Each pixel column is packed into bits
+    and hashed, so pixels sharing exactly the same selection of
+    interferograms end up in the same group.
+
+    :param mask: Boolean array of shape (nifgs, rows, cols) or (nifgs, npixels)
+
+    :return patterns: Boolean array of shape (nifgs, npatterns) with one
+        column per unique pattern
+    :return groups: List of 1D arrays of flat pixel indices, one per pattern
+    """
+    nifgs = mask.shape[0]
+    mask = np.asarray(mask, dtype=bool).reshape(nifgs, -1)
+    packed = np.ascontiguousarray(np.packbits(mask, axis=0).T)
+    keys = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    inverse = inverse.ravel()
+    # stable sort keeps pixels of each group in row major order
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.cumsum(np.bincount(inverse, minlength=len(first)))[:-1]
+    return mask[:, first], np.split(order, bounds)
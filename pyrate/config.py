@@ -44,6 +44,14 @@ PROCESSOR = 'processor'
 OBS_DIR = 'obsdir'
 #: STR; Name of directory for saving output products
 OUT_DIR = 'outdir'
+#: BOOL (0/1); Write output GeoTIFFs with square tiles instead of strips
+OUTPUT_TILED = 'outtiled'
+#: INT; Width and height of the tiles of output GeoTIFFs, a multiple of 16
+OUTPUT_BLOCK_SIZE = 'outblocksize'
+#: STR; Compression of output GeoTIFFs: NONE, DEFLATE, ZSTD or LZW
+OUTPUT_COMPRESSION = 'outcompress'
+#: BOOL (0/1); Write cloud optimised GeoTIFFs: tiled, with overviews
+OUTPUT_COG = 'outcog'
 #: STR; Name of Digital Elevation Model file
 DEM_FILE = 'demfile'
 #: STR; Name of the header for the DEM
@@ -61,7 +69,8 @@ NO_DATA_AVERAGING_THRESHOLD = 'noDataAveragingThreshold'
 #: BOOL (1/2/3); Re-project data from Line of sight, 1 = vertical,
 # 2 = horizontal, 3 = no conversion
 REPROJECTION = 'prjflag' # NOT CURRENTLY USED
-#: BOOL (0/1); Select MST algorithm, 0 = Matlab Pirate algorithm, 1 = NetworkX
+#: INT (0/1/2); Select MST algorithm, 0 = Matlab Pirate algorithm,
+#: 1 = NetworkX, 2 = array based Kruskal
 NETWORKX_OR_MATLAB_FLAG = 'networkx_or_matlab'
 #: BOOL (0/1): Convert no data values to Nan
 NAN_CONVERSION = 'nan_conversion'
@@ -100,6 +109,9 @@ REF_CHIP_SIZE = 'refchipsize'
 #: REAL; Minimum fraction of observations required in
 #: reference pixel search window for pixel to be a viable reference pixel
 REF_MIN_FRAC = 'refminfrac'
+#: INT; Stride in pixels of the dense reference pixel search, which scores
+#: every refstride-th pixel instead of the refnx by refny grid (0: grid search)
+REF_STRIDE = 'refstride'
 #: BOOL (1/2); Reference phase estimation method
 REF_EST_METHOD = 'refest'
 
@@ -127,6 +139,14 @@ ORBITAL_FIT_LOOKS_X = 'orbfitlksx'
 #: INT; Multi look factor for orbital error calculation in y dimension
 ORBITAL_FIT_LOOKS_Y = 'orbfitlksy'
 
+# maxvar/vcm parameters
+#: INT; Multi look factor of the block averaged interferograms used for
+#: the maxvar estimation in x dimension (1: full resolution)
+MAXVAR_LOOKS_X = 'maxvarlksx'
+#: INT; Multi look factor of the block averaged interferograms used for
+#: the maxvar estimation in y dimension (1: full resolution)
+MAXVAR_LOOKS_Y = 'maxvarlksy'
+
 # Linear rate/stacking parameters
 #: REAL; Threshold ratio between 'model minus observation'
 #: residuals and a-priori observation standard deviations for
@@ -153,6 +173,9 @@ TIME_SERIES_SM_ORDER = 'smorder'
 #: REAL; Laplacian smoothing factor (0: calculate & plot L-curve;
 #: others: using the specific smoothing factor 10**smfactor) NOT CURRENTLY USED
 TIME_SERIES_SM_FACTOR = 'smfactor'
+#: BOOL (0/1); Write the time series as one multi-band GeoTIFF per
+#: quantity (tscuml.tif, tsincr.tif) instead of one GeoTIFF per epoch
+TIME_SERIES_CUBE = 'tscube'
 # tsinterp is automatically assigned in the code; not needed in conf file
 #TIME_SERIES_INTERP = 'tsinterp'
 
@@ -160,6 +183,9 @@ TIME_SERIES_SM_FACTOR = 'smfactor'
 PARALLEL = 'parallel'
 #: INT; Number of processes for multi-threading
 PROCESSES = 'processes'
+#: INT; Maximum memory in MB for cached VCM factorisations used by the
+#: linear rate and time series inversions
+VCM_CACHE_SIZE = 'vcmcachesize'
 
 #: BOOL (0/1); Switch for using Luigi to perform prepifg step
 LUIGI = 'use_luigi'
@@ -215,6 +241,10 @@ PARAM_CONVERSION = {
     IFG_YFIRST : (float, None),
     IFG_YLAST : (float, None),
     NO_DATA_VALUE: (float, 0.0),
+    OUTPUT_TILED: (int, 0),
+    OUTPUT_BLOCK_SIZE: (int, 256),
+    OUTPUT_COMPRESSION: (str, 'NONE'),
+    OUTPUT_COG: (int, 0),
 
     REFX: (int, -1),
     REFY: (int, -1),
@@ -222,6 +252,7 @@ PARAM_CONVERSION = {
     REFNY: (int, 50),
     REF_CHIP_SIZE: (int, 21),
     REF_MIN_FRAC: (float, 0.8),
+    REF_STRIDE: (int, 0),
     REF_EST_METHOD: (int, 1), # default to average of whole image
 
     ORBITAL_FIT: (int, 0),
@@ -230,6 +261,9 @@ PARAM_CONVERSION = {
     ORBITAL_FIT_LOOKS_X: (int, NO_MULTILOOKING),
     ORBITAL_FIT_LOOKS_Y: (int, NO_MULTILOOKING),
 
+    MAXVAR_LOOKS_X: (int, NO_MULTILOOKING),
+    MAXVAR_LOOKS_Y: (int, NO_MULTILOOKING),
+
     LR_NSIG : (int, 3),
     # pixel thresh based on nepochs? not every project may have 20 epochs
     LR_PTHRESH : (int, 20),
@@ -241,11 +275,13 @@ PARAM_CONVERSION = {
     TIME_SERIES_SM_FACTOR: (float, None),
     TIME_SERIES_SM_ORDER: (int, None),
     TIME_SERIES_METHOD: (int, 2), # Default to SVD method
+    TIME_SERIES_CUBE: (int, 0),
 
     PARALLEL: (int, 0),
     PROCESSES: (int, 8),
+    VCM_CACHE_SIZE: (int, None), # Default to VcmCache limit
     PROCESSOR: (int, None),
-    NETWORKX_OR_MATLAB_FLAG: (int, 1), # Default to NetworkX
+    NETWORKX_OR_MATLAB_FLAG: (int, 2), # Default to array based Kruskal
     LUIGI: (int, 0),
     NAN_CONVERSION: (int, 0),
     NO_DATA_AVERAGING_THRESHOLD: (float, 0.0),
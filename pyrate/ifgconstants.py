@@ -47,6 +47,7 @@ CUML = 'CUMULATIVE_TIME_SLICE'
 LINRATE = 'LINEAR_RATE_MAP'
 LINERROR = 'LINEAR_RATE_ERROR_MAP'
 LINSAMP = 'LINEAR_RATE_SAMPLES'
+REF_PIXEL_SCORE = 'REFERENCE_PIXEL_MEAN_SD'
 PYRATE_ORBITAL_ERROR = 'ORBITAL_ERROR'
 ORB_REMOVED = 'REMOVED'
 REF_PHASE = 'REFERENCE_PHASE'
@@ -23,14 +23,16 @@ and Matlab 'lscov.m' functions.
 # pylint: disable= too-many-locals
 # pylint: disable= too-many-arguments
 import itertools
-from scipy.linalg import solve, cholesky, qr, inv
+from scipy.linalg import solve, qr, inv, solve_triangular
 from numpy import nan, isnan, sqrt, diag, delete, array, float32
 import numpy as np
 from joblib import Parallel, delayed
 from pyrate import config as cf
+from pyrate.algorithm import unique_mask_patterns
+from pyrate.vcm import vcm_factor, delete_from_factor, vcm_cache
 
 
-def linear_rate(ifgs, params, vcmt, mst=None):
+def linear_rate(ifgs, params, vcmt, mst=None, cache=None):
     """
     Pixel-by-pixel linear rate (velocity) estimation using iterative
     weighted least-squares method.
@@ -38,7 +40,9 @@ def linear_rate(ifgs, params, vcmt, mst=None):
     :param ifgs: Sequence of interferogram objects from which to extract observations
     :param params: Configuration parameters
     :param vcmt: Derived positive definite temporal variance covariance matrix
-    :param mst: Pixel-wise matrix describing the minimum spanning tree network
+    :param mst: Pixel-wise matrix describing the minimum spanning tree network,
+        a boolean array or a bit-packed mst.PackedMst
+    :param cache: VcmCache of vcmt, reused across calls (optional)
     :param parallel: Use multiprocessing or not
     :param processes: Number of parallel processes to use
 
@@ -48,14 +52,18 @@ def linear_rate(ifgs, params, vcmt, mst=None):
     """
     maxsig, nsig, pthresh, cols, error, mst, obs, parallel, _, \
         rate, rows, samples, span = linrate_setup(ifgs, mst, params)
+    if cache is None:
+        cache = vcm_cache(vcmt, params)
 
     # pixel-by-pixel calculation.
     # nested loops to loop over the 2 image dimensions
     if parallel == 1:
-
+        # factorise every mst pattern once, workers get the part they need
+        _warm_cache(cache, mst, pthresh, span)
         res = Parallel(n_jobs=params[cf.PROCESSES], verbose=50)(
             delayed(linear_rate_by_rows)(r, cols, mst, nsig, obs,
-                                         pthresh, span, vcmt)
+                                         pthresh, span, vcmt,
+                                         cache.subset(mst[:, r]))
             for r in range(rows))
         # pylint: disable=redefined-variable-type
         res = np.array(res)
@@ -63,9 +71,12 @@ def linear_rate(ifgs, params, vcmt, mst=None):
         error = res[:, :, 1]
         samples = res[:, :, 2]
     elif parallel == 2:
+        _warm_cache(cache, mst, pthresh, span)
+        # one subset per row, shared by the pixels of the row
+        subsets = [cache.subset(mst[:, r]) for r in range(rows)]
         res = Parallel(n_jobs=params[cf.PROCESSES], verbose=50)(
             delayed(linear_rate_by_pixel)(r, c, mst, nsig, obs,
-                                          pthresh, span, vcmt)
+                                          pthresh, span, vcmt, subsets[r])
             for r, c in itertools.product(range(rows), range(cols)))
         res = np.array(res)
 
@@ -73,11 +84,9 @@ def linear_rate(ifgs, params, vcmt, mst=None):
         error = res[:, 1].reshape(rows, cols)
         samples = res[:, 2].reshape(rows, cols)
     else:
-        for i in range(rows):
-            for j in range(cols):
-                rate[i, j], error[i, j], samples[i, j] = \
-                    linear_rate_by_pixel(i, j, mst, nsig, obs,
-                                         pthresh, span, vcmt)
+        # pixels sharing an mst pattern are solved together
+        rate[:], error[:], samples[:] = linear_rate_by_groups(
+            mst, nsig, obs, pthresh, span, vcmt, cache)
 
     # overwrite the data whose error is larger than the
     # maximum sigma user threshold
@@ -118,7 +127,10 @@ def linrate_setup(ifgs, mst, params):
     if mst is None:  # dummy mst if none is passed in
         mst = ~isnan(obs)
     else:
-        mst[isnan(obs)] = 0
+        nan_mask = isnan(obs)
+        # an empty mask would still repack a PackedMst
+        if nan_mask.any():
+            mst[nan_mask] = 0
 
     # preallocate empty arrays. No need to preallocation NaNs with new code
     error = np.empty([rows, cols], dtype=float32)
@@ -128,7 +140,8 @@ def linrate_setup(ifgs, mst, params):
            rate, rows, samples, span
 
 
-def linear_rate_by_rows(row, cols, mst, NSIG, obs, PTHRESH, span, vcmt):
+def linear_rate_by_rows(row, cols, mst, NSIG, obs, PTHRESH, span, vcmt,
+                        cache=None):
     """
     Helper function for parallel 'row' runs.
     
@@ -140,18 +153,76 @@ def linear_rate_by_rows(row, cols, mst, NSIG, obs, PTHRESH, span, vcmt):
     :param PTHRESH: xxxx
     :param span: Span calculated in linarate function
     :param vcmt: Temporal vcm matrix
+    :param cache: VcmCache of vcmt (optional)
     
     :return xxxx
     """
     res = np.empty(shape=(cols, 3), dtype=np.float32)
-    for col in range(cols):
-        res[col, :] = linear_rate_by_pixel(
-            row, col, mst, NSIG, obs, PTHRESH, span, vcmt)
-
+    rate, error, samples = linear_rate_by_groups(
+        mst[:, row:row + 1, :], NSIG, obs[:, row:row + 1, :],
+        PTHRESH, span, vcmt, cache)
+    res[:, 0], res[:, 1], res[:, 2] = rate[0], error[0], samples[0]
     return res
 
 
-def linear_rate_by_pixel(row, col, mst, nsig, obs, pthresh, span, vcmt):
+def linear_rate_by_groups(mst, nsig, obs, pthresh, span, vcmt, cache=None):
+    """
+    Compute linear rate for a block of pixels, grouping pixels by their
+    MST mask pattern. The weighted least-squares system of a pattern only
+    depends on the selected interferograms, so it is factored once per
+    unique pattern and all pixels of the group are solved with one matrix
+    product. Pixels which fail the first outlier test go through the
+    iterative pixel-by-pixel method.
+
+    :param mst: Boolean array (nifgs, rows, cols) of selected observations
+    :param nsig: n-sigma ratio used to threshold residuals
+    :param obs: Array of observations (nifgs, rows, cols)
+    :param pthresh: Minimum number of coherent observations for a pixel
+    :param span: Array of interferogram time spans (1, nifgs)
+    :param vcmt: Temporal vcm matrix
+    :param cache: VcmCache of vcmt (optional)
+
+    :return rate: Linear rate (velocity) of shape (rows, cols)
+    :return error: Standard deviation of the rate
+    :return samples: Number of observations used in the calculation
+    """
+    nifgs, rows, cols = obs.shape
+    rate = np.empty(rows * cols, dtype=float32)
+    error = np.empty(rows * cols, dtype=float32)
+    samples = np.empty(rows * cols, dtype=float32)
+    obs_2d = obs.reshape(nifgs, rows * cols)
+
+    patterns, groups = unique_mask_patterns(mst)
+    for pattern, pixels in zip(patterns.T, groups):
+        ind = np.nonzero(pattern)[0]
+        if len(ind) < pthresh:
+            rate[pixels], error[pixels], samples[pixels] = nan, nan, len(ind)
+            continue
+
+        # observations of all pixels in the group, one column per pixel
+        ifgv = obs_2d[ind][:, pixels]
+        factor, design = _factor_and_design(ind, span, vcmt, cache)
+
+        # same system as linear_rate_by_pixel, with multiple right hand sides
+        v, err, wr = _lscov(factor, span[:, ind], ifgv, design)
+
+        accept = wr.max(axis=0) <= nsig
+        rate[pixels[accept]] = v[0, accept]
+        error[pixels[accept]] = err[0]
+        samples[pixels[accept]] = len(ind)
+
+        # outliers found: fall back to the iterative pixel method
+        for p in pixels[~accept]:
+            row, col = divmod(p, cols)
+            rate[p], error[p], samples[p] = linear_rate_by_pixel(
+                row, col, mst, nsig, obs, pthresh, span, vcmt, cache)
+
+    return rate.reshape(rows, cols), error.reshape(rows, cols), \
+        samples.reshape(rows, cols)
+
+
+def linear_rate_by_pixel(row, col, mst, nsig, obs, pthresh, span, vcmt,
+                         cache=None):
     """
     Compute linear rate for one pixel.
     
@@ -163,6 +234,7 @@ def linear_rate_by_pixel(row, col, mst, nsig, obs, pthresh, span, vcmt):
     :param pthresh: xxxx
     :param span: xxxx
     :param vcmt: xxxx
+    :param cache: VcmCache of vcmt (optional)
     
     :return xxxx
     
@@ -172,6 +244,11 @@ def linear_rate_by_pixel(row, col, mst, nsig, obs, pthresh, span, vcmt):
     # iterative loop to calculate 'robust' velocity for pixel
     default_no_samples = len(ind)
 
+    # factor the VCM subset once, then update the factor as observations
+    # are rejected instead of refactorising it on every iteration
+    if len(ind) >= pthresh:
+        factor, design = _factor_and_design(ind, span, vcmt, cache)
+
     while len(ind) >= pthresh:
         # make vector of selected ifg observations
         ifgv = obs[ind, row, col]
@@ -179,47 +256,113 @@ def linear_rate_by_pixel(row, col, mst, nsig, obs, pthresh, span, vcmt):
         # form design matrix from appropriate ifg time spans
         B = span[:, ind]
 
-        # Subset of full VCM matrix for selected observations
-        vcm_temp = vcmt[ind, np.vstack(ind)]
-
-        # start Matlab lscov.m function
-        # Get the lower triangle cholesky decomposition.
-        # V must be positive definite (symmetrical and square)
-        T = cholesky(vcm_temp, 1)
-
-        # Incorporate inverse of VCM into the design matrix
-        # and observations vector
-        A = solve(T, B.transpose())
-        b = solve(T, ifgv.transpose())
-
-        # Factor the design matrix, incorporate covariances or weights into the
-        # system of equations, and transform the response vector.
-        Q, R, _ = qr(A, mode='economic', pivoting=True)
-        z = Q.conj().transpose().dot(b)
-
-        # Compute the Lstsq coefficient for the velocity
-        v = solve(R, z)
-        # end Matlab lscov.m function
-
-        # Compute the model errors
-        err1 = inv(vcm_temp).dot(B.conj().transpose())
-        err2 = B.dot(err1)
-        err = sqrt(diag(inv(err2)))
-
-        # Compute the residuals (model minus observations)
-        r = (B * v) - ifgv
-
-        # determine the ratio of residuals and apriori variances
-        w = cholesky(inv(vcm_temp))
-        wr = abs(np.dot(w, r.transpose()))
+        v, err, wr = _lscov(factor, B, ifgv, design)
 
         # test if maximum ratio is greater than user threshold.
         max_val = wr.max()
         if max_val > nsig:
             # if yes, discard and re-do the calculation.
-            ind = delete(ind, wr.argmax())
+            k = wr.argmax()
+            ind = delete(ind, k)
+            factor = delete_from_factor(factor, k)
+            design = None
         else:
             # if no, save estimate, exit the while loop and go to next pixel
             return v[0], err[0], ifgv.shape[0]
     # dummy return for no change
     return np.nan, np.nan, default_no_samples
+
+
+def _warm_cache(cache, mst, pthresh, span):
+    """
+    Fills the cache with the factors and design products of all mst
+    patterns with enough observations, before the cache is shared with
+    parallel workers.
+
+    :param cache: VcmCache of the temporal vcm matrix
+    :param mst: Boolean array (nifgs, rows, cols) of selected observations
+    :param pthresh: Minimum number of coherent observations for a pixel
+    :param span: Array of interferogram time spans (1, nifgs)
+    """
+    for pattern in unique_mask_patterns(mst)[0].T:
+        ind = np.nonzero(pattern)[0]
+        if len(ind) >= pthresh:
+            _factor_and_design(ind, span, cache.vcmt, cache)
+
+
+def _factor_and_design(ind, span, vcmt, cache=None):
+    """
+    VCM factor and least-squares design products for a selection of
+    interferograms, looked up in the cache if one is given.
+
+    :param ind: Indices of the selected interferograms
+    :param span: Array of interferogram time spans (1, nifgs)
+    :param vcmt: Temporal vcm matrix
+    :param cache: VcmCache of vcmt (optional)
+
+    :return factor: Upper triangular factor of vcmt[ind, ind]
+    :return design: Design products, see _design
+    """
+    if cache is None:
+        factor = vcm_factor(vcmt[ind, np.vstack(ind)])
+        return factor, _design(factor, span[:, ind])
+    factor = cache.factor(ind)
+    design = cache.get(ind, 'linrate_design',
+                       lambda i: _design(factor, span[:, i]))
+    return factor, design
+
+
+def _design(factor, B):
+    """
+    Products of the weighted design matrix which do not depend on the
+    observations.
+
+    :param factor: Upper triangular factor of the VCM, see vcm_factor
+    :param B: Design matrix of interferogram time spans (1, nobs)
+
+    :return Q: Orthogonal factor of the weighted design matrix
+    :return R: Triangular factor of the weighted design matrix
+    :return err: Standard deviation of the velocity
+    """
+    # Incorporate inverse of VCM into the design matrix
+    A = solve_triangular(factor, B.transpose())
+
+    # Factor the design matrix
+    Q, R, _ = qr(A, mode='economic', pivoting=True)
+
+    # Compute the model errors; A'A == B * inv(vcm) * B'
+    err = sqrt(diag(inv(A.transpose().dot(A))))
+    return Q, R, err
+
+
+def _lscov(factor, B, ifgv, design=None):
+    """
+    Weighted least-squares velocity, its error and the normalised residuals
+    for one or more pixels (Matlab 'lscov.m').
+
+    :param factor: Upper triangular factor of the VCM, see vcm_factor
+    :param B: Design matrix of interferogram time spans (1, nobs)
+    :param ifgv: Observations, shape (nobs,) or (nobs, npixels)
+    :param design: Precomputed design products, see _design (optional)
+
+    :return v: Velocity
+    :return err: Standard deviation of the velocity
+    :return wr: Ratio of residuals and apriori standard deviations
+    """
+    Q, R, err = _design(factor, B) if design is None else design
+
+    # Incorporate inverse of VCM into the observations vector, and
+    # transform the response vector.
+    b = solve_triangular(factor, ifgv)
+    z = Q.conj().transpose().dot(b)
+
+    # Compute the Lstsq coefficient for the velocity
+    v = solve(R, z)
+
+    # Compute the residuals (model minus observations)
+    r = B.transpose().dot(v) - ifgv
+
+    # determine the ratio of residuals and apriori variances.
+    # inv(factor) is the upper cholesky factor of inv(vcm)
+    wr = abs(solve_triangular(factor, r))
+    return v, err, wr
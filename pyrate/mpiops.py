@@ -83,3 +83,37 @@ def array_split(arr, process=None):
     """
     r = process if process else rank
     return np.array_split(arr, size)[r]
+
+
+def allreduce_sum(arr):
+    """
+    Element-wise sum of a numpy array across all MPI processes, in place
+    Parameters
+    ----------
+    arr: ndarray
+        contiguous array of the same shape and dtype on every process
+
+    Returns the summed array, which is arr itself
+    """
+    comm.Allreduce(MPI.IN_PLACE, arr, op=MPI.SUM)
+    return arr
+
+
+def gatherv(arr, root=0):
+    """
+    Concatenates 1-D numpy arrays of all MPI processes on the root process,
+    in process order
+    Parameters
+    ----------
+    arr: ndarray
+        contiguous 1-D array of the same dtype on every process, possibly of
+        different lengths
+    root: int, optional
+        process receiving the result
+
+    Returns the concatenated array on root and None on other processes
+    """
+    counts = comm.allgather(len(arr))
+    recvbuf = np.empty(sum(counts), dtype=arr.dtype) if rank == root else None
+    comm.Gatherv(arr, [recvbuf, counts] if rank == root else None, root=root)
+    return recvbuf
@@ -28,6 +28,7 @@ from joblib import Parallel, delayed
 
 from pyrate.algorithm import ifg_date_lookup
 from pyrate.algorithm import ifg_date_index_lookup
+from pyrate.algorithm import master_slave_indices, unique_mask_patterns
 from pyrate import config as cf
 from pyrate.shared import IfgPart, create_tiles
 np.seterr(invalid='ignore')  # stops RuntimeWarning in nan conversion
@@ -38,6 +39,77 @@ np.seterr(invalid='ignore')  # stops RuntimeWarning in nan conversion
 log = logging.getLogger(__name__)
 
 
+class PackedMst(object):
+    """
+    MST matrix bit-packed along the interferogram axis, one bit instead of
+    one byte per interferogram and pixel. Indexing, e.g. mst[:, row, col]
+    or mst[:, row], only unpacks the selected pixels.
+    """
+
+    def __init__(self, packed, nifgs):
+        """
+        :param packed: uint8 array (ceil(nifgs / 8), rows, cols) of packed bits
+        :param nifgs: Number of interferograms
+        """
+        self.packed = packed
+        self.nifgs = nifgs
+
+    @classmethod
+    def pack(cls, mst):
+        """
+        Returns the PackedMst of a boolean MST matrix.
+
+        :param mst: Boolean array (nifgs, rows, cols)
+        """
+        return cls(np.packbits(mst, axis=0), mst.shape[0])
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a PackedMst saved with save.
+
+        :param path: Path of the .npz file
+        """
+        data = np.load(path)
+        return cls(data['packed'], int(data['nifgs']))
+
+    def save(self, path):
+        """
+        Saves the packed bits and the number of interferograms.
+
+        :param path: Path of the .npz file
+        """
+        np.savez(path, packed=self.packed, nifgs=self.nifgs)
+
+    @property
+    def shape(self):
+        return (self.nifgs,) + self.packed.shape[1:]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        bits = np.unpackbits(self.packed[(slice(None),) + key[1:]], axis=0)
+        return bits[:self.nifgs][key[0]].view(bool)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, np.ndarray) and key.dtype == bool and \
+                key.shape == self.shape and np.ndim(value) == 0:
+            # a full boolean mask sets or clears its bits in packed form
+            bits = np.packbits(key, axis=0)
+            if value:
+                self.packed |= bits
+            else:
+                self.packed &= ~bits
+            return
+        mst = self[:]
+        mst[key] = value
+        self.packed = np.packbits(mst, axis=0)
+
+    def __array__(self, dtype=None, copy=None):
+        mst = self[:]
+        return mst if dtype is None else mst.astype(dtype)
+
+
 def mst_from_ifgs(ifgs):
     """
     Returns default MST dict for the given interferograms. The MST is calculated using a
@@ -101,7 +173,8 @@ def mst_parallel(ifgs, params):
     return result
 
 
-def mst_multiprocessing(tile, ifgs_or_paths, preread_ifgs=None):
+def mst_multiprocessing(tile, ifgs_or_paths, preread_ifgs=None,
+                        networkx=False):
     """
     The memory requirement during mpi mst computation is determined by the
     number of interferograms times size of IfgPart. Note that we need all interferogram header
@@ -111,10 +184,13 @@ def mst_multiprocessing(tile, ifgs_or_paths, preread_ifgs=None):
     :param tile: Tile class instance
     :param ifgs_or_paths: All interferograms paths of the problem. List of strings
     :param preread_ifgs: xxxx
+    :param networkx: Use the NetworkX reference implementation
     
     :return xxxx
     """
     ifg_parts = [IfgPart(p, tile, preread_ifgs) for p in ifgs_or_paths]
+    if networkx:
+        return mst_boolean_array_networkx(ifg_parts)
     t_mst = mst_boolean_array(ifg_parts)
     return t_mst
 
@@ -130,7 +206,90 @@ def _build_graph_networkx(edges_with_weights):
 
 def mst_boolean_array(ifgs):
     """
-    The MSTs are stripped of connecting edge info, leaving just the interferograms.
+    Pixel by pixel MST using Kruskal's algorithm on integer epoch indices.
+    Pixels sharing the same NaN signature across the interferograms have
+    the same MST, so it is computed once per unique signature and
+    broadcast back to the pixels. Interferograms of equal NaN fraction are
+    taken in interferogram order, so where weights tie the tree may differ
+    from the equally minimal tree of mst_boolean_array_networkx.
+
+    :param ifgs: Sequence of interferogram objects
+
+    :return Filter: returns array of independent ifgs from the pixel by pixel MST,
+    like that used by the Matlab Pirate package.
+    """
+    no_ifgs = len(ifgs)
+    no_y, no_x = ifgs[0].phase_data.shape
+    valid = array([~isnan(i.phase_data) for i in ifgs])
+    signatures, groups = unique_mask_patterns(valid)
+    log.info('Calculating mst of {} unique nan signatures for {} '
+             'pixels'.format(len(groups), no_y * no_x))
+
+    masters, slaves, nepochs = master_slave_indices(ifgs)
+    # stable sort, ties are resolved in interferogram order
+    order = np.argsort([i.nan_fraction for i in ifgs], kind='mergesort')
+    sig_mst = _kruskal(signatures, masters, slaves, order, nepochs)
+
+    # signature index of every pixel
+    inverse = np.empty(no_y * no_x, dtype=np.intp)
+    inverse[np.concatenate(groups)] = np.repeat(
+        np.arange(len(groups)), [len(g) for g in groups])
+    return sig_mst[:, inverse].reshape(no_ifgs, no_y, no_x)
+
+
+def _kruskal(valid, masters, slaves, order, nepochs):
+    """
+    Kruskal's algorithm for many networks sharing the same edges and edge
+    weights, each one using a subset of the edges. The union-find of all
+    networks is processed together, one edge at a time.
+
+    :param valid: Boolean array (nifgs, n) of the edges used by each network
+    :param masters: Master epoch index of each edge
+    :param slaves: Slave epoch index of each edge
+    :param order: Edge indices sorted by weight
+    :param nepochs: Number of epochs
+
+    :return Boolean array (nifgs, n) of the MST edges of each network
+    """
+    result = np.zeros(shape=valid.shape, dtype=bool)
+    # union-find parent of every epoch in every network
+    parent = np.tile(np.arange(nepochs, dtype=np.min_scalar_type(nepochs)),
+                     (valid.shape[1], 1))
+    for k in order:
+        pix = np.nonzero(valid[k])[0]
+        root_m = _find_roots(parent, pix, masters[k])
+        root_s = _find_roots(parent, pix, slaves[k])
+        # the edge joins two trees, otherwise it would close a loop
+        join = root_m != root_s
+        result[k, pix[join]] = True
+        parent[pix[join], root_m[join]] = root_s[join]
+    return result
+
+
+def _find_roots(parent, pix, node):
+    """
+    Returns the union-find roots of an epoch for the given pixels, and
+    points the epoch directly at its root.
+
+    :param parent: Array (npixels, nepochs) of union-find parents
+    :param pix: Indices of the pixels
+    :param node: Index of the epoch
+
+    :return Array of root epochs, one per pixel
+    """
+    roots = parent[pix, node]
+    while True:
+        up = parent[pix, roots]
+        if (up == roots).all():
+            break
+        roots = up
+    parent[pix, node] = roots
+    return roots
+
+
+def mst_boolean_array_networkx(ifgs):
+    """
+    NetworkX version of mst_boolean_array, kept as a reference.
 
     :param ifgs: Sequence of interferogram objects
         
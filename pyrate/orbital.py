@@ -18,17 +18,16 @@ This Python module implements residual orbital corrections for interferograms.
 """
 # pylint: disable=invalid-name
 import logging
-from collections import OrderedDict
-from numpy import empty, isnan, reshape, float32, squeeze
-from numpy import dot, vstack, zeros, meshgrid
+from numpy import empty, isnan, reshape, float32
+from numpy import dot, zeros, meshgrid
 import numpy as np
 from numpy.linalg import pinv
-# from joblib import Parallel, delayed
-from scipy.linalg import lstsq
+from joblib import Parallel, delayed
+from scipy.linalg import lstsq, cho_factor, cho_solve, LinAlgError
 
 from pyrate.algorithm import master_slave_ids, get_all_epochs
 from pyrate import mst, shared, prepifg
-from pyrate.shared import nanmedian, Ifg
+from pyrate.shared import nanmedian, Ifg, PrereadIfg
 from pyrate import config as cf
 from pyrate import ifgconstants as ifc
 from pyrate import mpiops
@@ -72,7 +71,7 @@ PART_CUBIC = cf.PART_CUBIC
 
 
 def orbital_correction(ifgs_or_ifg_paths, params, mlooked=None, offset=True,
-                       preread_ifgs=None):
+                       preread_ifgs=None, stack=None):
     """
     Removes orbital error from given interferograms.
 
@@ -85,13 +84,13 @@ def orbital_correction(ifgs_or_ifg_paths, params, mlooked=None, offset=True,
     :param method: INDEPENDENT_METHOD or NETWORK_METHOD
     :param mlooked: Sequence of multi-looked interferograms (must correspond to 'ifgs' arg)
     :param bool offset: True/False to include the constant/offset component
+    :param stack: Optional IfgStack the corrections are written through to,
+        instead of the interferogram files
     
     :return xxxxxx
     """
     degree = params[cf.ORBITAL_FIT_DEGREE]
     method = params[cf.ORBITAL_FIT_METHOD]
-    # parallel = params[cf.PARALLEL]  # not implemented
-
     if degree not in [PLANAR, QUADRATIC, PART_CUBIC]:
         msg = "Invalid degree of %s for orbital correction" % degree
         raise OrbitalError(msg)
@@ -103,20 +102,31 @@ def orbital_correction(ifgs_or_ifg_paths, params, mlooked=None, offset=True,
         if mlooked is None:
             network_correction(ifgs_or_ifg_paths, degree, offset, params,
                                m_ifgs=mlooked,
-                               preread_ifgs=preread_ifgs)
+                               preread_ifgs=preread_ifgs, stack=stack)
         else:
             _validate_mlooked(mlooked, ifgs_or_ifg_paths)
             network_correction(ifgs_or_ifg_paths, degree, offset, params,
-                               mlooked, preread_ifgs)
+                               mlooked, preread_ifgs, stack)
 
     elif method == INDEPENDENT_METHOD:
-        # not running in parallel
-        # raises swig object pickle error
-        # Parallel(n_jobs=params[cf.PROCESSES], verbose=50)(
-        #     delayed(_independent_correction)(ifg, degree, offset, params)
-        #     for ifg in ifgs)
-        for ifg in ifgs_or_ifg_paths:
-            independent_correction(ifg, degree, offset, params)
+        if not len(ifgs_or_ifg_paths):
+            return
+        # all interferograms share one geometry and thus one design matrix
+        fit = OrbitalFit(_shared_design_matrix(ifgs_or_ifg_paths[0], degree,
+                                               offset))
+        # only paths can be sent to the workers, open Ifgs raise a swig
+        # object pickle error. joblib memory maps the design matrix, so the
+        # workers share one copy of it
+        if params.get(cf.PARALLEL) and \
+                isinstance(ifgs_or_ifg_paths[0], str):
+            Parallel(n_jobs=params[cf.PROCESSES], verbose=50)(
+                delayed(independent_correction)(ifg, degree, offset, params,
+                                                fit, stack)
+                for ifg in ifgs_or_ifg_paths)
+        else:
+            for ifg in ifgs_or_ifg_paths:
+                independent_correction(ifg, degree, offset, params, fit,
+                                       stack)
     else:
         msg = "Unknown method: '%s', need INDEPENDENT or NETWORK method"
         raise OrbitalError(msg % method)
@@ -157,7 +167,82 @@ def _get_num_params(degree, offset=None):
     return nparams
 
 
-def independent_correction(ifg, degree, offset, params):
+def _shared_design_matrix(ifg, degree, offset):
+    """
+    Returns the design matrix of an interferogram or interferogram path,
+    shared by all interferograms of the same geometry.
+    """
+    if isinstance(ifg, str):
+        ifg = shared.Ifg(ifg)
+        ifg.open(readonly=True)
+        dm = get_design_matrix(ifg, degree, offset)
+        ifg.close()
+        return dm
+    return get_design_matrix(ifg, degree, offset)
+
+
+class OrbitalFit(object):
+    """
+    Least squares fits of one design matrix to the phase data of the
+    interferograms sharing its geometry. The normal equations of an
+    interferogram are formed from the moments dm'dm of the full grid minus
+    those of its NaN cells, or from its valid cells if they are fewer, so no
+    factorisation of the (num_cells, nparams) design matrix is needed.
+    """
+
+    def __init__(self, dm):
+        """
+        :param dm: Design matrix of the full grid, see get_design_matrix
+        """
+        self.dm = dm
+        self.gram = _gram(dm)
+
+    def solve(self, vphase):
+        """
+        Returns the model parameters fitted to the vectorised phase data.
+
+        :param vphase: Phase data of shape (num_cells,), NaN for no data
+
+        :return Array (nparams,) of model parameters
+        """
+        nan = isnan(vphase)
+        if 2 * np.count_nonzero(nan) <= len(vphase):
+            gram = self.gram - _gram(self.dm[nan])
+            rhs = _gram(self.dm, np.where(nan, 0, vphase))
+        else:
+            gram = _gram(self.dm[~nan])
+            rhs = _gram(self.dm[~nan], vphase[~nan])
+
+        # unit diagonal scaling keeps the normal equations well conditioned
+        scale = np.sqrt(np.diag(gram))
+        if np.all(scale > 0):
+            try:
+                factor = cho_factor(gram / np.outer(scale, scale))
+                # singular moments may factorise with round-off pivots
+                if np.min(np.abs(np.diag(factor[0])))**2 > 1e-10:
+                    return cho_solve(factor, rhs / scale) / scale
+            except LinAlgError:
+                pass
+        # rank deficient, e.g. too few valid cells
+        return lstsq(self.dm[~nan], vphase[~nan])[0]
+
+
+def _gram(dm, vec=None, chunk=2**16):
+    """
+    Returns dm'dm, or dm'vec if vec is given, accumulated in double
+    precision over blocks of rows.
+    """
+    out = zeros((dm.shape[1], dm.shape[1]) if vec is None else dm.shape[1],
+                dtype=np.float64)
+    for r in range(0, dm.shape[0], chunk):
+        block = dm[r:r + chunk].astype(np.float64)
+        out += block.T.dot(block if vec is None else vec[r:r + chunk])
+    return out
+
+
+def independent_correction(ifg, degree, offset, params, fit=None,
+                           stack=None):
+    # pylint: disable=too-many-arguments
     """
     Calculates and removes orbital correction from an interferogram.
     .. warn:: This will write orbital error corrected phase_data in the interferograms.
@@ -166,6 +251,8 @@ def independent_correction(ifg, degree, offset, params):
     :param degree: PLANAR, QUADRATIC or PART_CUBIC
     :param offset: Boolean
     :param params: Parameter dictionary
+    :param fit: Optional OrbitalFit of the interferogram geometry
+    :param stack: Optional IfgStack the correction is written through to
     
     :return xxxx
     """
@@ -175,12 +262,12 @@ def independent_correction(ifg, degree, offset, params):
     shared.nan_and_mm_convert(ifg, params)
     # vectorise, keeping NODATA
     vphase = reshape(ifg.phase_data, ifg.num_cells)
-    dm = get_design_matrix(ifg, degree, offset)
+    if fit is None:
+        fit = OrbitalFit(get_design_matrix(ifg, degree, offset))
+    dm = fit.dm
 
-    # filter NaNs out before getting model
-    clean_dm = dm[~isnan(vphase)]
-    data = vphase[~isnan(vphase)]
-    model = lstsq(clean_dm, data)[0]  # first arg is the model params
+    # NaN cells are left out of the model fit
+    model = fit.solve(vphase)
 
     # calculate forward model & morph back to 2D
     if offset:
@@ -189,6 +276,9 @@ def independent_correction(ifg, degree, offset, params):
     else:
         fullorb = np.reshape(np.dot(dm, model), ifg.phase_data.shape)
     offset_removal = nanmedian(np.ravel(ifg.phase_data - fullorb))
+    if stack is not None:
+        _remove_from_stack(ifg, fullorb - offset_removal, stack)
+        return
     ifg.phase_data -= (fullorb - offset_removal)
     # set orbfit tags after orbital error correction
     _save_orbital_error_corrected_phase(ifg)
@@ -197,44 +287,61 @@ def independent_correction(ifg, degree, offset, params):
 
 
 def network_correction(ifgs, degree, offset, params, m_ifgs=None,
-                       preread_ifgs=None):
+                       preread_ifgs=None, stack=None):
     """
     Calculates orbital correction model, removing this from the interferograms.
     .. warn:: This will write orbital error corrected phase_data in the interferograms.
 
-    :param ifgs: Interferograms reduced to a minimum tree from prior
-        MST calculations
+    Under MPI, every process passes its own interferograms. The network MST
+    and the normal equations of the network inversion are formed across all
+    processes, see network_normal_equations.
+
+    :param ifgs: Interferograms of this process
     :param degree: PLANAR, QUADRATIC or PART_CUBIC
     :param offset: True to calculate the model using offsets
     :param params: Parameter dictionary
     :param m_ifgs: Multi-looked orbfit interferograms (sequence must be mlooked
         versions of 'ifgs' arg)
     :param preread_ifgs: Parameters dict corresponding to config file
+    :param stack: Optional IfgStack the corrections are written through to
     
     :return xxxx
     """
     # pylint: disable=too-many-locals, too-many-arguments
     src_ifgs = ifgs if m_ifgs is None else m_ifgs
-    src_ifgs = mst.mst_from_ifgs(src_ifgs)[3]  # use networkx mst
-
-    vphase = vstack([i.phase_data.reshape((i.num_cells, 1)) for i in src_ifgs])
-    vphase = squeeze(vphase)
 
-    B = get_network_design_matrix(src_ifgs, degree, offset)
-
-    # filter NaNs out before getting model
-    B = B[~isnan(vphase)]
-    orbparams = dot(pinv(B, 1e-6), vphase[~isnan(vphase)])
+    # only the dates and nan fractions of all interferograms are needed to
+    # find the MST, the phase data stays with its process
+    headers = mpiops.comm.allgather([
+        PrereadIfg(path=None, nan_fraction=i.nan_fraction, master=i.master,
+                   slave=i.slave, time_span=None, nrows=i.nrows,
+                   ncols=i.ncols, metadata=None) for i in src_ifgs])
+    first = sum(len(h) for h in headers[:mpiops.rank])
+    headers = [h for process_headers in headers for h in process_headers]
+    mst_ifgs = mst.mst_from_ifgs(headers)[3]  # use networkx mst
+    mst_ids = dict((id(h), k) for k, h in enumerate(mst_ifgs))
+    ids = master_slave_ids(get_all_epochs(headers))
+
+    # interferograms of this process in the MST and their network index
+    network = [(i, mst_ids[id(headers[first + k])])
+               for k, i in enumerate(src_ifgs) if id(headers[first + k])
+               in mst_ids]
+    norm_mat, rhs = network_normal_equations(
+        [i for i, _ in network], degree, offset, ids,
+        ifg_ids=[j for _, j in network], nifgs=len(mst_ifgs))
+    mpiops.allreduce_sum(norm_mat)
+    mpiops.allreduce_sum(rhs)
+    # pinv of the normal matrix equals pinv(B) * pinv(B)', hence the
+    # squared cutoff
+    orbparams = dot(pinv(norm_mat, 1e-12), rhs)
 
     ncoef = _get_num_params(degree)
-    if preread_ifgs:
-        temp_ifgs = OrderedDict(sorted(preread_ifgs.items())).values()
-        ids = master_slave_ids(get_all_epochs(temp_ifgs))
-    else:
-        ids = master_slave_ids(get_all_epochs(ifgs))
     coefs = [orbparams[i:i+ncoef] for i in
              range(0, len(set(ids)) * ncoef, ncoef)]
 
+    if not len(ifgs):  # more processes than interferograms
+        return
+
     # create full res DM to expand determined coefficients into full res
     # orbital correction (eg. expand coarser model to full size)
 
@@ -255,16 +362,19 @@ def network_correction(ifgs, degree, offset, params, m_ifgs=None,
             i = Ifg(i)
             i.open(readonly=False)
             shared.nan_and_mm_convert(i, params)
-        _remove_networkx_error(coefs, dm, i, ids, offset)
+        _remove_networkx_error(coefs, dm, i, ids, offset, stack)
 
 
-def _remove_networkx_error(coefs, dm, ifg, ids, offset):
+def _remove_networkx_error(coefs, dm, ifg, ids, offset, stack=None):
     orb = dm.dot(coefs[ids[ifg.slave]] - coefs[ids[ifg.master]])
     orb = orb.reshape(ifg.shape)
     # offset estimation
     if offset:
         # bring all ifgs to same base level
         orb -= nanmedian(np.ravel(ifg.phase_data - orb))
+    if stack is not None:
+        _remove_from_stack(ifg, orb, stack)
+        return
     ifg.phase_data -= orb  # remove orbital error from the ifg
     # set orbfit tags after orbital error correction
     _save_orbital_error_corrected_phase(ifg)
@@ -283,6 +393,20 @@ def _save_orbital_error_corrected_phase(ifg):
     ifg.close()
 
 
+def _remove_from_stack(ifg, orb, stack):
+    """
+    Removes the orbital error surface from the phase data of an
+    interferogram in the stack. The interferogram file is left as it is,
+    it is exported from the stack after the reference phase removal.
+
+    :param ifg: Interferogram class instance
+    :param orb: Orbital error surface of shape ifg.shape
+    :param stack: IfgStack of the interferogram
+    """
+    stack.write(ifg.data_path, stack.read(ifg.data_path) - orb)
+    ifg.close()
+
+
 # TODO: subtract reference pixel coordinate from x and y
 def get_design_matrix(ifg, degree, offset, scale=100.0):
     """
@@ -390,19 +514,95 @@ def get_network_design_matrix(ifgs, degree, offset):
     return netdm
 
 
+def network_normal_equations(ifgs, degree, offset, ids=None, ifg_ids=None,
+                             nifgs=None):
+    # pylint: disable=too-many-arguments, too-many-locals
+    """
+    Returns the normal equations B'B and B'd of the network inversion, with
+    B the network design matrix (see get_network_design_matrix) and d the
+    stacked phase data without NaN cells. They are accumulated interferogram
+    by interferogram, so B is never formed: each interferogram only
+    contributes the blocks of its master, slave and offset columns.
+
+    Equations of subsets of the network, e.g. the interferograms of each MPI
+    process, add up to those of the whole network.
+
+    :param ifgs: Sequence of interferograms
+    :param degree: PLANAR, QUADRATIC or PART_CUBIC
+    :param offset: True to include offset cols, otherwise False
+    :param ids: Dict of epoch date: epoch index of the whole network,
+        defaults to the epochs of ifgs
+    :param ifg_ids: Index of each interferogram in the whole network,
+        defaults to range(len(ifgs))
+    :param nifgs: Number of interferograms of the whole network,
+        defaults to len(ifgs)
+
+    :return norm_mat: Array (nparams, nparams) of B'B
+    :return rhs: Array (nparams,) of B'd
+    """
+    if degree not in [PLANAR, QUADRATIC, PART_CUBIC]:
+        raise OrbitalError("Invalid degree argument")
+
+    if ids is None:
+        if len(ifgs) < 1:
+            raise OrbitalError("Invalid number of Ifgs: %s" % len(ifgs))
+        ids = master_slave_ids(get_all_epochs(ifgs))
+    ifg_ids = range(len(ifgs)) if ifg_ids is None else ifg_ids
+    nifgs = len(ifgs) if nifgs is None else nifgs
+
+    ncoef = _get_num_params(degree)
+    offset_col = len(ids) * ncoef  # base offset for the offset cols
+    nparams = offset_col + nifgs if offset else offset_col
+    norm_mat = zeros((nparams, nparams), dtype=np.float64)
+    rhs = zeros(nparams, dtype=np.float64)
+    if not len(ifgs):
+        return norm_mat, rhs
+
+    tmpdm = get_design_matrix(ifgs[0], degree, offset=False).astype(
+        np.float64)
+    for ifg, k in zip(ifgs, ifg_ids):
+        vphase = reshape(ifg.phase_data, tmpdm.shape[0])
+        valid = ~isnan(vphase)
+        dm = tmpdm[valid]
+        data = vphase[valid]
+        gram = dm.T.dot(dm)
+        proj = dm.T.dot(data)
+        m = slice(ids[ifg.master] * ncoef, (ids[ifg.master] + 1) * ncoef)
+        s = slice(ids[ifg.slave] * ncoef, (ids[ifg.slave] + 1) * ncoef)
+        # the design matrix block is -tmpdm for the master, tmpdm for the
+        # slave and a column of ones for the offset
+        norm_mat[m, m] += gram
+        norm_mat[s, s] += gram
+        norm_mat[m, s] -= gram
+        norm_mat[s, m] -= gram
+        rhs[m] -= proj
+        rhs[s] += proj
+        if offset:
+            o = offset_col + k
+            col_sums = dm.sum(axis=0)
+            norm_mat[o, o] += len(data)
+            norm_mat[o, m] -= col_sums
+            norm_mat[m, o] -= col_sums
+            norm_mat[o, s] += col_sums
+            norm_mat[s, o] += col_sums
+            rhs[o] += data.sum()
+    return norm_mat, rhs
+
+
 class OrbitalError(Exception):
     """
     Generic class for errors in orbital correction.
     """
 
 
-def remove_orbital_error(ifgs, params, preread_ifgs=None):
+def remove_orbital_error(ifgs, params, preread_ifgs=None, stack=None):
     """
     Wrapper for orbital error removal functionality.
 
     :param ifgs: List of interferograms or interferogram paths
     :param params: Dict corresponding to config parameters
     :param preread_ifgs: Dict containing information regarding MPI jobs (optional)
+    :param stack: Optional IfgStack the corrections are written through to
     
     :return xxxx
     """
@@ -420,13 +620,13 @@ def remove_orbital_error(ifgs, params, preread_ifgs=None):
             _check_orbital_ifgs(preread_ifgs)
 
     ifg_paths = [i.data_path for i in ifgs] \
-        if isinstance(ifgs[0], Ifg) else ifgs
+        if len(ifgs) and isinstance(ifgs[0], Ifg) else ifgs
 
     mlooked = None
 
     # mlooking is not necessary for independent correction
-    # can use multiple procesing if write_to_disc=True
-    if params[cf.ORBITAL_FIT_METHOD] == 2:
+    # every process multi-looks its own interferograms
+    if params[cf.ORBITAL_FIT_METHOD] == 2 and len(ifg_paths):
         mlooked_dataset = prepifg.prepare_ifgs(
             ifg_paths,
             crop_opt=prepifg.ALREADY_SAME_SIZE,
@@ -443,12 +643,13 @@ def remove_orbital_error(ifgs, params, preread_ifgs=None):
             m.convert_to_mm()
 
     orbital_correction(ifgs, params, mlooked=mlooked,
-                       preread_ifgs=preread_ifgs)
+                       preread_ifgs=preread_ifgs, stack=stack)
 
 
 def _check_orbital_ifgs(preread_ifgs):  # pragma: no cover
 
-    ifg_paths = sorted(preread_ifgs.keys())
+    ifg_paths = sorted(k for k, v in preread_ifgs.items()
+                       if isinstance(v, PrereadIfg))
     # preread_ifgs[i].metadata contains ifg metadata
     flags = [ifc.PYRATE_ORBITAL_ERROR in preread_ifgs[i].metadata
              for i in ifg_paths]
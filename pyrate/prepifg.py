@@ -28,8 +28,8 @@ from numbers import Number
 from subprocess import check_call
 from tempfile import mkstemp
 
-from numpy import array, where, nan, isnan, nanmean, float32, zeros, \
-    sum as nsum
+from numpy import array, where, nan, isnan, float32, empty, errstate
+import numpy as np
 from osgeo import gdal
 
 from pyrate import config as cf
@@ -49,6 +49,9 @@ CROP_OPTIONS = [MINIMUM_CROP, MAXIMUM_CROP, CUSTOM_CROP, ALREADY_SAME_SIZE]
 
 GRID_TOL = 1e-6
 
+# input cells per row band of resample, bounding its intermediate arrays
+RESAMPLE_BAND_CELLS = 2**24
+
 
 def is_number(s):
     """
@@ -341,18 +344,22 @@ def warp(ifg, x_looks, y_looks, extents, resolution, thresh, crop_out,
         return resampled_data, out_ds
 
 
-def resample(data, xscale, yscale, thresh):
+def resample(data, xscale, yscale, thresh, band_rows=None):
     """
-    # TODO: make more efficient
-    This is the slowest step in prepifg
     Resamples/averages 'data' to return an array from the averaging of blocks
     of several tiles in 'data'. NB: Assumes incoherent cells are NaNs.
 
+    The blocks of a band of output rows are averaged at once by reshaping
+    the band to (rows, yscale, cols, xscale). Cells beyond the last whole
+    block are ignored.
+
     :param data: Source array to resample to different size
     :param xscale: Number of cells to average along X axis
     :param yscale: Number of Y axis cells to average
     :param thresh: Minimum allowable proportion of NaN cells (range from 0.0-1.0), eg. 0.25 = 1/4 or
         more as NaNs results in a NaN value for the output cell
+    :param band_rows: Number of output rows averaged at a time, by default
+        bands of about RESAMPLE_BAND_CELLS input cells
     
     :return xxxx
     """
@@ -363,17 +370,27 @@ def resample(data, xscale, yscale, thresh):
     yscale = int(yscale)
     ysize, xsize = data.shape
     xres, yres = int(xsize / xscale), int(ysize / yscale)
-    dest = zeros((yres, xres), dtype=float32) * nan
+    dest = empty((yres, xres), dtype=float32)
     tile_cell_count = xscale * yscale
-
-    # calc mean without nans (fractional threshold ignores tiles
-    # with excess NaNs)
-    for x in range(xres):
-        for y in range(yres):
-            tile = data[y * yscale: (y+1) * yscale, x * xscale: (x+1) * xscale]
-            nan_fraction = nsum(isnan(tile)) / float(tile_cell_count)
-            if nan_fraction < thresh or (nan_fraction == 0 and thresh == 0):
-                dest[y, x] = nanmean(tile)
+    if band_rows is None:
+        band_rows = max(RESAMPLE_BAND_CELLS // max(xsize * yscale, 1), 1)
+
+    for r in range(0, yres, band_rows):
+        nrows = min(band_rows, yres - r)
+        band = data[r * yscale:(r + nrows) * yscale, :xres * xscale]
+        band = band.reshape(nrows, yscale, xres, xscale)
+        nans = isnan(band)
+        nan_count = nans.sum(axis=(1, 3))
+        total = where(nans, 0, band).sum(axis=(1, 3), dtype=np.float64)
+
+        # calc mean without nans (fractional threshold ignores tiles
+        # with excess NaNs)
+        nan_fraction = nan_count / float(tile_cell_count)
+        keep = (nan_fraction < thresh) | ((nan_fraction == 0) & (thresh == 0))
+        with errstate(invalid='ignore', divide='ignore'):
+            dest[r:r + nrows] = where(keep,
+                                      total / (tile_cell_count - nan_count),
+                                      nan)
     return dest
 
 
@@ -17,12 +17,10 @@
 This Python module implements an algorithm to search for the location
 of the interferometric reference pixel
 """
-import os
 import logging
 from itertools import product
 import numpy as np
 from numpy import isnan, std, mean, sum as nsum
-from joblib import Parallel, delayed
 
 import pyrate.config as cf
 from pyrate.shared import Ifg
@@ -46,20 +44,11 @@ def ref_pixel(ifgs, params):
     :return xxxx
     """
     half_patch_size, thresh, grid = ref_pixel_setup(ifgs, params)
-    parallel = params[cf.PARALLEL]
-    if parallel:
-        phase_data = [i.phase_data for i in ifgs]
-        mean_sds = Parallel(n_jobs=params[cf.PROCESSES], verbose=50)(
-            delayed(ref_pixel_multi)(g, half_patch_size, phase_data,
-                                     thresh, params) for g in grid)
-        refy, refx = filter_means(mean_sds, grid)
-    else:
-        phase_data = [i.phase_data for i in ifgs]
-        mean_sds = []
-        for g in grid:
-            mean_sds.append(ref_pixel_multi(
-                g, half_patch_size, phase_data, thresh, params))
-        refy, refx = filter_means(mean_sds, grid)
+    phase_data = [i.phase_data for i in ifgs]
+    sd_sum, ninvalid = ref_pixel_sds(grid, half_patch_size, phase_data,
+                                     thresh, params)
+    mean_sds = chip_mean_sds(sd_sum, ninvalid, len(ifgs))
+    refy, refx = filter_means(mean_sds, grid)
 
     if refy and refx:
         return refy, refx
@@ -73,19 +62,18 @@ def filter_means(mean_sds, grid):
     Parameters.
     
     :param mean_sds: List of mean standard deviations from each reference pixel grid
-    :param grid: List of grid tuples
+    :param grid: List of grid tuples, or array (nnodes, 2) of a dense search
     
     :return Tuple of (refy, refx)
     """
     log.info('Filtering means during reference pixel computation')
     refp_index = np.nanargmin(mean_sds)
-    return grid[refp_index]
+    return tuple(int(i) for i in grid[refp_index])
 
 
 def ref_pixel_setup(ifgs_or_paths, params):
     """
     Sets up the grid for reference pixel computation.
-    Also saves numpy files for later use during reference pixel computation.
     
     :param ifgs_or_paths: xxxx
     :param params: xxxx
@@ -111,6 +99,8 @@ def ref_pixel_setup(ifgs_or_paths, params):
     _validate_chipsize(chipsize, head)
     _validate_minimum_fraction(min_frac)
     _validate_search_win(refnx, refny, chipsize, head)
+    stride = params.get(cf.REF_STRIDE, 0)
+    _validate_stride(stride)
     # pre-calculate useful amounts
     half_patch_size = chipsize // 2
     chipsize = half_patch_size * 2 + 1
@@ -118,63 +108,192 @@ def ref_pixel_setup(ifgs_or_paths, params):
     # do window searches across dataset, central pixel of stack with smallest
     # mean is the reference pixel
     rows, cols = head.shape
-    ysteps = step(rows, refny, half_patch_size)
-    xsteps = step(cols, refnx, half_patch_size)
+    if stride > 0:
+        log.info('Dense ref pixel search with a stride of {}'.format(stride))
+        grid = dense_grid(rows, cols, half_patch_size, stride)
+    else:
+        ysteps = step(rows, refny, half_patch_size)
+        xsteps = step(cols, refnx, half_patch_size)
+        grid = list(product(ysteps, xsteps))
     log.info('Ref pixel setup finished')
-    return half_patch_size, thresh, list(product(ysteps, xsteps))
+    return half_patch_size, thresh, grid
 
 
-def ref_pixel_mpi(process_grid, half_patch_size, ifgs, thresh, params):
+def dense_grid(rows, cols, radius, stride):
     """
-    Convenience function for reference pixel calculation for each process.
-    
-    :param process_grid: xxxx
-    :param half_patch_size: xxxx
-    :param ifgs: xxxx
-    :param thresh: xxxx
-    :param params: xxxx
-    
-    :return xxxx    
+    Returns the nodes of a dense reference pixel search, every stride-th
+    pixel whose chip lies inside the raster.
+
+    :param rows: Number of rows of the raster
+    :param cols: Number of columns of the raster
+    :param radius: The number of cells from the centre of the chip
+    :param stride: Distance in pixels between the search nodes
+
+    :return Integer array (nnodes, 2) of (y, x) nodes, in row major order
     """
-    log.info('Ref pixel calculation started')
-    mean_sds = []
-    for g in process_grid:
-        mean_sds.append(ref_pixel_multi(g, half_patch_size, ifgs, thresh,
-                                        params))
-    return mean_sds
+    ysteps = np.arange(radius, rows - radius, stride)
+    xsteps = np.arange(radius, cols - radius, stride)
+    ys, xs = np.meshgrid(ysteps, xsteps, indexing='ij')
+    return np.column_stack([ys.ravel(), xs.ravel()])
 
 
-def ref_pixel_multi(g, half_patch_size, phase_data_or_ifg_paths,
-                    thresh, params):
+def ref_pixel_surface(mean_sds, grid, shape):
+    """
+    Places the mean chip standard deviations of the search nodes on the
+    raster, e.g. to inspect the scores of a dense search.
+
+    :param mean_sds: Array of mean standard deviations of the grid nodes
+    :param grid: List of grid tuples, or array (nnodes, 2) of a dense search
+    :param shape: Shape (rows, cols) of the raster
+
+    :return Float32 array of the given shape, NaN away from the nodes
+    """
+    ys, xs = np.array(grid, dtype=np.intp).reshape(-1, 2).T
+    surface = np.empty(shape, dtype=np.float32)
+    surface.fill(np.nan)
+    surface[ys, xs] = mean_sds
+    return surface
+
+
+def ref_pixel_sds(grid, half_patch_size, phase_data_or_ifg_paths, thresh,
+                  params):
+    """
+    Accumulates the standard deviations of the chips centred at the grid
+    nodes over interferograms. Each interferogram is read once, and the
+    statistics of all its chips come from integral images, see chip_sds.
+
+    :param grid: List of (y, x) grid tuples, or array (nnodes, 2)
+    :param half_patch_size: Number of cells from the chip centre to its edge
+    :param phase_data_or_ifg_paths: List of phase data arrays or ifg paths
+    :param thresh: Minimum number of valid cells of a chip
+    :param params: Parameters dictionary
+
+    :return sd_sum: Array (nnodes,) of chip standard deviations summed over
+        interferograms
+    :return ninvalid: Array (nnodes,) of the number of interferograms in
+        which the chip has too few valid cells
+    """
+    ys, xs = np.array(grid, dtype=np.intp).reshape(-1, 2).T
+    sd_sum = np.zeros(len(ys), dtype=np.float64)
+    ninvalid = np.zeros(len(ys), dtype=np.float64)
+    for p in phase_data_or_ifg_paths:
+        if isinstance(p, str):
+            # one ifg.phase_data in memory at any time
+            ifg = Ifg(p)
+            ifg.open(readonly=True)
+            ifg.nodata_value = params[cf.NO_DATA_VALUE]
+            ifg.convert_to_nans()
+            ifg.convert_to_mm()
+            phase_data = ifg.phase_data
+            ifg.close()
+        else:
+            phase_data = p
+        count, sd = chip_sds(phase_data, ys, xs, half_patch_size)
+        valid = count > thresh
+        sd_sum[valid] += sd[valid]
+        ninvalid[~valid] += 1
+    return sd_sum, ninvalid
+
+
+def chip_mean_sds(sd_sum, ninvalid, nifgs):
     """
-    Convenience function for for reference pixel optimisation.
+    Mean chip standard deviations of the grid nodes, NaN where a chip of
+    1+ interferograms has too many incoherent cells.
+
+    :param sd_sum: Array of chip standard deviations summed over ifgs
+    :param ninvalid: Array of the number of ifgs with an invalid chip
+    :param nifgs: Number of interferograms
+
+    :return Array of mean standard deviations
+    """
+    return np.where(ninvalid > 0, np.nan, sd_sum / nifgs)
+
+
+def chip_sds(phase_data, ys, xs, half_patch_size):
+    """
+    NaN aware standard deviations of the chips centred at (ys, xs), each
+    evaluated in O(1) from integral images of the valid cell count, sum
+    and sum of squares of the phase data.
+
+    :param phase_data: Phase data array of shape (rows, cols)
+    :param ys: Array of chip centre rows
+    :param xs: Array of chip centre columns
+    :param half_patch_size: Number of cells from the chip centre to its edge
+
+    :return count: Array of the number of valid cells of each chip
+    :return sd: Array of the standard deviations of the valid chip cells
+    """
+    valid = ~isnan(phase_data)
+    # the variance is shift invariant, centring keeps the sums small
+    offset = np.nanmean(phase_data[::16, ::16]) \
+        if valid[::16, ::16].any() else 0.0
+    # float64 before centring, float32 sums of squares cancel badly in var
+    data = phase_data.astype(np.float64) - offset
+    data[~valid] = 0
+    top, bottom = ys - half_patch_size, ys + half_patch_size + 1
+    left, right = xs - half_patch_size, xs + half_patch_size + 1
+    # the integral images are only needed at the chip edge rows
+    rows = np.unique(np.concatenate([[0, phase_data.shape[0]], top, bottom]))
+    top, bottom = np.searchsorted(rows, top), np.searchsorted(rows, bottom)
+
+    def _chip_sums(arr):
+        sat = _integral_image(arr, rows)
+        return sat[bottom, right] - sat[top, right] - \
+            sat[bottom, left] + sat[top, left]
+
+    count = _chip_sums(valid)
+    total = _chip_sums(data)
+    data *= data
+    total_sq = _chip_sums(data)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_sq = total_sq / count
+        var = mean_sq - (total / count)**2
+        # zero the float64 round-off of the difference, eg. for constant
+        # chips: each integral image cell adds up to rows + cols terms
+        tol = sum(phase_data.shape) * np.finfo(np.float64).eps * \
+            (offset**2 + mean_sq + data.sum() / count)
+        var[var <= tol] = 0
+    return count, np.sqrt(var)
+
+
+def _integral_image(arr, rows):
+    """
+    Rows of the summed area table of arr, sat[k, x] being the sum of
+    arr[:rows[k], :x].
+
+    :param arr: Array of shape (nrows, ncols)
+    :param rows: Sorted unique row indices, starting at 0 and ending
+        at nrows
+
+    :return Array of shape (len(rows), ncols + 1)
+    """
+    sat = np.zeros((len(rows), arr.shape[1] + 1), dtype=np.float64)
+    # sums of the row bands between consecutive rows, in one pass
+    bands = np.add.reduceat(arr, rows[:-1], axis=0, dtype=np.float64)
+    np.cumsum(bands, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def ref_pixel_multi(g, half_patch_size, phase_data, thresh, params):
+    """
+    Mean standard deviation of the chips of a single grid node, computed
+    chip by chip. Kept as a reference for ref_pixel_sds.
     
     :param g: xxxx
     :param half_patch_size: xxxx
-    :param phase_data_or_ifg_paths: xxxx
+    :param phase_data: List of phase data arrays
     :param thresh: xxxx
     :param params: xxxx
     
     :return xxxx 
     """
     # pylint: disable=invalid-name
-    # phase_data_or_ifg is list of ifgs
+    # pylint: disable=unused-argument
     y, x, = g
-    if isinstance(phase_data_or_ifg_paths[0], str):
-        # this consumes a lot less memory
-        # one ifg.phase_data in memory at any time
-        data = []
-        output_dir = params[cf.TMPDIR]
-        for p in phase_data_or_ifg_paths:
-            data_file = os.path.join(output_dir,
-                                     'ref_phase_data_{b}_{y}_{x}.npy'.format(
-                                         b=os.path.basename(p).split('.')[0],
-                                         y=y, x=x))
-            data.append(np.load(file=data_file))
-    else:  # phase_data_or_ifg is phase_data list
-        data = [p[y - half_patch_size:y + half_patch_size + 1,
-                  x - half_patch_size:x + half_patch_size + 1]
-                for p in phase_data_or_ifg_paths]
+    data = [p[y - half_patch_size:y + half_patch_size + 1,
+              x - half_patch_size:x + half_patch_size + 1]
+            for p in phase_data]
     valid = [nsum(~isnan(d)) > thresh for d in data]
     if all(valid):  # ignore if 1+ ifgs have too many incoherent cells
         sd = [std(i[~isnan(i)]) for i in data]
@@ -246,6 +365,12 @@ def _validate_search_win(refnx, refny, chipsize, head):
         raise ValueError(msg % max_rows)
 
 
+def _validate_stride(stride):
+    """Sanity check the dense search stride."""
+    if stride < 0:
+        raise ValueError("Reference pixel stride must be >= 0")
+
+
 class RefPixelError(Exception):
     '''
     Generic exception for reference pixel errors.
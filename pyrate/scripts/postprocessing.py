@@ -110,16 +110,23 @@ def save_linrate(ifgs_dict, params, tiles, out_type):
     else:
         md[ifc.DATA_TYPE] = ifc.LINSAMP
 
-    rate = np.zeros(shape=ifgs[0].shape, dtype=np.float32)
+    # stream the tiles into the outputs, the full size rate is never
+    # held in memory
+    writer = shared.GeotiffWriter(md, gt, wkt, ifgs[0].shape, dest, np.nan,
+                                  params)
+    npy_rate_file = os.path.join(params[cf.OUT_DIR], out_type + '.npy')
+    rate = np.lib.format.open_memmap(npy_rate_file, mode='w+',
+                                     dtype=np.float32, shape=ifgs[0].shape)
     for t in tiles:
         rate_file = os.path.join(params[cf.TMPDIR], out_type +
                                  '_{}.npy'.format(t.index))
         rate_tile = np.load(file=rate_file)
+        writer.write_tile(rate_tile, t)
         rate[t.top_left_y:t.bottom_right_y,
              t.top_left_x:t.bottom_right_x] = rate_tile
-    shared.write_output_geotiff(md, gt, wkt, rate, dest, np.nan)
-    npy_rate_file = os.path.join(params[cf.OUT_DIR], out_type + '.npy')
-    np.save(file=npy_rate_file, arr=rate)
+    writer.close()
+    rate.flush()
+    del rate
     log.info('Finished PyRate postprocessing {}'.format(out_type))
 
 
@@ -141,18 +148,24 @@ def postprocess_timeseries(rows, cols, params):
 
     # load previously saved prepread_ifgs dict
     preread_ifgs_file = join(output_dir, 'preread_ifgs.pk')
-    ifgs = cp.load(open(preread_ifgs_file, 'rb'))
+    ifgs_dict = cp.load(open(preread_ifgs_file, 'rb'))
 
     # metadata and projections
-    gt, md, wkt = ifgs['gt'], ifgs['md'], ifgs['wkt']
-    epochlist = ifgs['epochlist']
-    ifgs = [v for v in ifgs.values() if isinstance(v, PrereadIfg)]
+    gt, md, wkt = ifgs_dict['gt'], ifgs_dict['md'], ifgs_dict['wkt']
+    epochlist = ifgs_dict['epochlist']
+    ifgs = [v for v in ifgs_dict.values() if isinstance(v, PrereadIfg)]
 
     tiles = run_pyrate.get_tiles(dest_tifs[0], rows, cols)
 
+    if params.get(cf.TIME_SERIES_CUBE):
+        # one cube per quantity, the processes share the two quantities
+        for out_type in mpiops.array_split(['tscuml', 'tsincr']):
+            save_timeseries_cube(ifgs_dict, params, tiles, out_type)
+        return
+
     # load the first tsincr file to determine the number of time series tifs
     tsincr_file = os.path.join(output_dir, 'tsincr_0.npy')
-    tsincr = np.load(file=tsincr_file)
+    tsincr = np.load(file=tsincr_file, mmap_mode='r')
 
     # pylint: disable=no-member
     no_ts_tifs = tsincr.shape[2]
@@ -167,41 +180,59 @@ def postprocess_timeseries(rows, cols, params):
     log.info('process {} will write {} ts (incr/cuml) tifs of '
              'total {}'.format(mpiops.rank, len(process_tifs), no_ts_tifs * 2))
     for i in process_tifs:
-        tscum_g = np.empty(shape=ifgs[0].shape, dtype=np.float32)
         if i < no_ts_tifs:
-            for n, t in enumerate(tiles):
-                tscum_file = os.path.join(output_dir,
-                                          'tscuml_{}.npy'.format(n))
-                tscum = np.load(file=tscum_file)
-
-                md[ifc.EPOCH_DATE] = epochlist.dates[i + 1]
-                # sequence position; first time slice is #0
-                md['SEQUENCE_POSITION'] = i+1
-                tscum_g[t.top_left_y:t.bottom_right_y,
-                        t.top_left_x:t.bottom_right_x] = tscum[:, :, i]
-                dest = os.path.join(params[cf.OUT_DIR],
-                                    'tscuml' + "_" +
-                                    str(epochlist.dates[i + 1]) + ".tif")
-                md[ifc.DATA_TYPE] = ifc.CUML
-                shared.write_output_geotiff(md, gt, wkt, tscum_g, dest, np.nan)
+            out_type, data_type = 'tscuml', ifc.CUML
         else:
-            tsincr_g = np.empty(shape=ifgs[0].shape, dtype=np.float32)
+            out_type, data_type = 'tsincr', ifc.INCR
             i %= no_ts_tifs
-            for n, t in enumerate(tiles):
-                tsincr_file = os.path.join(output_dir,
-                                           'tsincr_{}.npy'.format(n))
-                tsincr = np.load(file=tsincr_file)
-
-                md[ifc.EPOCH_DATE] = epochlist.dates[i + 1]
-                # sequence position; first time slice is #0
-                md['SEQUENCE_POSITION'] = i+1
-                tsincr_g[t.top_left_y:t.bottom_right_y,
-                         t.top_left_x:t.bottom_right_x] = tsincr[:, :, i]
-                dest = os.path.join(params[cf.OUT_DIR],
-                                    'tsincr' + "_" + str(
-                                        epochlist.dates[i + 1]) + ".tif")
-                md[ifc.DATA_TYPE] = ifc.INCR
-                shared.write_output_geotiff(md, gt, wkt, tsincr_g, dest,
-                                            np.nan)
+        md[ifc.EPOCH_DATE] = epochlist.dates[i + 1]
+        # sequence position; first time slice is #0
+        md['SEQUENCE_POSITION'] = i+1
+        md[ifc.DATA_TYPE] = data_type
+        dest = os.path.join(params[cf.OUT_DIR], out_type + "_" +
+                            str(epochlist.dates[i + 1]) + ".tif")
+        # one tile of one time slice in memory at any time
+        writer = shared.GeotiffWriter(md, gt, wkt, ifgs[0].shape, dest,
+                                      np.nan, params)
+        for n, t in enumerate(tiles):
+            ts_file = os.path.join(output_dir,
+                                   out_type + '_{}.npy'.format(n))
+            ts_tile = np.load(file=ts_file, mmap_mode='r')
+            writer.write_tile(np.array(ts_tile[:, :, i], dtype=np.float32), t)
+        writer.close()
     log.info('process {} finished writing {} ts (incr/cuml) tifs of '
              'total {}'.format(mpiops.rank, len(process_tifs), no_ts_tifs * 2))
+
+
+def save_timeseries_cube(ifgs_dict, params, tiles, out_type):
+    """
+    Save a time series output as one multi-band GeoTIFF, band k holding
+    the epoch k + 1 with its date in the band metadata. Each tile is read
+    once and written to all bands.
+
+    :param ifgs_dict: Dictionary of PrereadIfgs and projection information
+    :param params: Configuration parameters
+    :param tiles: List of tiles
+    :param out_type: 'tscuml' or 'tsincr'
+    """
+    log.info('Starting PyRate postprocessing {}'.format(out_type))
+    gt, wkt = ifgs_dict['gt'], ifgs_dict['wkt']
+    # the dates are per band, keep them out of the dataset metadata
+    md = dict(ifgs_dict['md'])
+    epochlist = ifgs_dict['epochlist']
+    ifgs = [v for v in ifgs_dict.values() if isinstance(v, PrereadIfg)]
+    dates = epochlist.dates[1:]
+    md[ifc.DATA_TYPE] = ifc.CUML if out_type == 'tscuml' else ifc.INCR
+    md.pop('SEQUENCE_POSITION', None)
+    # sequence position; first time slice is #0
+    band_md = [{ifc.EPOCH_DATE: d, 'SEQUENCE_POSITION': i + 1}
+               for i, d in enumerate(dates)]
+    dest = os.path.join(params[cf.OUT_DIR], out_type + ".tif")
+    writer = shared.GeotiffWriter(md, gt, wkt, ifgs[0].shape, dest, np.nan,
+                                  params, band_md=band_md)
+    for t in tiles:
+        ts_file = os.path.join(params[cf.TMPDIR],
+                               out_type + '_{}.npy'.format(t.index))
+        writer.write_tile(np.load(file=ts_file), t)
+    writer.close()
+    log.info('Finished PyRate postprocessing {}'.format(out_type))
@@ -82,7 +82,8 @@ def _join_dicts(dicts):
 
 def create_ifg_dict(dest_tifs, params, tiles):
     """
-    1. Convert interferogram phase data into numpy binary files.
+    1. Convert interferogram phase data into one numpy tile cube per tile,
+    after nan and mm conversion.
     2. Save the preread_ifgs dictionary with information about the interferograms that are
     later used for fast loading of Ifg files in IfgPart class.
 
@@ -94,7 +95,7 @@ def create_ifg_dict(dest_tifs, params, tiles):
     """
     ifgs_dict = {}
     process_tifs = mpiops.array_split(dest_tifs)
-    save_numpy_phase(dest_tifs, tiles, params)
+    save_numpy_phase(dest_tifs, tiles, params, convert=True)
     for d in process_tifs:
         ifg = prepare_ifg(d, params)
         ifgs_dict[d] = PrereadIfg(path=d,
@@ -118,6 +119,8 @@ def create_ifg_dict(dest_tifs, params, tiles):
         ifgs_dict['gt'] = gt
         ifgs_dict['md'] = md
         ifgs_dict['wkt'] = wkt
+        ifgs_dict[shared.CUBE_INDEX] = shared.tile_cube_index(
+            params[cf.TMPDIR])
         # dump ifgs_dict file for later use
         cp.dump(ifgs_dict, open(preread_ifgs_file, 'wb'))
 
@@ -144,19 +147,24 @@ def mst_calc(dest_tifs, params, tiles, preread_ifgs):
 
     def save_mst_tile(tile, i, preread_ifgs):
         """ Convenient inner loop for mst tile saving"""
-        if params[cf.NETWORKX_OR_MATLAB_FLAG] == 1:
+        if params[cf.NETWORKX_OR_MATLAB_FLAG] == 2:
             log.info('Calculating minimum spanning tree matrix '
-                     'using NetworkX method')
+                     'using array based Kruskal method')
             mst_tile = mst.mst_multiprocessing(tile, dest_tifs, preread_ifgs)
+        elif params[cf.NETWORKX_OR_MATLAB_FLAG] == 1:
+            log.info('Calculating minimum spanning tree matrix '
+                     'using NetworkX method')
+            mst_tile = mst.mst_multiprocessing(tile, dest_tifs, preread_ifgs,
+                                               networkx=True)
         elif params[cf.NETWORKX_OR_MATLAB_FLAG] == 0:
             raise ConfigException('Matlab mst not supported')
         else:
-            raise ConfigException('Only NetworkX mst is supported')
-            # mst_tile = mst.mst_multiprocessing(tile, dest_tifs, preread_ifgs)
-        # locally save the mst_mat
+            raise ConfigException('Only NetworkX and array based Kruskal '
+                                  'mst are supported')
+        # locally save the mst_mat, bit-packed along the ifg axis
         mst_file_process_n = join(
-            params[cf.TMPDIR], 'mst_mat_{}.npy'.format(i))
-        np.save(file=mst_file_process_n, arr=mst_tile)
+            params[cf.TMPDIR], 'mst_mat_{}.npz'.format(i))
+        mst.PackedMst.pack(mst_tile).save(mst_file_process_n)
 
     for t in process_tiles:
         save_mst_tile(t, t.index, preread_ifgs)
@@ -164,12 +172,13 @@ def mst_calc(dest_tifs, params, tiles, preread_ifgs):
     mpiops.comm.barrier()
 
 
-def ref_pixel_calc(ifg_paths, params):
+def ref_pixel_calc(ifg_paths, params, stack=None):
     """
     Reference pixel calculation setup.
 
     :param ifg_paths: List of interferogram paths
     :param params: Parameters dictionary corresponding to config file
+    :param stack: Optional IfgStack the phase data is read from
 
     :return refx: Reference pixel x-coordinate
     :return refy: Reference pixel y-coordinate
@@ -192,7 +201,7 @@ def ref_pixel_calc(ifg_paths, params):
 
     if refx <= 0 or refy <= 0:  # if either zero or negative
         log.info('Searching for best reference pixel location')
-        refy, refx = find_ref_pixel(ifg_paths, params)
+        refy, refx = find_ref_pixel(ifg_paths, params, stack)
         log.info('Selected reference pixel coordinate: '
                  '({}, {})'.format(refx, refy))
     else:  # pragma: no cover
@@ -202,82 +211,68 @@ def ref_pixel_calc(ifg_paths, params):
     return refx, refy
 
 
-def find_ref_pixel(ifg_paths, params):
+def find_ref_pixel(ifg_paths, params, stack=None):
     """
     Find reference pixel using MPI Parameters.
 
     :param ifg_paths: List of interferogram paths
     :param params: Parameters dictionary corresponding to config file
+    :param stack: Optional IfgStack the phase data is read from
 
     :return Tuple of (refy, refx).
     """
     half_patch_size, thresh, grid = refpixel.ref_pixel_setup(ifg_paths, params)
-    process_grid = mpiops.array_split(grid)
-    save_ref_pixel_blocks(process_grid, half_patch_size, ifg_paths, params)
-    mean_sds = refpixel.ref_pixel_mpi(process_grid, half_patch_size,
-                                      ifg_paths, thresh, params)
-    mean_sds = mpiops.comm.gather(mean_sds, root=0)
-    if mpiops.rank == MASTER_PROCESS:
-        mean_sds = np.hstack(mean_sds)
-    return mpiops.run_once(refpixel.filter_means, mean_sds, grid)
+    # every process streams its own ifgs once, the per node sums are reduced
+    process_ifgs = mpiops.array_split(ifg_paths)
+    if stack is not None:
+        process_ifgs = (stack.read(p) for p in process_ifgs)
+    sd_sum, ninvalid = refpixel.ref_pixel_sds(grid, half_patch_size,
+                                              process_ifgs, thresh, params)
+    mpiops.allreduce_sum(sd_sum)
+    mpiops.allreduce_sum(ninvalid)
+    mean_sds = refpixel.chip_mean_sds(sd_sum, ninvalid, len(ifg_paths))
+    if params.get(cf.REF_STRIDE, 0) > 0 and mpiops.rank == MASTER_PROCESS:
+        _write_ref_pixel_surface(mean_sds, grid, ifg_paths[0], params)
+    return refpixel.filter_means(mean_sds, grid)
 
 
-def save_ref_pixel_blocks(grid, half_patch_size, ifg_paths, params):
+def _write_ref_pixel_surface(mean_sds, grid, ifg_path, params):
     """
-    xxxx
-    
-    :param grid: List of tuples (y, x) corresponding reference pixel grids
-    :param half_patch_size: Patch size in pixels corresponding to reference pixel grids
-    :param ifg_paths: List of interferogram paths
-    :param params: Parameters dictionary corresponding to config file
-    
-    :return xxxx
+    Writes the mean chip standard deviations of a dense reference pixel
+    search to refpixel_mean_sd.tif in the output directory.
     """
-    log.info('Saving ref pixel blocks')
-    outdir = params[cf.TMPDIR]
-    for pth in ifg_paths:
-        ifg = Ifg(pth)
-        ifg.open(readonly=True)
-        ifg.nodata_value = params[cf.NO_DATA_VALUE]
-        ifg.convert_to_nans()
-        ifg.convert_to_mm()
-        for y, x in grid:
-            data = ifg.phase_data[y - half_patch_size:y + half_patch_size + 1,
-                                  x - half_patch_size:x + half_patch_size + 1]
-
-            data_file = join(outdir, 'ref_phase_data_{b}_{y}_{x}.npy'.format(
-                b=os.path.basename(pth).split('.')[0], y=y, x=x))
-            np.save(file=data_file, arr=data)
-        ifg.close()
-    log.info('Saved ref pixel blocks')
+    ifg = Ifg(ifg_path)
+    ifg.open(readonly=True)
+    shape = ifg.shape
+    ifg.close()
+    gt, md, wkt = get_projection_info(ifg_path)
+    md[ifc.DATA_TYPE] = ifc.REF_PIXEL_SCORE
+    surface = refpixel.ref_pixel_surface(mean_sds, grid, shape)
+    dest = join(params[cf.OUT_DIR], 'refpixel_mean_sd.tif')
+    shared.write_output_geotiff(md, gt, wkt, surface, dest, np.nan, params)
+    log.info('Wrote reference pixel scores to {}'.format(dest))
 
 
-def orb_fit_calc(ifg_paths, params, preread_ifgs=None):
+def orb_fit_calc(ifg_paths, params, preread_ifgs=None, stack=None):
     """
     Orbital fit correction.
 
     :param ifg_paths: List of ifg paths
     :param params: Parameters dictionary corresponding to config file
+    :param stack: Optional IfgStack the corrections are written through to
     
     :return xxxx
     """
     log.info('Calculating orbfit correction')
-    if params[cf.ORBITAL_FIT_METHOD] == 1:
-        prcs_ifgs = mpiops.array_split(ifg_paths)
-        orbital.remove_orbital_error(prcs_ifgs, params, preread_ifgs)
-    else:
-        # Here we do all the multilooking in one process, but in memory
-        # can use multiple processes if we write data to disc during
-        # remove_orbital_error step
-        # A performance comparison should be performed be performed for saving
-        # multilooked files on disc vs in memory single process multilooking
-        if mpiops.rank == MASTER_PROCESS:
-            orbital.remove_orbital_error(ifg_paths, params, preread_ifgs)
+    # the network method multilooks the ifgs of each process and reduces
+    # the normal equations of the network inversion across processes
+    prcs_ifgs = mpiops.array_split(ifg_paths)
+    orbital.remove_orbital_error(prcs_ifgs, params, preread_ifgs, stack)
     mpiops.comm.barrier()
     log.info('Finished orbfit calculation in process {}'.format(mpiops.rank))
 
 
-def ref_phase_estimation(ifg_paths, params, refpx, refpy):
+def ref_phase_estimation(ifg_paths, params, refpx, refpy, stack=None):
     """
     Reference phase estimation.
 
@@ -285,6 +280,7 @@ def ref_phase_estimation(ifg_paths, params, refpx, refpy):
     :param params: Parameters dictionary corresponding to config file
     :param refpx: Reference pixel x-coordinate
     :param refpy: Reference pixel y-coordinate
+    :param stack: Optional IfgStack updated with the corrected phase data
 
     :return xxxx
     """
@@ -292,32 +288,22 @@ def ref_phase_estimation(ifg_paths, params, refpx, refpy):
     log.info('Estimating and removing reference phase')
     if params[cf.REF_EST_METHOD] == 1:
         # calculate phase sum for later use in ref phase method 1
-        comp = phase_sum(ifg_paths, params)
-        process_ref_phs = ref_phs_method1(ifg_paths, comp)
+        comp = phase_sum(ifg_paths, params, stack)
+        process_ref_phs = ref_phs_method1(ifg_paths, comp, stack)
     elif params[cf.REF_EST_METHOD] == 2:
-        process_ref_phs = ref_phs_method2(ifg_paths, params, refpx, refpy)
+        process_ref_phs = ref_phs_method2(ifg_paths, params, refpx, refpy,
+                                          stack)
     else:
         raise ConfigException('Ref phase estimation method must be 1 or 2')
 
-    ref_phs_file = join(params[cf.TMPDIR], 'ref_phs.npy')
+    # the ref phases of each process are for a contiguous block of ifgs
+    ref_phs = mpiops.gatherv(np.asarray(process_ref_phs, dtype=np.float64))
     if mpiops.rank == MASTER_PROCESS:
-        ref_phs = np.zeros(len(ifg_paths), dtype=np.float64)
-        process_indices = mpiops.array_split(range(len(ifg_paths)))
-        ref_phs[process_indices] = process_ref_phs
-        for r in range(1, mpiops.size):  # pragma: no cover
-            process_indices = mpiops.array_split(range(len(ifg_paths)), r)
-            this_process_ref_phs = np.zeros(shape=len(process_indices),
-                                            dtype=np.float64)
-            mpiops.comm.Recv(this_process_ref_phs, source=r, tag=r)
-            ref_phs[process_indices] = this_process_ref_phs
-        np.save(file=ref_phs_file, arr=ref_phs)
-    else:  # pragma: no cover
-        # send reference phase data to master process
-        mpiops.comm.Send(process_ref_phs, dest=MASTER_PROCESS,
-                         tag=mpiops.rank)
+        np.save(file=join(params[cf.TMPDIR], 'ref_phs.npy'), arr=ref_phs)
+    mpiops.comm.barrier()
 
 
-def ref_phs_method2(ifg_paths, params, refpx, refpy):
+def ref_phs_method2(ifg_paths, params, refpx, refpy, stack=None):
     """
     Reference phase computation using method 2.
 
@@ -325,6 +311,7 @@ def ref_phs_method2(ifg_paths, params, refpx, refpy):
     :param params: Parameters dictionary corresponding to config file
     :param refpx: Reference pixel x-coordinate
     :param refpy: Reference pixel y-coordinate
+    :param stack: Optional IfgStack updated with the corrected phase data
 
     :return ref_phs: Array of reference phase of shape ifg.shape
     """
@@ -333,53 +320,91 @@ def ref_phs_method2(ifg_paths, params, refpx, refpy):
     thresh = chipsize * chipsize * params[cf.REF_MIN_FRAC]
     process_ifg_paths = mpiops.array_split(ifg_paths)
 
-    def _inner(ifg_path):
-        ifg = Ifg(ifg_path)
-        ifg.open(readonly=False)
-        phase_data = ifg.phase_data
-        ref_ph = rpe.est_ref_phs_method2(phase_data,
-                                         half_chip_size,
-                                         refpx, refpy, thresh)
-        phase_data -= ref_ph
-        md = ifg.meta_data
-        md[ifc.REF_PHASE] = ifc.REF_PHASE_REMOVED
-        ifg.write_modified_phase(data=phase_data)
-        ifg.close()
-        return ref_ph
+    def _estimate(phase_data):
+        return rpe.est_ref_phs_method2(phase_data, half_chip_size,
+                                       refpx, refpy, thresh)
 
-    ref_phs = np.array([_inner(p) for p in process_ifg_paths])
+    ref_phs = np.array([_remove_ref_phase(p, _estimate, stack)
+                        for p in process_ifg_paths])
     log.info('Ref phase computed in process {}'.format(mpiops.rank))
     return ref_phs
 
 
-def ref_phs_method1(ifg_paths, comp):
+def ref_phs_method1(ifg_paths, comp, stack=None):
     """
     Reference phase computation using method 1.
 
     :param ifg_paths: List of interferogram paths
     :param comp: Array of phase sum of all interferograms of shape ifg.shape
+    :param stack: Optional IfgStack updated with the corrected phase data
 
     :return ref_phs: Array of reference phase of shape ifg.shape
     """
 
-    def _inner(ifg_path):
-        """ convenient inner loop """
-        ifg = Ifg(ifg_path)
-        ifg.open(readonly=False)
-        phase_data = ifg.phase_data
-        ref_phase = rpe.est_ref_phs_method1(phase_data, comp)
-        phase_data -= ref_phase
-        md = ifg.meta_data
-        md[ifc.REF_PHASE] = ifc.REF_PHASE_REMOVED
-        ifg.write_modified_phase(data=phase_data)
-        ifg.close()
-        return ref_phase
+    def _estimate(phase_data):
+        return rpe.est_ref_phs_method1(phase_data, comp)
+
     this_process_ifgs = mpiops.array_split(ifg_paths)
-    ref_phs = np.array([_inner(ifg) for ifg in this_process_ifgs])
+    ref_phs = np.array([_remove_ref_phase(p, _estimate, stack)
+                        for p in this_process_ifgs])
     log.info('Ref phase computed in process {}'.format(mpiops.rank))
     return ref_phs
 
 
+def _remove_ref_phase(ifg_path, estimate, stack=None):
+    """
+    Estimates and removes the reference phase of an interferogram in a
+    single read-modify-write pass over its phase data.
+
+    :param ifg_path: Interferogram path
+    :param estimate: Function of the phase data returning the ref phase
+    :param stack: Optional IfgStack holding the phase data. The corrected
+        phase is written back to the stack, the interferogram file is left
+        to export_ifgs
+
+    :return Reference phase of the interferogram
+    """
+    if stack is not None:
+        phase_data = stack.read(ifg_path)
+        ref_ph = estimate(phase_data)
+        phase_data -= ref_ph
+        stack.write(ifg_path, phase_data)
+        return ref_ph
+    ifg = Ifg(ifg_path)
+    ifg.open(readonly=False)
+    phase_data = ifg.phase_data
+    ref_ph = estimate(phase_data)
+    phase_data -= ref_ph
+    ifg.meta_data[ifc.REF_PHASE] = ifc.REF_PHASE_REMOVED
+    ifg.write_modified_phase(data=phase_data)
+    ifg.close()
+    return ref_ph
+
+
+def export_ifgs(ifg_paths, params, stack):
+    """
+    Writes the corrected phase data of the stack to the interferogram
+    files, tagged with the corrections applied to it.
+
+    :param ifg_paths: List of interferogram paths
+    :param params: Parameters dictionary corresponding to config file
+    :param stack: IfgStack holding the corrected phase data
+    """
+    for ifg_path in mpiops.array_split(ifg_paths):
+        ifg = Ifg(ifg_path)
+        ifg.open(readonly=False)
+        # the stack is saved nan converted and in millimetres
+        ifg.meta_data[ifc.NAN_STATUS] = ifc.NAN_CONVERTED
+        ifg.meta_data[ifc.DATA_UNITS] = shared.MILLIMETRES
+        if params[cf.ORBITAL_FIT]:
+            ifg.meta_data[ifc.PYRATE_ORBITAL_ERROR] = ifc.ORB_REMOVED
+        ifg.meta_data[ifc.REF_PHASE] = ifc.REF_PHASE_REMOVED
+        ifg.write_modified_phase(data=stack.read(ifg_path))
+        ifg.close()
+    mpiops.comm.barrier()
+    log.info('Exported corrected ifgs in process {}'.format(mpiops.rank))
+
+
 def process_ifgs(ifg_paths, params, rows, cols):
     """
     Top level function to perform PyRate correction steps on given interferograms.
@@ -399,10 +424,15 @@ def process_ifgs(ifg_paths, params, rows, cols):
                                    params=params,
                                    tiles=tiles)
 
+    # chunked phase stack over the nan and mm converted tile cubes saved by
+    # create_ifg_dict. The corrections are applied to the stack and the
+    # GeoTIFFs are written once, after the reference phase removal
+    stack = shared.IfgStack(params[cf.TMPDIR], tiles)
+
     mst_calc(ifg_paths, params, tiles, preread_ifgs)
 
     # Estimate reference pixel location
-    refpx, refpy = ref_pixel_calc(ifg_paths, params)
+    refpx, refpy = ref_pixel_calc(ifg_paths, params, stack)
 
     # remove APS delay here, and write aps delay removed ifgs to disc
     # TODO: fix PyAPS integration
@@ -415,25 +445,27 @@ def process_ifgs(ifg_paths, params, rows, cols):
             check_aps_ifgs(ifg_paths)
 
     # Estimate and remove orbit errors
-    orb_fit_calc(ifg_paths, params, preread_ifgs)
+    orb_fit_calc(ifg_paths, params, preread_ifgs, stack)
 
     # calc and remove reference phase
-    ref_phase_estimation(ifg_paths, params, refpx, refpy)
+    ref_phase_estimation(ifg_paths, params, refpx, refpy, stack)
+
+    # write the corrected phase to the GeoTIFFs
+    export_ifgs(ifg_paths, params, stack)
 
-    maxvar, vcmt = maxvar_vcm_calc(ifg_paths, params, preread_ifgs)
-    save_numpy_phase(ifg_paths, tiles, params)
+    maxvar, vcmt = maxvar_vcm_calc(ifg_paths, params, preread_ifgs, stack)
 
     if params[cf.TIME_SERIES_CAL]:
-        timeseries_calc(ifg_paths, params, vcmt, tiles, preread_ifgs)
+        timeseries_calc(ifg_paths, params, vcmt, tiles, preread_ifgs, stack)
 
     # Calculate linear rate map
-    linrate_calc(ifg_paths, params, vcmt, tiles, preread_ifgs)
+    linrate_calc(ifg_paths, params, vcmt, tiles, preread_ifgs, stack)
 
     log.info('PyRate workflow completed')
     return (refpx, refpy), maxvar, vcmt
 
 
-def linrate_calc(ifg_paths, params, vcmt, tiles, preread_ifgs):
+def linrate_calc(ifg_paths, params, vcmt, tiles, preread_ifgs, stack=None):
     """
     MPI capable linrate calculation.
 
@@ -442,6 +474,7 @@ def linrate_calc(ifg_paths, params, vcmt, tiles, preread_ifgs):
     :param vcmt: vcmt array
     :param tiles: List of all tiles used during MPI processes
     :param preread_ifgs: Dictionary containing interferogram characteristics for efficient computing
+    :param stack: Optional IfgStack of the tile cubes
     
     :return xxxx
     """
@@ -449,13 +482,18 @@ def linrate_calc(ifg_paths, params, vcmt, tiles, preread_ifgs):
     process_tiles = mpiops.array_split(tiles)
     log.info('Calculating linear rate')
     output_dir = params[cf.TMPDIR]
+    if stack is None:
+        stack = shared.IfgStack(output_dir, tiles)
+    # factorisations are shared by all tiles of this process
+    cache = vcm_module.vcm_cache(vcmt, params)
     for t in process_tiles:
         log.info('calculating lin rate of tile {}'.format(t.index))
-        ifg_parts = [shared.IfgPart(p, t, preread_ifgs) for p in ifg_paths]
-        mst_grid_n = np.load(os.path.join(output_dir,
-                                          'mst_mat_{}.npy'.format(t.index)))
+        ifg_parts = stack.parts(t, ifg_paths, preread_ifgs)
+        mst_grid_n = mst.PackedMst.load(
+            os.path.join(output_dir, 'mst_mat_{}.npz'.format(t.index)))
         rate, error, samples = linrate.linear_rate(ifg_parts, params,
-                                                   vcmt, mst_grid_n)
+                                                   vcmt, mst_grid_n, cache)
+        _log_vcm_cache(cache)
         # declare file names
         np.save(file=os.path.join(output_dir,
                                   'linrate_{}.npy'.format(t.index)),
@@ -469,13 +507,27 @@ def linrate_calc(ifg_paths, params, vcmt, tiles, preread_ifgs):
     mpiops.comm.barrier()
 
 
-def maxvar_vcm_calc(ifg_paths, params, preread_ifgs):
+def _log_vcm_cache(cache):
+    """
+    Log the counters of a VCM factorisation cache.
+
+    :param cache: VcmCache instance
+    """
+    log.info('VCM cache: {} entries ({:.1f} MB), {} hits, {} misses, '
+             '{} evictions'.format(len(cache), cache.nbytes / 2.0**20,
+                                   cache.hits, cache.misses,
+                                   cache.evictions))
+
+
+def maxvar_vcm_calc(ifg_paths, params, preread_ifgs, stack=None):
     """
     MPI capable maxvar and vcmt computation.
 
     :param ifg_paths: List of interferogram paths
     :param params: Parameters dictionary corresponding to config file
     :param preread_ifgs: Dictionary containing interferogram characteristics for efficient computing
+    :param stack: Optional IfgStack the full resolution phase data is read
+        from. The multi-looked copies are made from the interferogram files
 
     :return maxvar: Array of shape (nifgs, 1)
     :return vcmt: Array of shape (nifgs, nifgs)
@@ -483,12 +535,26 @@ def maxvar_vcm_calc(ifg_paths, params, preread_ifgs):
     log.info('Calculating maxvar and vcm')
     process_indices = mpiops.array_split(range(len(ifg_paths)))
     prcs_ifgs = mpiops.array_split(ifg_paths)
-    process_maxvar = []
-    for n, i in enumerate(prcs_ifgs):
-        log.info('Calculating maxvar for {} of process ifgs {} of '
-                 'total {}'.format(n+1, len(prcs_ifgs), len(ifg_paths)))
-        # TODO: cvd calculation is still pretty slow - revisit
-        process_maxvar.append(vcm_module.cvd(i, params)[0])
+    xlooks = params.get(cf.MAXVAR_LOOKS_X, cf.NO_MULTILOOKING)
+    ylooks = params.get(cf.MAXVAR_LOOKS_Y, cf.NO_MULTILOOKING)
+    if xlooks > 1 or ylooks > 1:
+        log.info('Calculating maxvar of {} process ifgs on {}x{} '
+                 'multi-looked copies'.format(len(prcs_ifgs), xlooks, ylooks))
+        process_maxvar = vcm_module.multilooked_cvd(prcs_ifgs, params,
+                                                    xlooks, ylooks)[0]
+    else:
+        # lag distances are shared by all ifgs, which have the same geometry
+        ifg = Ifg(ifg_paths[0])
+        ifg.open(readonly=True)
+        context = vcm_module.CvdContext.from_ifg(ifg)
+        ifg.close()
+        process_maxvar = []
+        for n, i in enumerate(prcs_ifgs):
+            log.info('Calculating maxvar for {} of process ifgs {} of '
+                     'total {}'.format(n+1, len(prcs_ifgs), len(ifg_paths)))
+            phase = i if stack is None else stack.read(i)
+            process_maxvar.append(vcm_module.cvd(phase, params,
+                                                 context=context)[0])
     if mpiops.rank == MASTER_PROCESS:
         maxvar = np.empty(len(ifg_paths), dtype=np.float64)
         maxvar[process_indices] = process_maxvar
@@ -508,47 +574,41 @@ def maxvar_vcm_calc(ifg_paths, params, preread_ifgs):
     return maxvar, vcmt
 
 
-def phase_sum(ifg_paths, params):
+def phase_sum(ifg_paths, params, stack=None):
     """
-    Save phase data and phs_sum used in the reference phase estimation.
+    NaN mask of the interferogram stack used in the reference phase
+    estimation method 1: cells that are NaN in any interferogram.
 
     :param ifg_paths: List of paths to interferograms
     :param params: Config dictionary
+    :param stack: Optional IfgStack the phase data is read from. The
+        orbital correction does not change the NaNs of its phase data
     
-    :return xxxx
+    :return Boolean array of the flattened (Fortran order) ifg shape
     """
     p_paths = mpiops.array_split(ifg_paths)
-    ifg = Ifg(p_paths[0])
+    ifg = Ifg(ifg_paths[0])
     ifg.open(readonly=True)
-    shape = ifg.shape
-    phs_sum = np.zeros(shape=shape, dtype=np.float64)
+    nan_count = np.zeros(shape=ifg.shape, dtype=np.int32)
     ifg.close()
 
     for d in p_paths:
-        ifg = Ifg(d)
-        ifg.open()
-        ifg.nodata_value = params[cf.NO_DATA_VALUE]
-        phs_sum += ifg.phase_data
-        ifg.close()
-
-    if mpiops.rank == MASTER_PROCESS:
-        phase_sum_all = phs_sum
-        # loop is better for memory
-        for i in range(1, mpiops.size):  # pragma: no cover
-            phs_sum = np.zeros(shape=shape, dtype=np.float64)
-            mpiops.comm.Recv(phs_sum, source=i, tag=i)
-            phase_sum_all += phs_sum
-        comp = np.isnan(phase_sum_all)  # this is the same as in Matlab
-        comp = np.ravel(comp, order='F')  # this is the same as in Matlab
-    else:  # pragma: no cover
-        comp = None
-        mpiops.comm.Send(phs_sum, dest=0, tag=mpiops.rank)
+        if stack is not None:
+            nan_count += np.isnan(stack.read(d))
+        else:
+            ifg = Ifg(d)
+            ifg.open(readonly=True)
+            ifg.nodata_value = params[cf.NO_DATA_VALUE]
+            nan_count += np.isnan(ifg.phase_data)
+            ifg.close()
 
-    comp = mpiops.comm.bcast(comp, root=0)
-    return comp
+    mpiops.allreduce_sum(nan_count)
+    # same as the NaNs of the phase sum in Matlab
+    return np.ravel(nan_count > 0, order='F')
 
 
-def timeseries_calc(ifg_paths, params, vcmt, tiles, preread_ifgs):
+def timeseries_calc(ifg_paths, params, vcmt, tiles, preread_ifgs,
+                    stack=None):
     """
     Time series calculation.
 
@@ -557,18 +617,25 @@ def timeseries_calc(ifg_paths, params, vcmt, tiles, preread_ifgs):
     :param vcmt: vcmt array
     :param tiles: List of all tiles used during MPI processes
     :param preread_ifgs: Dictionary containing interferogram characteristics for efficient computing
+    :param stack: Optional IfgStack of the tile cubes
 
     :return xxxx
     """
     process_tiles = mpiops.array_split(tiles)
     log.info('Calculating time series')
     output_dir = params[cf.TMPDIR]
+    if stack is None:
+        stack = shared.IfgStack(output_dir, tiles)
+    # factorisations are shared by all tiles of this process
+    cache = vcm_module.vcm_cache(vcmt, params)
     for t in process_tiles:
         log.info('Calculating time series for tile {}'.format(t.index))
-        ifg_parts = [shared.IfgPart(p, t, preread_ifgs) for p in ifg_paths]
-        mst_tile = np.load(os.path.join(output_dir,
-                                        'mst_mat_{}.npy'.format(t.index)))
-        res = timeseries.time_series(ifg_parts, params, vcmt, mst_tile)
+        ifg_parts = stack.parts(t, ifg_paths, preread_ifgs)
+        mst_tile = mst.PackedMst.load(
+            os.path.join(output_dir, 'mst_mat_{}.npz'.format(t.index)))
+        res = timeseries.time_series(ifg_parts, params, vcmt, mst_tile,
+                                     cache)
+        _log_vcm_cache(cache)
         tsincr, tscum, _ = res
         np.save(file=os.path.join(output_dir, 'tsincr_{}.npy'.format(t.index)),
                 arr=tsincr)
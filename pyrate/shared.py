@@ -27,7 +27,6 @@ import os
 from os.path import basename, dirname, join
 import shutil
 import stat
-import struct
 from datetime import date
 from itertools import product
 import numpy as np
@@ -62,6 +61,15 @@ GDAL_Y_CELLSIZE = 5
 GDAL_X_FIRST = 0
 GDAL_Y_FIRST = 3
 
+# tile cube of the phase data of all interferograms
+TILE_CUBE = 'phase_cube_{}.npy'
+TILE_CUBE_INDEX = 'phase_cube_index.npy'
+#: key of the tile cube layer of each interferogram in the preread_ifgs dict
+CUBE_INDEX = 'cube_index'
+
+# approximate size of the row blocks written to GeoTIFFs
+WRITE_BLOCK_BYTES = 2**22
+
 
 def mkdir_p(path):
     """
@@ -497,7 +505,7 @@ class IfgPart(object):
     """
     # pylint: disable=missing-docstring
     # pylint: disable=too-many-instance-attributes
-    def __init__(self, ifg_or_path, tile, ifg_dict=None):
+    def __init__(self, ifg_or_path, tile, ifg_dict=None, cube=None):
 
         self.tile = tile
         self.r_start = self.tile.top_left_y
@@ -511,10 +519,13 @@ class IfgPart(object):
             self.master = ifg.master
             self.slave = ifg.slave
             self.time_span = ifg.time_span
-            phase_file = 'phase_data_{}_{}.npy'.format(
-                basename(ifg_or_path).split('.')[0], tile.index)
-            self.phase_data = np.load(join(dirname(ifg_or_path), cf.TMPDIR,
-                                           phase_file))
+            # zero-copy view of this ifg's layer in the tile cube
+            if cube is None:
+                cube = np.load(join(dirname(ifg_or_path), cf.TMPDIR,
+                                    TILE_CUBE.format(tile.index)),
+                               mmap_mode='r')
+            layer = ifg_dict[CUBE_INDEX][basename(ifg_or_path).split('.')[0]]
+            self.phase_data = cube[layer]
         else:
             # check if Ifg was sent.
             if isinstance(ifg_or_path, Ifg):
@@ -763,38 +774,52 @@ def write_geotiff(header, data_path, dest, nodata):
     band = ds.GetRasterBand(1)
     band.SetNoDataValue(nodata)
 
+    data = _raw_data(data_path, ifg_proc, is_ifg, ncols, nrows)
+
+    # write whole GTiff blocks of rows, of about WRITE_BLOCK_BYTES each
+    block_rows = band.GetBlockSize()[1]
+    rows = max(WRITE_BLOCK_BYTES // (ncols * data.itemsize) // block_rows,
+               1) * block_rows
+    for y in range(0, nrows, rows):
+        band.WriteArray(data[y:y + rows].astype(data.dtype.newbyteorder('=')),
+                        yoff=y)
+
+    # Needed? Only in ROIPAC code
+    ds = None  # manual close
+    del ds
+
+
+def _raw_data(data_path, ifg_proc, is_ifg, ncols, nrows):
+    """
+    Returns a read only memory mapped (nrows, ncols) view of the data of a
+    GAMMA or ROI_PAC binary file.
+
+    :param data_path: Path to the binary file
+    :param ifg_proc: Processor type, GAMMA or ROIPAC
+    :param is_ifg: Whether interferogram or dem
+    :param ncols: Number of columns
+    :param nrows: Number of rows
+
+    :return Array view of the file data
+    """
     if ifg_proc == GAMMA:
-        fmtstr = '!' + ('f' * ncols)  # data format is big endian float32s
-        bytes_per_col = 4
+        # data format is big endian float32s
+        return np.memmap(data_path, dtype='>f4', mode='r',
+                         shape=(nrows, ncols))
     elif ifg_proc == ROIPAC:
         if is_ifg:
-            fmtstr = '<' + ('f' * ncols)  # roipac ifgs are little endian float32s
-            bytes_per_col = 4
-        else:
-            fmtstr = '<' + ('h' * ncols)  # roipac DEM is little endian signed int16
-            bytes_per_col = 2
+            # roipac ifgs are little endian float32s, with the rows of the
+            # amplitude band interleaved before the rows of the phase band
+            raw = np.memmap(data_path, dtype='<f4', mode='r',
+                            shape=(nrows, 2 * ncols))
+            return raw[:, ncols:]
+        # roipac DEM is little endian signed int16
+        return np.memmap(data_path, dtype='<i2', mode='r',
+                         shape=(nrows, ncols))
     else:  # pragma: no cover
         msg = 'Unrecognised InSAR Processor: %s' % ifg_proc
         raise GeotiffException(msg)
 
-    row_bytes = ncols * bytes_per_col
-
-    with open(data_path, 'rb') as f:
-        for y in range(nrows):
-            if ifg_proc == ROIPAC:
-                if is_ifg:
-                    f.seek(row_bytes, 1)  # skip interleaved band 1
-
-            data = struct.unpack(fmtstr, f.read(row_bytes))
-            #else: # GAMMA
-            #    data = struct.unpack(fmtstr, f.read(ncols * 4))
-
-            band.WriteArray(np.array(data).reshape(1, ncols), yoff=y)
-
-    # Needed? Only in ROIPAC code
-    ds = None  # manual close
-    del ds
-
 
 def write_unw_from_data_or_geotiff(geotif_or_data, dest_unw, ifg_proc):
     """
@@ -811,21 +836,29 @@ def write_unw_from_data_or_geotiff(geotif_or_data, dest_unw, ifg_proc):
     if isinstance(geotif_or_data, str):
         assert os.path.exists(geotif_or_data), 'make sure geotif exists'
         ds = gdal.Open(geotif_or_data)
-        data = ds.ReadAsArray()
-        ds = None
+        band = ds.GetRasterBand(1)
+        nrows, ncols = ds.RasterYSize, ds.RasterXSize
+
+        def _read(y, rows):
+            return band.ReadAsArray(0, y, ncols, min(rows, nrows - y))
     else:
-        data = geotif_or_data
+        ds = None
+        nrows, ncols = geotif_or_data.shape
 
-    nrows, ncols = data.shape
-    fmtstr = '!' + ('f' * ncols)  # data format is big endian float32s
+        def _read(y, rows):
+            return geotif_or_data[y:y + rows]
 
+    # convert and write blocks of rows of about WRITE_BLOCK_BYTES, so only
+    # one block is in memory at a time
+    rows = max(WRITE_BLOCK_BYTES // (ncols * 4), 1)
     with open(dest_unw, 'wb') as f:
-        for y in range(nrows):
-            col_data = struct.pack(fmtstr, *data[y, :])
-            f.write(col_data)
+        for y in range(0, nrows, rows):
+            # data format is big endian float32s
+            _read(y, rows).astype('>f4').tofile(f)
+    ds = None
 
 
-def write_output_geotiff(md, gt, wkt, data, dest, nodata):
+def write_output_geotiff(md, gt, wkt, data, dest, nodata, params=None):
     # pylint: disable=too-many-arguments
     """
     Writes PyRate output data to a GeoTIFF file.
@@ -836,28 +869,147 @@ def write_output_geotiff(md, gt, wkt, data, dest, nodata):
     :param data: xxxx
     :param dest: xxxx
     :param nodata: xxxx
+    :param params: Optional config dictionary with the output profile, see
+        geotiff_creation_options
     
     :return xxxx
     """
+    writer = GeotiffWriter(md, gt, wkt, data.shape, dest, nodata, params)
+    writer.write(data)
+    writer.close()
 
-    driver = gdal.GetDriverByName("GTiff")
-    nrows, ncols = data.shape
-    ds = driver.Create(dest, ncols, nrows, 1, gdal.GDT_Float32)
-    # set spatial reference for geotiff
-    ds.SetGeoTransform(gt)
-    ds.SetProjection(wkt)
-    ds.SetMetadataItem(ifc.EPOCH_DATE, str(md[ifc.EPOCH_DATE]))
-
-    # set other metadata
-    ds.SetMetadataItem('DATA_TYPE', str(md['DATA_TYPE']))
-    # sequence position for time series products
-    if 'SEQUENCE_POSITION' in md:
-        ds.SetMetadataItem('SEQUENCE_POSITION', str(md['SEQUENCE_POSITION']))
-
-    # write data to geotiff
-    band = ds.GetRasterBand(1)
-    band.SetNoDataValue(nodata)
-    band.WriteArray(data, 0, 0)
+
+def geotiff_creation_options(params, tiled_only=False):
+    """
+    Returns the GTiff creation options of the output profile in the config:
+    tiling, compression with a floating point predictor, and BIGTIFF when
+    needed.
+
+    :param params: Config dictionary, or None for the GDAL defaults
+    :param tiled_only: Whether to leave out the compression options
+
+    :return List of creation options
+    """
+    if params is None:
+        return []
+    options = ['BIGTIFF=IF_SAFER']
+    if params.get(cf.OUTPUT_TILED) or params.get(cf.OUTPUT_COG):
+        size = params.get(cf.OUTPUT_BLOCK_SIZE, 256)
+        options += ['TILED=YES', 'BLOCKXSIZE={}'.format(size),
+                    'BLOCKYSIZE={}'.format(size)]
+    compress = str(params.get(cf.OUTPUT_COMPRESSION, 'NONE')).upper()
+    if compress != 'NONE' and not tiled_only:
+        options += ['COMPRESS={}'.format(compress), 'PREDICTOR=3',
+                    'NUM_THREADS={}'.format(params.get(cf.PROCESSES, 1))]
+    return options
+
+
+class GeotiffWriter(object):
+    """
+    Writes a float32 PyRate output GeoTIFF block by block, e.g. one tile
+    at a time, so the full size output is never held in memory. Multi-band
+    outputs, such as time series cubes, are band interleaved and written
+    from (rows, cols, bands) blocks.
+
+    Cloud optimised GeoTIFFs are first written to a tiled temporary file,
+    which gets overviews and is copied to the destination when closed.
+    """
+    # pylint: disable=too-many-arguments
+    def __init__(self, md, gt, wkt, shape, dest, nodata, params=None,
+                 band_md=None):
+        """
+        :param md: Dictionary containing PyRate metadata
+        :param gt: GDAL geotransform for the data
+        :param wkt: GDAL projection information for the data
+        :param shape: Shape (rows, cols) of the output
+        :param dest: Output GeoTIFF path
+        :param nodata: No data value
+        :param params: Optional config dictionary with the output profile
+        :param band_md: Optional list of metadata dictionaries, one per
+            band of a multi-band output
+        """
+        band_md = band_md or [{}]
+        self.dest = dest
+        self.cog = bool(params is not None and params.get(cf.OUTPUT_COG))
+        interleave = ['INTERLEAVE=BAND'] if len(band_md) > 1 else []
+        self.options = geotiff_creation_options(params) + interleave
+        self.block_size = params.get(cf.OUTPUT_BLOCK_SIZE, 256) \
+            if params is not None else None
+        self.path = dest + '.tmp' if self.cog else dest
+        nrows, ncols = shape
+        driver = gdal.GetDriverByName("GTiff")
+        options = geotiff_creation_options(params, tiled_only=True) + \
+            interleave if self.cog else self.options
+        self.ds = driver.Create(self.path, ncols, nrows, len(band_md),
+                                gdal.GDT_Float32, options=options)
+        # set spatial reference for geotiff
+        self.ds.SetGeoTransform(gt)
+        self.ds.SetProjection(wkt)
+        if ifc.EPOCH_DATE in md:
+            self.ds.SetMetadataItem(ifc.EPOCH_DATE, str(md[ifc.EPOCH_DATE]))
+
+        # set other metadata
+        self.ds.SetMetadataItem('DATA_TYPE', str(md['DATA_TYPE']))
+        # sequence position for time series products
+        if 'SEQUENCE_POSITION' in md:
+            self.ds.SetMetadataItem('SEQUENCE_POSITION',
+                                    str(md['SEQUENCE_POSITION']))
+        for i, metadata in enumerate(band_md):
+            band = self.ds.GetRasterBand(i + 1)
+            band.SetNoDataValue(nodata)
+            for k, v in metadata.items():
+                band.SetMetadataItem(k, str(v))
+            if ifc.EPOCH_DATE in metadata:
+                band.SetDescription(str(metadata[ifc.EPOCH_DATE]))
+
+    def write(self, data, yoff=0, xoff=0):
+        """
+        Writes a block of data.
+
+        :param data: Array (rows, cols) of the block, or (rows, cols, bands)
+            of a multi-band output
+        :param yoff: Row of the top left cell of the block
+        :param xoff: Column of the top left cell of the block
+        """
+        if data.ndim == 2:
+            self.ds.GetRasterBand(1).WriteArray(data, xoff, yoff)
+            return
+        # all bands of the block in one band sequential buffer
+        rows, cols, nbands = data.shape
+        buf = np.ascontiguousarray(np.rollaxis(data, 2), dtype=np.float32)
+        self.ds.WriteRaster(xoff, yoff, cols, rows, buf.tobytes(),
+                            buf_type=gdal.GDT_Float32,
+                            band_list=list(range(1, nbands + 1)))
+
+    def write_tile(self, data, tile):
+        """
+        Writes the data of a tile.
+
+        :param data: Array of the tile shape, with the bands last for
+            multi-band outputs
+        :param tile: Tile instance
+        """
+        self.write(data, tile.top_left_y, tile.top_left_x)
+
+    def close(self):
+        """
+        Finishes the GeoTIFF, adding overviews for cloud optimised output.
+        """
+        if self.cog:
+            levels = []
+            level = 2
+            while max(self.ds.RasterXSize, self.ds.RasterYSize) / level >= \
+                    self.block_size:
+                levels.append(level)
+                level *= 2
+            if levels:
+                self.ds.BuildOverviews('AVERAGE', levels)
+            gdal.GetDriverByName("GTiff").CreateCopy(
+                self.dest, self.ds,
+                options=self.options + ['COPY_SRC_OVERVIEWS=YES'])
+        self.ds = None
+        if self.cog:
+            os.remove(self.path)
 
 
 class GeotiffException(Exception):
@@ -1073,35 +1225,161 @@ def prepare_ifg(ifg_path, params):
     return ifg
 
 
-def save_numpy_phase(ifg_paths, tiles, params):
+def save_numpy_phase(ifg_paths, tiles, params, convert=False):
     """
-    Save interferogram phase data as numpy array.
+    Save interferogram phase data as one tile cube per tile: a memory
+    mappable .npy file holding the (nifgs, tile rows, tile cols) float32
+    phase data of all interferograms, in the order of ifg_paths. The order
+    is also saved in an index file, see tile_cube_index.
 
     :param ifg_paths: List of strings corresponding to interferogram paths
     :param tiles: List of Shared.Tile instances    
     :param params: Configuration dictionary
+    :param convert: Whether to save the phase data in millimetres with the
+        nodata cells as NaNs, whatever the nan conversion setting
 
     :return xxxx
     """
-    process_ifgs = mpiops.array_split(ifg_paths)
+    process_layers = mpiops.array_split(range(len(ifg_paths)))
     outdir = params[cf.TMPDIR]
     if not os.path.exists(outdir):
         mkdir_p(outdir)
-    for ifg_path in process_ifgs:
-        ifg = Ifg(ifg_path)
+    if mpiops.rank == 0:
+        np.save(join(outdir, TILE_CUBE_INDEX),
+                np.array([basename(p).split('.')[0] for p in ifg_paths]))
+        for t in tiles:
+            shape = (len(ifg_paths), int(t.bottom_right_y - t.top_left_y),
+                     int(t.bottom_right_x - t.top_left_x))
+            np.lib.format.open_memmap(join(outdir, TILE_CUBE.format(t.index)),
+                                      mode='w+', dtype=np.float32,
+                                      shape=shape)
+    mpiops.comm.barrier()
+
+    # every process writes the layers of its own ifgs
+    cubes = [np.lib.format.open_memmap(join(outdir, TILE_CUBE.format(t.index)),
+                                       mode='r+') for t in tiles]
+    for layer in process_layers:
+        ifg = Ifg(ifg_paths[layer])
         ifg.open()
+        if convert:
+            # nodata cells are matched before the scaling to millimetres
+            ifg.nodata_value = params[cf.NO_DATA_VALUE]
+            ifg.convert_to_nans()
+            ifg.convert_to_mm()
         phase_data = ifg.phase_data
-        bname = basename(ifg_path).split('.')[0]
-        for t in tiles:
-            p_data = phase_data[t.top_left_y:t.bottom_right_y,
-                                t.top_left_x:t.bottom_right_x]
-            phase_file = 'phase_data_{}_{}.npy'.format(bname, t.index)
-            np.save(file=join(outdir, phase_file),
-                    arr=p_data)
+        for t, cube in zip(tiles, cubes):
+            cube[layer] = phase_data[t.top_left_y:t.bottom_right_y,
+                                     t.top_left_x:t.bottom_right_x]
         ifg.close()
+    for cube in cubes:
+        cube.flush()
+    del cubes
     mpiops.comm.barrier()
 
 
+def tile_cube_index(outdir):
+    """
+    Returns the layer of each interferogram in the tile cubes.
+
+    :param outdir: Directory of the tile cubes
+
+    :return Dictionary of interferogram base name: layer
+    """
+    names = np.load(join(outdir, TILE_CUBE_INDEX))
+    return {str(n): k for k, n in enumerate(names)}
+
+
+class IfgStack(object):
+    """
+    Chunked (ifg, row, col) phase store of all interferograms, backed by
+    the tile cubes written by save_numpy_phase. Each chunk holds the
+    pixel columns of one tile for every interferogram, so the per pixel
+    stages (linrate and time series) read one chunk per tile, and the
+    reference pixel search reads whole interferograms, without touching
+    the GeoTIFFs. The orbital and reference phase corrections are written
+    through to the chunks, and the GeoTIFFs are exported from the stack
+    once, see run_pyrate.export_ifgs.
+    """
+    def __init__(self, outdir, tiles):
+        """
+        :param outdir: Directory of the tile cubes
+        :param tiles: List of Tile instances the cubes were saved with
+        """
+        self.outdir = outdir
+        self.tiles = tiles
+        self.index = tile_cube_index(outdir)
+        self.nrows = int(max(t.bottom_right_y for t in tiles))
+        self.ncols = int(max(t.bottom_right_x for t in tiles))
+
+    @property
+    def shape(self):
+        """
+        Returns the (ifgs, rows, cols) shape of the stack.
+        """
+        return len(self.index), self.nrows, self.ncols
+
+    def layer(self, ifg_path):
+        """
+        Returns the layer of an interferogram in the stack.
+
+        :param ifg_path: Interferogram path
+        """
+        return self.index[basename(ifg_path).split('.')[0]]
+
+    def chunk(self, tile, mode='r'):
+        """
+        Returns the (ifgs, tile rows, tile cols) memory mapped chunk of a tile.
+
+        :param tile: Tile instance
+        :param mode: Memory map mode, 'r' or 'r+'
+        """
+        return np.load(join(self.outdir, TILE_CUBE.format(tile.index)),
+                       mmap_mode=mode)
+
+    def parts(self, tile, ifg_paths, ifg_dict):
+        """
+        Returns the IfgParts of a tile, all viewing one memory map of its
+        chunk.
+
+        :param tile: Tile instance
+        :param ifg_paths: List of interferogram paths
+        :param ifg_dict: Dictionary of PrereadIfgs
+
+        :return List of IfgPart instances
+        """
+        cube = self.chunk(tile)
+        return [IfgPart(p, tile, ifg_dict, cube) for p in ifg_paths]
+
+    def read(self, ifg_path):
+        """
+        Assembles the full phase data of an interferogram from the chunks.
+
+        :param ifg_path: Interferogram path
+
+        :return Float32 array of shape (rows, cols)
+        """
+        layer = self.layer(ifg_path)
+        data = np.empty((self.nrows, self.ncols), dtype=np.float32)
+        for t in self.tiles:
+            data[t.top_left_y:t.bottom_right_y,
+                 t.top_left_x:t.bottom_right_x] = self.chunk(t)[layer]
+        return data
+
+    def write(self, ifg_path, data):
+        """
+        Writes the full phase data of an interferogram into the chunks.
+
+        :param ifg_path: Interferogram path
+        :param data: Array of shape (rows, cols)
+        """
+        layer = self.layer(ifg_path)
+        for t in self.tiles:
+            cube = self.chunk(t, mode='r+')
+            cube[layer] = data[t.top_left_y:t.bottom_right_y,
+                               t.top_left_x:t.bottom_right_x]
+            cube.flush()
+
+
 def get_projection_info(ifg_path):
     """
     Return projection information of interferogram.
@@ -23,16 +23,20 @@ and 'tsinvlap.m' contained in the Pirate package.
 import itertools
 from numpy import (where, isnan, nan, diff, zeros,
                    float32, cumsum, dot, delete, asarray)
-from numpy.linalg import matrix_rank, pinv, cholesky
+from numpy.linalg import matrix_rank, pinv
 import numpy as np
-from scipy.linalg import qr
+from scipy.linalg import qr, cho_factor, cho_solve, LinAlgError
+from scipy.linalg.lapack import dpotri
+from scipy.sparse import csr_matrix
 import matplotlib.pyplot as plt
 from joblib import Parallel, delayed
 
-from pyrate.algorithm import master_slave_ids, get_epochs
+from pyrate.algorithm import master_slave_ids, get_epochs, \
+    unique_mask_patterns
 from pyrate import config as cf
 from pyrate.config import ConfigException
 from pyrate import mst as mst_module
+from pyrate.vcm import VcmCache, vcm_cache
 
 
 def time_series_setup(ifgs, mst, params):
@@ -108,14 +112,16 @@ def time_series_setup(ifgs, mst, params):
         mst, ncols, nrows, nvelpar, parallel, span, tsvel_matrix
 
 
-def time_series(ifgs, params, vcmt, mst=None):
+def time_series(ifgs, params, vcmt, mst=None, cache=None):
     """
     Returns time series data from the given interferograms.
 
     :param ifgs: Network of interferograms
     :param params: Configuration parameters
     :param vcmt: Derived positive definite temporal variance covariance matrix
-    :param mst: Array of interferogram indexes from the MST-matrix (optional)
+    :param mst: Array of interferogram indexes from the MST-matrix, a boolean
+        array or a bit-packed mst.PackedMst (optional)
+    :param cache: VcmCache of vcmt, reused across calls (optional)
     :param parallel: Use parallel processing or not
 
     :return: Tuple with the elements:
@@ -135,12 +141,24 @@ def time_series(ifgs, params, vcmt, mst=None):
     b0_mat, interp, p_thresh, sm_factor, sm_order, ts_method, ifg_data, mst, \
         ncols, nrows, nvelpar, parallel, span, tsvel_matrix = \
         time_series_setup(ifgs, mst, params)
+    if cache is None:
+        cache = vcm_cache(vcmt, params)
+    bank = LaplacianBank(nvelpar, sm_order, sm_factor) \
+        if ts_method == 1 else None
+
+    if parallel in (1, 2):
+        # build every mst pattern operator once, workers get the part of
+        # the cache their row needs
+        _warm_cache(b0_mat, mst, nvelpar, p_thresh, interp, ts_method, cache,
+                    bank)
+        subsets = [cache.subset(mst[:, r]) for r in range(nrows)]
 
     if parallel == 1:
         tsvel_matrix = Parallel(n_jobs=params[cf.PROCESSES], verbose=50)(
             delayed(time_series_by_rows)(r, b0_mat, sm_factor, sm_order,
                                          ifg_data, mst, ncols, nvelpar,
-                                         p_thresh, vcmt, ts_method, interp)
+                                         p_thresh, vcmt, ts_method, interp,
+                                         subsets[r], bank)
             for r in range(nrows))
 
     elif parallel == 2:
@@ -148,15 +166,15 @@ def time_series(ifgs, params, vcmt, mst=None):
         res = np.array(Parallel(n_jobs=params[cf.PROCESSES], verbose=50)(
             delayed(time_series_by_pixel)(i, j, b0_mat, sm_factor, sm_order,
                                           ifg_data, mst, nvelpar, p_thresh,
-                                          vcmt, ts_method, interp)
+                                          vcmt, ts_method, interp,
+                                          subsets[i], bank)
             for (i, j) in itertools.product(range(nrows), range(ncols))))
         tsvel_matrix = np.reshape(res, newshape=(nrows, ncols, res.shape[1]))
     else:
-        for row in range(nrows):
-            for col in range(ncols):
-                tsvel_matrix[row, col] = time_series_by_pixel(
-                    row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
-                    nvelpar, p_thresh, vcmt, ts_method, interp)
+        # pixels sharing an mst pattern are solved together
+        tsvel_matrix = time_series_by_groups(
+            b0_mat, ifg_data, mst, nvelpar, p_thresh, interp, ts_method,
+            cache, bank)
 
     tsvel_matrix = where(tsvel_matrix == 0, nan, tsvel_matrix)
     # SB: do the span multiplication as a numpy linalg operation, MUCH faster
@@ -171,7 +189,8 @@ def time_series(ifgs, params, vcmt, mst=None):
 
 
 def time_series_by_rows(row, b0_mat, sm_factor, sm_order, ifg_data, mst, ncols,
-                        nvelpar, p_thresh, vcmt, ts_method, interp):
+                        nvelpar, p_thresh, vcmt, ts_method, interp,
+                        cache=None, bank=None):
     """
     Time series computation for each row of interferograms.
      
@@ -187,16 +206,18 @@ def time_series_by_rows(row, b0_mat, sm_factor, sm_order, ifg_data, mst, ncols,
      :param vcmt: xxxx
      :param ts_method: xxxx
      :param interp: xxxx
+     :param cache: VcmCache of vcmt (optional)
+     :param bank: LaplacianBank for ts_method 1 (optional)
      
      :return xxxx
      """
-    tsvel = np.empty(shape=(ncols, nvelpar), dtype=float32)
-    for col in range(ncols):
-        tsvel[col, :] = time_series_by_pixel(
-            row, col, b0_mat, sm_factor, sm_order, ifg_data, mst, nvelpar,
-            p_thresh, vcmt, ts_method, interp)
-
-    return tsvel
+    if cache is None:
+        cache = VcmCache(vcmt)
+    if ts_method == 1 and bank is None:
+        bank = LaplacianBank(nvelpar, sm_order, sm_factor)
+    return time_series_by_groups(
+        b0_mat, ifg_data[:, row:row + 1], mst[:, row:row + 1], nvelpar,
+        p_thresh, interp, ts_method, cache, bank)[0]
 
 
 def remove_rank_def_rows(b_mat, nvelpar, ifgv, sel):
@@ -214,13 +235,125 @@ def remove_rank_def_rows(b_mat, nvelpar, ifgv, sel):
     licols = e_var[matrix_rank(b_mat):nvelpar]
     [rmrow, _] = where(b_mat[:, licols] != 0)
     b_mat = delete(b_mat, rmrow, axis=0)
-    ifgv = delete(ifgv, rmrow)
+    ifgv = delete(ifgv, rmrow, axis=0)
     sel = delete(sel, rmrow)
     return b_mat, ifgv, sel, rmrow
 
 
+def time_series_by_groups(b0_mat, ifg_data, mst, nvelpar, p_thresh, interp,
+                          method=2, cache=None, bank=None):
+    """
+    Time series inversion for a block of pixels, grouping pixels by
+    their MST mask pattern. The design matrix, its rank reduction and
+    the least squares operator only depend on the selected interferograms,
+    so they are computed once per unique pattern and applied to all pixels
+    of the group with one matrix product.
+
+    :param b0_mat: Design matrix of all interferograms (nifgs, nvelpar)
+    :param ifg_data: Array of observations (nifgs, rows, cols)
+    :param mst: Boolean array (nifgs, rows, cols) of selected observations
+    :param nvelpar: Number of velocity parameters
+    :param p_thresh: Minimum number of coherent observations for a pixel
+    :param interp: 0 if the rank deficient rows need to be removed
+    :param method: 1 for Laplacian smoothing, 2 for SVD
+    :param cache: VcmCache of the temporal vcm matrix, required for method 1
+    :param bank: LaplacianBank, required for method 1
+
+    :return tsvel: Velocities of shape (rows, cols, nvelpar)
+    """
+    if method not in (1, 2):
+        raise ValueError("Unrecognised time series method")
+    nifgs, rows, cols = ifg_data.shape
+    tsvel = np.empty(shape=(rows * cols, nvelpar), dtype=float32) * np.nan
+    data = ifg_data.reshape(nifgs, rows * cols)
+
+    patterns, groups = unique_mask_patterns(mst)
+    for pattern, pixels in zip(patterns.T, groups):
+        sel = np.nonzero(pattern)[0]
+        if len(sel) < p_thresh:
+            continue
+        solver = _pattern_operator(b0_mat, sel, nvelpar, interp, method,
+                                   cache, bank)
+        if solver is None:
+            continue
+        sel, keep, operator = solver
+        # observations of all pixels in the group, one column per pixel
+        ifgv = data[sel][:, pixels]
+        tsvel[np.ix_(pixels, keep)] = dot(operator, ifgv).T
+
+    return tsvel.reshape(rows, cols, nvelpar)
+
+
+def _pattern_operator(b0_mat, sel, nvelpar, interp, method, cache=None,
+                      bank=None):
+    """
+    Least squares operator of a selection of interferograms, after the
+    rank deficient rows are removed, as used by time_series_by_pixel.
+
+    :param b0_mat: Design matrix of all interferograms (nifgs, nvelpar)
+    :param sel: Indices of the selected interferograms
+    :param nvelpar: Number of velocity parameters
+    :param interp: 0 if the rank deficient rows need to be removed
+    :param method: 1 for Laplacian smoothing, 2 for SVD
+    :param cache: VcmCache of the temporal vcm matrix, required for method 1
+    :param bank: LaplacianBank, required for method 1
+
+    :return sel: Indices of the interferograms left
+    :return keep: Boolean flags of the velocity parameters solved for
+    :return operator: Array (nkeep, len(sel)) mapping the observations to
+        the velocities, or None if no interferograms are left
+    """
+    # operators are cached under the selection before the rank deficient
+    # rows are removed, the keys of VcmCache.subset
+    key = sel
+    b_mat = b0_mat[sel, :]
+    if interp == 0:
+        # remove rank deficient rows, the rows of sel follow those of b_mat
+        rmrow = asarray([0])  # dummy
+        while len(rmrow) > 0 and b_mat.shape[0] > 1:
+            b_mat, _, sel, rmrow = remove_rank_def_rows(
+                b_mat, nvelpar, sel, sel)
+        if len(rmrow) > 0:
+            return None
+        velflag = sum(abs(b_mat), 0)
+        b_mat = b_mat[:, ~np.isclose(velflag, 0.0)]
+    else:
+        velflag = np.ones(nvelpar)
+    if method == 1:
+        operator = cache.get(key, 'ts_lap', lambda _: _lap_operator(
+            velflag, b_mat, bank, sel, cache))
+        return sel, ~np.isclose(velflag, 0.0, atol=1e-8), operator
+    return sel, velflag != 0, pinv(b_mat)
+
+
+def _warm_cache(b0_mat, mst, nvelpar, p_thresh, interp, method, cache,
+                bank):
+    """
+    Fills the cache with the Laplacian smoothing operators of all mst
+    patterns with enough observations, before the cache is shared with
+    parallel workers. The SVD method does not use the cache.
+
+    :param b0_mat: Design matrix of all interferograms (nifgs, nvelpar)
+    :param mst: Boolean array (nifgs, rows, cols) of selected observations
+    :param nvelpar: Number of velocity parameters
+    :param p_thresh: Minimum number of coherent observations for a pixel
+    :param interp: 0 if the rank deficient rows need to be removed
+    :param method: 1 for Laplacian smoothing, 2 for SVD
+    :param cache: VcmCache of the temporal vcm matrix
+    :param bank: LaplacianBank
+    """
+    if method != 1:
+        return
+    for pattern in unique_mask_patterns(mst)[0].T:
+        sel = np.nonzero(pattern)[0]
+        if len(sel) >= p_thresh:
+            _pattern_operator(b0_mat, sel, nvelpar, interp, method, cache,
+                              bank)
+
+
 def time_series_by_pixel(row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
-                         nvelpar, p_thresh, vcmt, method, interp):
+                         nvelpar, p_thresh, vcmt, method, interp,
+                         cache=None, bank=None):
     """
     Time series computation for each pixel.
     
@@ -236,11 +369,14 @@ def time_series_by_pixel(row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
      :param vcmt: xxxx
      :param method: xxxx
      :param interp: xxxx
+     :param cache: VcmCache of vcmt (optional)
+     :param bank: LaplacianBank for method 1 (optional)
      
      :return xxxx
     """
     # check pixel for non-redundant ifgs
     sel = np.nonzero(mst[:, row, col])[0]  # trues in mst are chosen
+    key = sel
     if len(sel) >= p_thresh:
         ifgv = ifg_data[sel, row, col]
         # make design matrix, b_mat
@@ -265,8 +401,10 @@ def time_series_by_pixel(row, col, b0_mat, sm_factor, sm_order, ifg_data, mst,
             velflag = np.ones(nvelpar)
         if method == 1:
             # Use Laplacian smoothing method
-            tsvel = _solve_ts_lap(nvelpar, velflag, ifgv, b_mat,
-                                  sm_order, sm_factor, sel, vcmt)
+            if bank is None:
+                bank = LaplacianBank(nvelpar, sm_order, sm_factor)
+            tsvel = _solve_ts_lap(nvelpar, velflag, ifgv, b_mat, bank, sel,
+                                  vcmt, cache, key)
         elif method == 2:
             # Use SVD method
             tsvel = solve_ts_svd(nvelpar, velflag, ifgv, b_mat)
@@ -296,7 +434,149 @@ def solve_ts_svd(nvelpar, velflag, ifgv, b_mat):
     return tsvel
 
 
-def _solve_ts_lap(nvelpar, velflag, ifgv, mat_b, smorder, smfactor, sel, vcmt):
+class LaplacianBank(object):
+    """
+    Laplacian smoothing design matrices of a time series run. They only
+    depend on the number of velocity parameters left after removing the
+    rank deficient rows of a pixel, so each one is built once, on first use.
+    """
+
+    def __init__(self, nvelpar, smorder, smfactor):
+        """
+        :param nvelpar: Number of velocity parameters
+        :param smorder: Order of the Laplacian smoothing operator (1 or 2)
+        :param smfactor: Laplacian smoothing factor
+        """
+        self.smorder = smorder
+        # Laplacian observations number
+        nlap = nvelpar - smorder
+        #  Laplacian smoothing coefficient matrix
+        coefs = [-1, 1] if smorder == 1 else [1, -2, 1]
+        self.b_lap0 = np.zeros(shape=(nlap, nvelpar))
+        diag_ind = np.arange(nlap)
+        for k, coef in enumerate(coefs):
+            self.b_lap0[diag_ind, diag_ind + k] = coef
+
+        # Scale the coefficients by Laplacian smoothing factor
+        self.b_lap0 *= smfactor
+        self._b_laps = {}
+        self._grams = {}
+
+    def design(self, nvelleft):
+        """
+        Returns the Laplacian smoothing design matrix.
+
+        :param nvelleft: Number of velocity parameters left
+
+        :return Array of shape (nvelleft - smorder + 2, nvelleft)
+        """
+        if nvelleft not in self._b_laps:
+            nlap = nvelleft - self.smorder
+
+            # constrain for the first and the last incremental
+            b_lap1 = - np.divide(np.ones(shape=nvelleft), nvelleft - 1)
+            b_lap1[0] = 1.0
+            b_lapn = - np.divide(np.ones(shape=nvelleft), nvelleft - 1)
+            b_lapn[-1] = 1.0
+
+            b_lap = np.empty(shape=(nlap + 2, nvelleft))
+            b_lap[0, :] = b_lap1
+            b_lap[1:nlap + 1, :] = self.b_lap0[0:nlap, 0:nvelleft]
+            b_lap[-1, :] = b_lapn
+            self._b_laps[nvelleft] = b_lap
+        return self._b_laps[nvelleft]
+
+    def gram(self, nvelleft):
+        """
+        Returns the Gram matrix b_lap' * b_lap of the Laplacian smoothing
+        design matrix, its contribution to the normal equations.
+
+        :param nvelleft: Number of velocity parameters left
+
+        :return Array of shape (nvelleft, nvelleft)
+        """
+        if nvelleft not in self._grams:
+            b_lap = self.design(nvelleft)
+            self._grams[nvelleft] = dot(b_lap.T, b_lap)
+        return self._grams[nvelleft]
+
+
+def _lap_operator(velflag, mat_b, bank, sel, cache):
+    """
+    Least squares operator of the Laplacian smoothing method, mapping the
+    observations of a pixel to its velocities.
+
+    :param velflag: Flags of the velocity parameters left
+    :param mat_b: Design matrix of the selected interferograms
+    :param bank: LaplacianBank
+    :param sel: Indices of the selected interferograms
+    :param cache: VcmCache of the temporal vcm matrix
+
+    :return Array of shape (nvelleft, len(sel))
+    """
+    # pylint: disable=invalid-name
+    nvelleft = np.count_nonzero(velflag)
+
+    # vcm is block diagonal, vcmt[sel, sel] and identity for the laplacian
+    # rows, and the Laplacian observations are zero. The operator is then
+    # inv(B' inv(vcm) B + b_lap' b_lap) B' inv(vcm) for the design matrix B
+    # of the interferograms, solved from cholesky factors
+    try:
+        vinv = _inverse_from_factor(cache.factor(sel))
+        # B has a few non zeros per row, the time spans of an interferogram
+        b_t = csr_matrix(mat_b.T)
+        bv = b_t.dot(vinv)
+        factor = cho_factor(b_t.dot(bv.T) + bank.gram(nvelleft))
+    except LinAlgError:
+        factor = None
+    if factor is not None and not _rank_deficient(factor[0]):
+        return cho_solve(factor, bv)
+
+    # singular vcm or normal matrix: the weight matrix is the upper
+    # cholesky factor of inv(vcm), only the interferogram rows are weighted
+    w = cache.inverse_factor(sel)
+    wb = np.concatenate((dot(w, mat_b), bank.design(nvelleft)), axis=0)
+    # only the columns of pinv(wb) of the interferogram observations are
+    # needed
+    return dot(pinv(wb, rcond=1e-8)[:, :len(sel)], w)
+
+
+def _inverse_from_factor(factor):
+    """
+    Returns the inverse of a VCM from its factor, see vcm_factor.
+
+    :param factor: Upper triangular factor U, vcm = U * U'
+
+    :return Array inv(vcm)
+    """
+    if _rank_deficient(factor):
+        raise LinAlgError('Singular VCM factor')
+    # the reversed factor is the lower cholesky factor of the reversed vcm
+    inv, info = dpotri(factor[::-1, ::-1], lower=1)
+    if info != 0:
+        raise LinAlgError('Singular VCM factor')
+    inv = np.tril(inv)
+    inv += np.tril(inv, -1).T
+    return inv[::-1, ::-1]
+
+
+def _rank_deficient(factor, rcond=1e-8):
+    """
+    Whether a triangular cholesky factor is numerically rank deficient.
+    For a normal matrix, the diagonal of the factor estimates the singular
+    values of the design matrix, compared with the rcond of pinv.
+
+    :param factor: Triangular cholesky factor
+    :param rcond: Relative cutoff of the singular values
+
+    :return True if the normal equations need the pseudo inverse
+    """
+    diag = np.abs(np.diag(factor))
+    return diag.min() <= rcond * diag.max()
+
+
+def _solve_ts_lap(nvelpar, velflag, ifgv, mat_b, bank, sel, vcmt, cache=None,
+                  key=None):
     """
     Solve the linear least squares system using the Finite Difference
     method using a Laplacian Smoothing operator.
@@ -306,70 +586,29 @@ def _solve_ts_lap(nvelpar, velflag, ifgv, mat_b, smorder, smfactor, sel, vcmt):
     :param velflag: xxxx
     :param ifgv: xxxx
     :param mat_b: xxxx
-    :param smorder: xxxx
-    :param smfactor: xxxx
+    :param bank: LaplacianBank of the smoothing design matrices
     :param sel: xxxx
     :param vcmt: xxxx
+    :param cache: VcmCache of vcmt (optional)
+    :param key: Selection of interferograms before the rank deficient rows
+        were removed, the cache key of the operator (default sel)
     
     :return xxxx    
     """
-    # pylint: disable=invalid-name
-    # Laplacian observations number
-    nlap = nvelpar - smorder
-    #  Laplacian smoothing coefficient matrix
-    b_lap0 = np.zeros(shape=(nlap, nvelpar))
-
-    for i in range(nlap):
-        if smorder == 1:
-            b_lap0[i, i:i+2] = [-1, 1]
-        else:
-            b_lap0[i, i:i+3] = [1, -2, 1]
-
-    # Scale the coefficients by Laplacian smoothing factor
-    b_lap0 *= smfactor
-
-    # Laplacian smoothing design matrix
-    nvelleft = np.count_nonzero(velflag)
-    nlap = nvelleft - smorder
-
-    # constrain for the first and the last incremental
-    b_lap1 = - np.divide(np.ones(shape=nvelleft), nvelleft - 1)
-    b_lap1[0] = 1.0
-    b_lapn = - np.divide(np.ones(shape=nvelleft), nvelleft - 1)
-    b_lapn[-1] = 1.0
-
-    b_lap = np.empty(shape=(nlap + 2, nvelleft))
-    b_lap[0, :] = b_lap1
-    b_lap[1:nlap + 1, :] = b_lap0[0:nlap, 0:nvelleft]
-    b_lap[-1, :] = b_lapn
-
-    nlap += 2
-
-    # add laplacian design matrix to existing design matrix
-    mat_b = np.concatenate((mat_b, b_lap), axis=0)
-
-    # combine ifg and Laplacian smooth vector
-    v_lap = np.zeros(nlap)
-    obsv = np.concatenate((ifgv, v_lap), axis=0)
-
-    # make variance-covariance matrix
-    # new covariance matrix, adding the laplacian equations
-    m = len(sel)
-    nobs = m + nlap
-    vcm_tmp = np.eye(nobs)
-    vcm_tmp[:m, :m] = vcmt[sel, np.vstack(sel)]
+    if cache is None:
+        cache = VcmCache(vcmt)
+    if key is None:
+        key = sel
 
     # solve the equation by least-squares
     # calculate velocities
-    # we get the lower triangle in numpy, Matlab gives upper triangle
-    w = cholesky(pinv(vcm_tmp)).T
-    wb = dot(w, mat_b)
-    wl = dot(w, obsv)
-    x = dot(pinv(wb, rcond=1e-8), wl)
+    operator = cache.get(key, 'ts_lap', lambda _: _lap_operator(
+        velflag, mat_b, bank, sel, cache))
+    x = dot(operator, ifgv)
 
     # TODO: implement residuals and roughness calculations
     tsvel = np.empty(nvelpar, dtype=float32) * np.nan
-    tsvel[~np.isclose(velflag, 0.0, atol=1e-8)] = x[:nvelleft]
+    tsvel[~np.isclose(velflag, 0.0, atol=1e-8)] = x
 
     # TODO: implement uncertainty estimates (tserror) like in Matlab Pirate code
     return tsvel
@@ -20,16 +20,24 @@ are based on functions 'cvdcalc.m' and 'vcmt.m' from
 the Matlab Pirate package.
 """
 from __future__ import print_function
-from numpy import array, where, isnan, real, imag, sqrt, meshgrid
-from numpy import zeros, vstack, ceil, mean, exp, reshape
+import logging
+from collections import OrderedDict
+from numpy import array, where, isnan, sqrt
+from numpy import zeros, vstack, ceil, exp, delete
+from numpy.fft import rfft2, irfft2
 from numpy.linalg import norm
 import numpy as np
-from scipy.fftpack import fft2, ifft2, fftshift
+from scipy.linalg import cholesky, solve_triangular, LinAlgError
 from scipy.optimize import fmin
 
+from pyrate import config as cf
+from pyrate import prepifg
 from pyrate import shared
 from pyrate.shared import PrereadIfg
-from pyrate.algorithm import master_slave_ids
+from pyrate.algorithm import master_slave_indices, unique_mask_patterns
+
+# pylint: disable=logging-format-interpolation
+log = logging.getLogger(__name__)
 
 
 def pendiffexp(alphamod, cvdav):
@@ -61,119 +69,222 @@ def unique_points(points):
     return vstack([array(u) for u in set(points)])
 
 
-def cvd(ifg_path, params, calc_alpha=False):
+def cvd(ifg_path, params, calc_alpha=False, context=None):
     """
     Calculate average covariance versus distance (autocorrelation) and its
     best fitting exponential function.
 
-    :param ifg_path: An interferogram. ifg: :py:class:`pyrate.shared.Ifg`
+    :param ifg_path: An interferogram. ifg: :py:class:`pyrate.shared.Ifg`,
+        or its nan converted phase data in millimetres, e.g. read from an
+        IfgStack
     :param: params: Dictionary of configuration parameters
     :param calc_alpha: Whether to calculate alpha
+    :param context: Optional CvdContext of the interferogram geometry,
+        shared by all interferograms of a stack. Required with phase data
     
     :return xxxx
     """
     # pylint: disable=invalid-name
     # pylint: disable=too-many-locals
-    if isinstance(ifg_path, str):  # used during MPI
-        ifg = shared.Ifg(ifg_path)
-        ifg.open()
+    if isinstance(ifg_path, np.ndarray):
+        if context is None:
+            raise ValueError('cvd of phase data requires a CvdContext')
+        phase = where(isnan(ifg_path), 0, ifg_path)
     else:
-        ifg = ifg_path
-    # assert isinstance(ifg_path, shared.Ifg)
-    # ifg = ifg_path
-    shared.nan_and_mm_convert(ifg, params)
+        if isinstance(ifg_path, str):  # used during MPI
+            ifg = shared.Ifg(ifg_path)
+            ifg.open()
+        else:
+            ifg = ifg_path
+        # assert isinstance(ifg_path, shared.Ifg)
+        # ifg = ifg_path
+        shared.nan_and_mm_convert(ifg, params)
+        if ifg.nan_converted:  # saves heaps of time with no-nan conversion
+            phase = where(isnan(ifg.phase_data), 0, ifg.phase_data)
+        else:
+            phase = ifg.phase_data
+        if context is None:
+            context = CvdContext.from_ifg(ifg)
+        if isinstance(ifg_path, str):
+            ifg.close()
+
+    if context.shape != phase.shape:
+        raise ValueError('CvdContext of shape {} does not match the '
+                         'interferogram shape {}'.format(context.shape,
+                                                         phase.shape))
+
     # calculate 2D auto-correlation of image using the
     # spectral method (Wiener-Khinchin theorem)
-    if ifg.nan_converted:  # saves heaps of time with no-nan conversion
-        phase = where(isnan(ifg.phase_data), 0, ifg.phase_data)
-    else:
-        phase = ifg.phase_data
-    # distance division factor of 1000 converts to km and is needed to match
-    # Matlab code output
-    distfact = 1000
-
-    nrows, ncols = phase.shape
-    fft_phase = fft2(phase)
-    pspec = real(fft_phase)**2 + imag(fft_phase)**2
-    autocorr_grid = ifft2(pspec)
-    nzc = np.sum(np.sum(phase != 0))
-    autocorr_grid = fftshift(real(autocorr_grid)) / nzc
-
-    # pixel distances from pixel at zero lag (image centre).
-    xx, yy = meshgrid(range(ncols), range(nrows))
-
-    # r_dist is distance from the center
-    # doing np.divide and np.sqrt will improve performance as it keeps
-    # calculations in the numpy land
-    r_dist = np.divide(np.sqrt(((xx-ifg.x_centre) * ifg.x_size)**2 +
-                               ((yy-ifg.y_centre) * ifg.y_size)**2), distfact)
-
-    r_dist = reshape(r_dist, ifg.num_cells)
-    acg = reshape(autocorr_grid, ifg.num_cells)
-
-    # Symmetry in image; keep only unique points
-    # tmp = unique_points(zip(acg, r_dist))
-    # Sudipta: Is this faster than keeping only the 1st half as in Matlab?
-    # Sudipta: Unlikely, as unique_point is a search/comparison,
-    # whereas keeping 1st half is just numpy indexing.
-    # If it is not faster, why was this done differently here?
-
-    r_dist = r_dist[:int(ceil(ifg.num_cells/2.0)) + ifg.nrows]
-    acg = acg[:len(r_dist)]
-
-    # Alternative method to remove duplicate cells (from Matlab Pirate code)
-    # r_dist = r_dist[:ceil(len(r_dist)/2)+nlines]
-    #  Reason for '+nlines' term unknown
-
-    # eg. array([x for x in set([(1,1), (2,2), (1,1)])])
-    # the above shortens r_dist by some number of cells
-
-    # bin width for collecting data
-    bin_width = max(ifg.x_size, ifg.y_size) * 2 / distfact
-
-    # pick the smallest axis to determine circle search radius
-    # print 'ifg.X_CENTRE, ifg.Y_CENTRE=', ifg.x_centre, ifg.y_centre
-    # print 'ifg.X_SIZE, ifg.Y_SIZE', ifg.x_size, ifg.y_size
-    if (ifg.x_centre * ifg.x_size) < (ifg.y_centre * ifg.y_size):
-        maxdist = ifg.x_centre * ifg.x_size / distfact
-    else:
-        maxdist = ifg.y_centre * ifg.y_size/ distfact
-
-    # filter out data where the of lag distance is greater than maxdist
-    # r_dist = array([e for e in rorig if e <= maxdist]) #
-    # MG: prefers to use all the data
-    # acg = array([e for e in rorig if e <= maxdist])
-    indices_to_keep = r_dist < maxdist
-    r_dist = r_dist[indices_to_keep]
-    acg = acg[indices_to_keep]
-
-    if isinstance(ifg_path, str):
-        ifg.close()
+    nzc = np.sum(phase != 0)
+    acg = _autocorr(phase).ravel()[context.src] / nzc
 
     if calc_alpha:
-        # classify values of r_dist according to bin number
-        rbin = ceil(r_dist / bin_width).astype(int)
-        maxbin = max(rbin)  # consistent with Matlab code
+        maxbin = context.maxbin  # consistent with Matlab code
+        bin_width = context.bin_width
 
         cvdav = zeros(shape=(2, maxbin))
 
         # the following stays in numpy land
         # distance instead of bin number
         cvdav[0, :] = np.multiply(range(maxbin), bin_width)
-        # mean variance for the bins
-        cvdav[1, :] = [mean(acg[rbin == b]) for b in range(maxbin)]
+        # mean variance for the bins, in one pass over the lags
+        sums = np.bincount(context.rbin, weights=acg,
+                           minlength=maxbin + 1)[:maxbin]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cvdav[1, :] = sums / context.counts
 
         # calculate best fit function maxvar*exp(-alpha*r_dist)
         alphaguess = 2 / (maxbin * bin_width)
         alpha = fmin(pendiffexp, x0=alphaguess, args=(cvdav,), disp=0,
                      xtol=1e-6, ftol=1e-6)
-        print("1st guess alpha", alphaguess, 'converged alpha:', alpha)
+        log.debug('1st guess alpha {}, converged alpha: {}'.format(
+            alphaguess, alpha))
         # maximum variance usually at the zero lag: max(acg[:len(r_dist)])
         return np.max(acg), alpha[0]
     else:
         return np.max(acg), None
 
 
+def _autocorr(phase):
+    """
+    Circular 2D autocorrelation of real valued phase data, computed with
+    real to complex transforms.
+
+    :param phase: Array of shape (rows, cols) without NaNs
+
+    :return Autocorrelation array of shape (rows, cols), zero lag at [0, 0]
+    """
+    fft_phase = rfft2(phase)
+    pspec = fft_phase.real**2 + fft_phase.imag**2
+    return irfft2(pspec, s=phase.shape)
+
+
+class CvdContext(object):
+    """
+    Lag distances of the autocorrelation cells used by cvd. They only
+    depend on the interferogram geometry, so one context is built per
+    stack and shared by the cvd calls of all its interferograms.
+    """
+    # pylint: disable=too-many-arguments
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, nrows, ncols, x_centre, y_centre, x_size, y_size):
+        """
+        :param nrows: Number of rows of the interferograms
+        :param ncols: Number of columns of the interferograms
+        :param x_centre: Column index of the image centre
+        :param y_centre: Row index of the image centre
+        :param x_size: Cell width in metres
+        :param y_size: Cell height in metres
+        """
+        self.shape = (nrows, ncols)
+        # distance division factor of 1000 converts to km and is needed to
+        # match Matlab code output
+        distfact = 1000
+
+        # Symmetry in image; keep only the first half (plus nrows cells, as
+        # in Matlab Pirate) of the fftshift-ed grid
+        ncells = min(int(ceil(nrows * ncols / 2.0)) + nrows, nrows * ncols)
+        yy, xx = divmod(np.arange(ncells), ncols)
+
+        # r_dist is distance from the center
+        r_dist = np.divide(np.sqrt(((xx - x_centre) * x_size)**2 +
+                                   ((yy - y_centre) * y_size)**2), distfact)
+
+        # pick the smallest axis to determine circle search radius
+        if (x_centre * x_size) < (y_centre * y_size):
+            maxdist = x_centre * x_size / distfact
+        else:
+            maxdist = y_centre * y_size / distfact
+
+        # filter out data where the of lag distance is greater than maxdist
+        keep = r_dist < maxdist
+        yy, xx, r_dist = yy[keep], xx[keep], r_dist[keep]
+
+        #: flat indices of the used cells in the unshifted autocorrelation
+        self.src = ((yy - nrows // 2) % nrows) * ncols + \
+            (xx - ncols // 2) % ncols
+
+        # bin width for collecting data
+        self.bin_width = max(x_size, y_size) * 2 / distfact
+        # classify values of r_dist according to bin number
+        self.rbin = ceil(r_dist / self.bin_width).astype(int)
+        self.maxbin = max(self.rbin)
+        self.counts = np.bincount(self.rbin,
+                                  minlength=self.maxbin + 1)[:self.maxbin]
+
+    @classmethod
+    def from_ifg(cls, ifg):
+        """
+        Builds the context of an open interferogram.
+
+        :param ifg: Interferogram class instance
+
+        :return CvdContext instance
+        """
+        return cls(ifg.nrows, ifg.ncols, ifg.x_centre, ifg.y_centre,
+                   ifg.x_size, ifg.y_size)
+
+
+def multilooked_cvd(ifg_paths, params, xlooks, ylooks):
+    """
+    Estimates maxvar and alpha of interferograms from block averaged
+    copies, made with the prepifg multi-looking. The zero lag variance of
+    the block averages is rescaled to full resolution with the fitted
+    exponential covariance model, see multilook_variance_factor.
+
+    :param ifg_paths: List of interferogram paths
+    :param params: Dictionary of configuration parameters
+    :param xlooks: Multi look factor in x dimension
+    :param ylooks: Multi look factor in y dimension
+
+    :return maxvar: List of full resolution maxvar estimates
+    :return alpha: List of exponential decay exponents
+    """
+    mlooked = prepifg.prepare_ifgs(
+        ifg_paths, crop_opt=prepifg.ALREADY_SAME_SIZE, xlooks=xlooks,
+        ylooks=ylooks, thresh=params[cf.NO_DATA_AVERAGING_THRESHOLD],
+        write_to_disc=False)
+    maxvar, alpha = [], []
+    context = None
+    for _, dataset in mlooked:
+        ifg = shared.Ifg(dataset)
+        ifg.initialize()
+        if context is None:
+            context = CvdContext.from_ifg(ifg)
+        mlooked_maxvar, ifg_alpha = cvd(ifg, params, calc_alpha=True,
+                                        context=context)
+        factor = multilook_variance_factor(ifg_alpha, xlooks, ylooks,
+                                           ifg.x_size / xlooks,
+                                           ifg.y_size / ylooks)
+        maxvar.append(mlooked_maxvar / factor)
+        alpha.append(ifg_alpha)
+    return maxvar, alpha
+
+
+def multilook_variance_factor(alpha, xlooks, ylooks, x_size, y_size):
+    """
+    Ratio of the variance of xlooks by ylooks block averages to the
+    variance of the full resolution cells, for a field with covariance
+    maxvar * exp(-alpha * r).
+
+    :param alpha: Exponential decay exponent (1/km)
+    :param xlooks: Multi look factor in x dimension
+    :param ylooks: Multi look factor in y dimension
+    :param x_size: Full resolution cell width in metres
+    :param y_size: Full resolution cell height in metres
+
+    :return Variance factor
+    """
+    # lags between the cells of a block, and the number of cell pairs
+    # of the block at each lag
+    dx = np.arange(1 - xlooks, xlooks)
+    dy = np.arange(1 - ylooks, ylooks)
+    npairs = np.outer(ylooks - np.abs(dy), xlooks - np.abs(dx))
+    r_dist = np.sqrt((dx[np.newaxis, :] * x_size)**2 +
+                     (dy[:, np.newaxis] * y_size)**2) / 1000
+    return np.sum(npairs * exp(-alpha * r_dist)) / (xlooks * ylooks)**2
+
+
 def get_vcmt(ifgs, maxvar):
     """
     Returns the temporal variance/covariance matrix.
@@ -183,38 +294,223 @@ def get_vcmt(ifgs, maxvar):
     
     :return xxxx
     """
-    # pylint: disable=too-many-locals
-    # c=0.5 for common master or slave; c=-0.5 if master
-    # of one matches slave of another
-
     if isinstance(ifgs, dict):
-        from collections import OrderedDict
         ifgs = {k: v for k, v in ifgs.items() if isinstance(v, PrereadIfg)}
         ifgs = OrderedDict(sorted(ifgs.items()))
         # pylint: disable=redefined-variable-type
         ifgs = ifgs.values()
 
-    nifgs = len(ifgs)
-    vcm_pat = zeros((nifgs, nifgs))
+    masters, slaves, _ = master_slave_indices(ifgs)
+    vcm_pat = vcm_pattern(masters, slaves)
 
-    dates = [ifg.master for ifg in ifgs] + [ifg.slave for ifg in ifgs]
-    ids = master_slave_ids(dates)
+    # make covariance matrix in time domain
+    std = sqrt(maxvar).reshape((len(masters), 1))
+    vcm_t = std * std.transpose()
+    return vcm_t * vcm_pat
 
-    for i, ifg in enumerate(ifgs):
-        mas1, slv1 = ids[ifg.master], ids[ifg.slave]
 
-        for j, ifg2 in enumerate(ifgs):
-            mas2, slv2 = ids[ifg2.master], ids[ifg2.slave]
-            if mas1 == mas2 or slv1 == slv2:
-                vcm_pat[i, j] = 0.5
+def vcm_pattern(masters, slaves):
+    """
+    Returns the temporal correlation pattern of a network of interferograms:
+    1 on the diagonal, 0.5 for interferograms with a common master or slave,
+    -0.5 where the master of one is the slave of the other and 0 otherwise.
 
-            if mas1 == slv2 or slv1 == mas2:
-                vcm_pat[i, j] = -0.5
+    :param masters: Integer array of master epoch indices
+    :param slaves: Integer array of slave epoch indices
 
-            if mas1 == mas2 and slv1 == slv2:
-                vcm_pat[i, j] = 1.0  # handle testing ifg against itself
+    :return Array of shape (nifgs, nifgs)
+    """
+    masters = np.asarray(masters)
+    slaves = np.asarray(slaves)
 
-    # make covariance matrix in time domain
-    std = sqrt(maxvar).reshape((nifgs, 1))
-    vcm_t = std * std.transpose()
-    return vcm_t * vcm_pat
+    # c=0.5 for common master or slave; c=-0.5 if master
+    # of one matches slave of another
+    mas1, slv1 = masters[:, np.newaxis], slaves[:, np.newaxis]
+    vcm_pat = where((mas1 == masters) | (slv1 == slaves), 0.5, 0.0)
+    vcm_pat[(mas1 == slaves) | (slv1 == masters)] = -0.5
+    # handle testing ifg against itself
+    vcm_pat[(mas1 == masters) & (slv1 == slaves)] = 1.0
+    return vcm_pat
+
+
+def vcm_factor(vcm):
+    """
+    Returns the upper triangular factor U of a positive definite VCM such
+    that vcm = U * U'. inv(U) is then the upper cholesky factor of inv(vcm),
+    used to weight the residuals, and rows/columns of the VCM can be
+    removed from U with a cheap update (see delete_from_factor).
+
+    :param vcm: Positive definite variance covariance matrix
+
+    :return Upper triangular factor
+    """
+    return cholesky(vcm[::-1, ::-1], lower=True)[::-1, ::-1]
+
+
+def delete_from_factor(factor, k):
+    """
+    Returns the factor (see vcm_factor) of the VCM with row and
+    column k removed, using a rank one update of the leading block
+    instead of a new factorisation.
+
+    :param factor: Upper triangular factor of the VCM
+    :param k: Index of the observation to remove
+
+    :return Upper triangular factor of the reduced VCM
+    """
+    x = factor[:k, k].copy()
+    factor = delete(delete(factor, k, axis=0), k, axis=1)
+    # reversing the leading block gives a lower triangular cholesky factor
+    lead = factor[:k, :k][::-1, ::-1]
+    x = x[::-1]
+    for j in range(k):
+        diag_jj = np.hypot(lead[j, j], x[j])
+        c = diag_jj / lead[j, j]
+        s = x[j] / lead[j, j]
+        lead[j, j] = diag_jj
+        lead[j + 1:, j] = (lead[j + 1:, j] + s * x[j + 1:]) / c
+        x[j + 1:] = c * x[j + 1:] - s * lead[j + 1:, j]
+    return factor
+
+
+def _nbytes(value):
+    """
+    Memory used by a cache entry, an array or a tuple of arrays.
+    """
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+    return np.asarray(value).nbytes
+
+
+class VcmCache(object):
+    """
+    Least recently used cache of factorisations of temporal VCM subsets.
+    Entries are keyed by the packed bitmask of the selected interferograms,
+    so pixels using the same observations in the linear rate and time
+    series inversions share one factorisation.
+
+    The cache only holds numpy arrays and counters, so it can be pickled
+    and handed to joblib workers or MPI processes (see subset).
+    """
+
+    def __init__(self, vcmt, max_mb=256):
+        """
+        :param vcmt: Temporal variance covariance matrix
+        :param max_mb: Maximum memory used by the cached entries in MB
+        """
+        self.vcmt = vcmt
+        self.max_bytes = int(max_mb * 2**20)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, ind):
+        """
+        Returns the packed bitmask of a selection of interferograms.
+
+        :param ind: Indices of the selected interferograms
+        """
+        sel = zeros(len(self.vcmt), dtype=bool)
+        sel[ind] = True
+        return np.packbits(sel).tobytes()
+
+    def get(self, ind, name, func):
+        """
+        Returns func(ind), which is only computed if the entry 'name' of
+        this selection of interferograms is not in the cache.
+
+        :param ind: Indices of the selected interferograms
+        :param name: Name of the cached quantity
+        :param func: Function of ind computing the quantity
+
+        :return Cached or computed value
+        """
+        key = (self.key(ind), name)
+        if key in self._entries:
+            self.hits += 1
+            # move to the most recently used end
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+        self.misses += 1
+        value = func(ind)
+        size = _nbytes(value)
+        if size <= self.max_bytes:
+            self._entries[key] = value
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= _nbytes(old)
+                self.evictions += 1
+        return value
+
+    def factor(self, ind):
+        """
+        Returns the upper triangular factor of vcmt[ind, ind], see
+        vcm_factor.
+
+        :param ind: Indices of the selected interferograms
+        """
+        return self.get(ind, 'factor',
+                        lambda i: vcm_factor(self.vcmt[i, vstack(i)]))
+
+    def inverse_factor(self, ind):
+        """
+        Returns the upper cholesky factor of inv(vcmt[ind, ind]), the
+        inverse of its factor.
+
+        :param ind: Indices of the selected interferograms
+        """
+        return self.get(ind, 'inverse_factor', self._inverse_factor)
+
+    def _inverse_factor(self, ind):
+        """
+        inv(factor), falling back to the pseudo inverse of the VCM when
+        the subset is numerically singular.
+        """
+        try:
+            factor = self.factor(ind)
+        except LinAlgError:
+            return np.linalg.cholesky(
+                np.linalg.pinv(self.vcmt[ind, vstack(ind)])).T
+        return solve_triangular(factor, np.eye(len(ind)))
+
+    def subset(self, mask):
+        """
+        Returns a new cache with the entries needed for the pixels of mask,
+        e.g. the rows or pixels sent to a parallel worker.
+
+        :param mask: Boolean array (nifgs, ...) of selected observations
+
+        :return VcmCache sharing vcmt and limits with this cache
+        """
+        sub = VcmCache(self.vcmt)
+        sub.max_bytes = self.max_bytes
+        if not self._entries:
+            return sub
+        keys = set(self.key(np.nonzero(p)[0])
+                   for p in unique_mask_patterns(mask)[0].T)
+        for key, value in self._entries.items():
+            if key[0] in keys:
+                sub._entries[key] = value
+                sub.nbytes += _nbytes(value)
+        return sub
+
+
+def vcm_cache(vcmt, params):
+    """
+    Returns a VcmCache using the memory limit from the config.
+
+    :param vcmt: Temporal variance covariance matrix
+    :param params: Configuration parameters
+
+    :return VcmCache
+    """
+    max_mb = params.get(cf.VCM_CACHE_SIZE)
+    return VcmCache(vcmt) if max_mb is None else VcmCache(vcmt, max_mb)
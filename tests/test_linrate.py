@@ -33,7 +33,8 @@ from pyrate import config as cf
 from pyrate import ref_phs_est as rpe
 from pyrate import shared
 from pyrate import vcm as vcm_module
-from pyrate.linrate import linear_rate
+from pyrate.linrate import linear_rate, linear_rate_by_groups, \
+    linear_rate_by_pixel
 from pyrate.scripts import run_pyrate, run_prepifg
 from tests.common import SML_TEST_DIR, prepare_ifgs_without_phase
 from tests.common import TEST_CONF_ROIPAC
@@ -76,6 +77,57 @@ class LinearRateTests(unittest.TestCase):
         assert_array_almost_equal(samples, expsamp)
 
 
+class LinearRateByGroupsTests(unittest.TestCase):
+    """
+    Tests the mst pattern grouped solver against the pixel by pixel solver
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(10)
+        self.nifgs, self.rows, self.cols = 6, 4, 5
+        self.span = array([[0.1, 0.7, 0.8, 0.5, 0.7, 0.2]])
+        self.obs = rng.randn(self.nifgs, self.rows, self.cols) * 0.2 + \
+            5.0 * self.span.reshape(self.nifgs, 1, 1)
+        self.obs[2, 0, :] += 10  # outliers for part of a group
+        self.mst = ones((self.nifgs, self.rows, self.cols), dtype=bool)
+        self.mst[4, 1:3, :] = False
+        self.mst[:3, 3, 3:] = False  # below pthresh
+        self.vcmt = eye(6, 6)
+
+    def test_linear_rate_by_groups(self):
+        params = default_params()
+        rate, error, samples = linear_rate_by_groups(
+            self.mst, params['nsig'], self.obs, params['pthr'], self.span,
+            self.vcmt)
+        for r in range(self.rows):
+            for c in range(self.cols):
+                exp = linear_rate_by_pixel(
+                    r, c, self.mst, params['nsig'], self.obs,
+                    params['pthr'], self.span, self.vcmt)
+                np.testing.assert_array_equal(
+                    [rate[r, c], error[r, c], samples[r, c]],
+                    np.array(exp, dtype=np.float32))
+
+    def test_linear_rate_by_groups_correlated_vcm(self):
+        params = default_params()
+        masters = array([0, 0, 1, 1, 2, 3])
+        slaves = array([1, 2, 2, 3, 4, 4])
+        vcmt = vcm_module.vcm_pattern(masters, slaves) * 0.3 + eye(6) * 0.2
+        cache = vcm_module.VcmCache(vcmt)
+        rate, error, samples = linear_rate_by_groups(
+            self.mst, params['nsig'], self.obs, params['pthr'], self.span,
+            vcmt, cache=cache)
+        self.assertGreater(cache.hits, 0)
+        for r in range(self.rows):
+            for c in range(self.cols):
+                exp = linear_rate_by_pixel(
+                    r, c, self.mst, params['nsig'], self.obs,
+                    params['pthr'], self.span, vcmt)
+                np.testing.assert_array_equal(
+                    [rate[r, c], error[r, c], samples[r, c]],
+                    np.array(exp, dtype=np.float32))
+
+
 class MatlabEqualityTest(unittest.TestCase):
     """
     Tests equality vs matlab
@@ -28,6 +28,7 @@ import tempfile
 import random
 import string
 from subprocess import check_output
+from osgeo import gdal
 
 import pyrate.orbital
 import pyrate.shared
@@ -42,6 +43,7 @@ from tests.common import small_data_setup, reconstruct_mst, \
 from tests import common
 from tests.test_vcm import matlab_maxvar
 from pyrate import config as cf
+from pyrate import ifgconstants as ifc
 from pyrate import mpiops
 from pyrate import algorithm
 
@@ -191,6 +193,88 @@ def test_vcm_matlab_vs_mpi(mpisync, tempdir, get_config):
         shutil.rmtree(outdir)
 
 
+def test_gatherv_uneven_splits(mpisync):
+    # process r sends r values, the root sends none
+    arr = np.full(mpiops.rank, mpiops.rank, dtype=np.float64)
+    res = mpiops.gatherv(arr)
+    if mpiops.rank == 0:
+        exp = np.concatenate([np.full(r, r, dtype=np.float64)
+                              for r in range(mpiops.size)])
+        np.testing.assert_array_equal(res, exp)
+    else:
+        assert res is None
+
+
+def test_allreduce_sum_nan_mask_of_some_processes(mpisync):
+    shape = (5, 7)
+    rng = np.random.RandomState(7)
+    masks = [rng.rand(*shape) > 0.6 for _ in range(mpiops.size)]
+    # only the odd processes see NaNs
+    nan_count = np.zeros(shape, dtype=np.int32)
+    if mpiops.rank % 2:
+        nan_count += masks[mpiops.rank]
+    mpiops.allreduce_sum(nan_count)
+    exp = np.zeros(shape, dtype=np.int32)
+    for r in range(1, mpiops.size, 2):
+        exp += masks[r]
+    assert nan_count.dtype == np.int32
+    np.testing.assert_array_equal(nan_count, exp)
+
+
+def test_phase_sum_and_ref_phase_mpi(mpisync, tempdir, get_config,
+                                     ref_est_method):
+    from tests.common import TEST_CONF_ROIPAC
+
+    params_dict = get_config(TEST_CONF_ROIPAC)
+    params_dict[cf.REF_EST_METHOD] = ref_est_method
+    params_dict[cf.PARALLEL] = False
+    outdir = mpiops.run_once(tempdir)
+    params_dict[cf.OUT_DIR] = outdir
+    params_dict[cf.TMPDIR] = os.path.join(outdir, cf.TMPDIR)
+    xlks, _, crop = cf.transform_params(params_dict)
+    base_unw_paths = cf.original_ifg_paths(params_dict[cf.IFG_FILE_LIST])
+    dest_paths = cf.get_dest_paths(base_unw_paths, crop, params_dict, xlks)
+    if mpiops.rank == 0:
+        os.makedirs(params_dict[cf.TMPDIR])
+        run_prepifg.roipac_prepifg(base_unw_paths, params_dict)
+    mpiops.comm.barrier()
+
+    # serial results; the 17 ifgs are split unevenly over most process counts
+    phase = []
+    for p in dest_paths:
+        ifg = shared.Ifg(p)
+        ifg.open(readonly=True)
+        ifg.nodata_value = params_dict[cf.NO_DATA_VALUE]
+        phase.append(ifg.phase_data.copy())
+        ifg.close()
+    comp = np.ravel(np.sum(np.isnan(phase), axis=0) > 0, order='F')
+    np.testing.assert_array_equal(
+        run_pyrate.phase_sum(dest_paths, params_dict), comp)
+
+    refpx, refpy = run_pyrate.ref_pixel_calc(dest_paths, params_dict)
+    if ref_est_method == 1:
+        exp = [rpe.est_ref_phs_method1(ph.copy(), comp) for ph in phase]
+    else:
+        half_chip_size = int(np.floor(params_dict[cf.REF_CHIP_SIZE] / 2.0))
+        chipsize = 2 * half_chip_size + 1
+        thresh = chipsize * chipsize * params_dict[cf.REF_MIN_FRAC]
+        exp = [rpe.est_ref_phs_method2(ph, half_chip_size, refpx, refpy,
+                                       thresh) for ph in phase]
+    run_pyrate.ref_phase_estimation(dest_paths, params_dict, refpx, refpy)
+
+    if mpiops.rank == 0:
+        ref_phs = np.load(os.path.join(params_dict[cf.TMPDIR],
+                                       'ref_phs.npy'))
+        np.testing.assert_array_almost_equal(ref_phs, exp)
+        for p, ph, ref_ph in zip(dest_paths, phase, exp):
+            ifg = shared.Ifg(p)
+            ifg.open(readonly=True)
+            np.testing.assert_array_almost_equal(ifg.phase_data, ph - ref_ph,
+                                                 decimal=4)
+            ifg.close()
+        shutil.rmtree(outdir)
+
+
 @pytest.fixture(params=[1, 2, 5])
 def orbfit_lks(request):
     return request.param
@@ -256,6 +340,11 @@ def test_timeseries_linrate_mpi(mpisync, tempdir, modify_config,
                             rows=row_splits, cols=col_splits)
     postprocessing.postprocess_linrate(row_splits, col_splits, params)
     postprocessing.postprocess_timeseries(row_splits, col_splits, params)
+    # and the multi-band time series outputs
+    params[cf.TIME_SERIES_CUBE] = 1
+    postprocessing.postprocess_timeseries(row_splits, col_splits, params)
+    params[cf.TIME_SERIES_CUBE] = 0
+    mpiops.comm.barrier()
     ifgs_mpi_out_dir = params[cf.OUT_DIR]
     ifgs_mpi = small_data_setup(datafiles=dest_paths)
 
@@ -323,6 +412,18 @@ def test_timeseries_linrate_mpi(mpisync, tempdir, modify_config,
 
         # 12 timeseries outputs
         assert i + 1 == tsincr.shape[2]
+
+        # time series cubes hold the time series outputs as dated bands
+        for out_type, ts in [('tsincr', tsincr_mpi), ('tscuml', tscum_mpi)]:
+            ds = gdal.Open(os.path.join(ifgs_mpi_out_dir, out_type + '.tif'))
+            assert ds.RasterCount == ts.shape[2]
+            for i in range(ts.shape[2]):
+                band = ds.GetRasterBand(i + 1)
+                assert band.GetMetadataItem(ifc.EPOCH_DATE) == \
+                    str(epochlist.dates[i + 1])
+                np.testing.assert_array_almost_equal(band.ReadAsArray(),
+                                                     ts[:, :, i], decimal=4)
+            ds = None
         shutil.rmtree(ifgs_mpi_out_dir)  # remove mpi out dir
         shutil.rmtree(params_old[cf.OUT_DIR])  # remove serial out dir
 
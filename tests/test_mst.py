@@ -23,10 +23,12 @@ import shutil
 import subprocess
 import tempfile
 import unittest
+from datetime import date, timedelta
 from itertools import product
 from numpy import empty, array, nan, isnan, sum as nsum
 
 import numpy as np
+import networkx as nx
 from tests.common import MockIfg, small5_mock_ifgs, small_data_setup
 
 from pyrate import algorithm
@@ -185,6 +187,147 @@ class NetworkxMSTTreeCheck(unittest.TestCase):
         self.assertEqual(2, ntrees)
 
 
+class SyntheticIfg(object):
+    """
+    Interferogram with the attributes used by the MST functions
+    """
+
+    def __init__(self, master, slave, phase_data, nan_fraction):
+        self.master = master
+        self.slave = slave
+        self.phase_data = phase_data
+        self.nan_fraction = nan_fraction
+        self.nrows, self.ncols = phase_data.shape
+
+
+class KruskalMSTTests(unittest.TestCase):
+    """
+    Compares the array based Kruskal MST with the NetworkX reference
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(2)
+        dates = [date(2006, 1, 1) + timedelta(days=35 * i) for i in range(8)]
+        pairs = [(m, s) for m in range(8) for s in range(m + 1, min(m + 4, 8))]
+        self.ifgs = []
+        for k, (m, s) in enumerate(pairs):
+            phase = rng.randn(6, 7)
+            phase[rng.rand(6, 7) < 0.3] = nan
+            # distinct weights, so that the MST of each pixel is unique
+            self.ifgs.append(SyntheticIfg(
+                dates[m], dates[s], phase, 0.01 * k))
+        for i in self.ifgs:
+            i.phase_data[0, 0] = nan  # all nan pixel
+        self.ifgs[0].phase_data[0, 0] = 1.0
+
+    def test_mst_boolean_array(self):
+        exp = mst.mst_boolean_array_networkx(self.ifgs)
+        res = mst.mst_boolean_array(self.ifgs)
+        np.testing.assert_array_equal(res, exp)
+        np.testing.assert_array_equal(res[:, 0, 0],
+                                      np.arange(len(self.ifgs)) == 0)
+
+    def test_repeated_nan_signatures(self):
+        # pixels with the same nan signature share one mst computation
+        for i in self.ifgs:
+            i.phase_data = np.tile(i.phase_data[:2, :3], (3, 2))
+        exp = mst.mst_boolean_array_networkx(self.ifgs)
+        np.testing.assert_array_equal(mst.mst_boolean_array(self.ifgs), exp)
+
+    def test_tied_weights(self):
+        # repeated nan fractions, as found in real stacks: any spanning
+        # forest of minimum weight is an MST, the NetworkX one may differ
+        for k, i in enumerate(self.ifgs):
+            i.nan_fraction = 0.1 * (k % 3)
+        res = mst.mst_boolean_array(self.ifgs)
+        weights = np.array([i.nan_fraction for i in self.ifgs])
+        no_y, no_x = self.ifgs[0].phase_data.shape
+        for y, x in product(range(no_y), range(no_x)):
+            valid = [k for k, i in enumerate(self.ifgs)
+                     if not isnan(i.phase_data[y, x])]
+            graph = _graph(self.ifgs, valid)
+            tree = _graph(self.ifgs, np.nonzero(res[:, y, x])[0])
+            # a spanning forest of the valid ifgs
+            self.assertTrue(set(np.nonzero(res[:, y, x])[0]) <= set(valid))
+            self.assertTrue(nx.is_forest(tree) if len(tree) else True)
+            self.assertEqual(
+                sorted(sorted(c) for c in nx.connected_components(graph)),
+                sorted(sorted(c) for c in nx.connected_components(tree)))
+            # of minimum total weight
+            exp = sum(d['weight'] for _, _, d in
+                      nx.minimum_spanning_edges(graph, data=True))
+            self.assertAlmostEqual(weights[res[:, y, x]].sum(), exp)
+
+    def test_tie_break_in_ifg_order(self):
+        # three ifgs of equal weight closing a loop, the last one is dropped
+        dates = [date(2006, 1, 1) + timedelta(days=35 * i) for i in range(3)]
+        phase = np.ones((1, 1))
+        for pairs, exp in [([(0, 1), (1, 2), (0, 2)], [True, True, False]),
+                           ([(0, 2), (0, 1), (1, 2)], [True, True, False]),
+                           ([(1, 2), (0, 2), (0, 1)], [True, True, False])]:
+            ifgs = [SyntheticIfg(dates[m], dates[s], phase.copy(), 0.2)
+                    for m, s in pairs]
+            np.testing.assert_array_equal(
+                mst.mst_boolean_array(ifgs)[:, 0, 0], exp)
+        # a lower weight still comes first
+        ifgs[2].nan_fraction = 0.1
+        np.testing.assert_array_equal(mst.mst_boolean_array(ifgs)[:, 0, 0],
+                                      [True, False, True])
+
+
+def _graph(ifgs, indices):
+    """Graph of the epochs connected by the given ifgs"""
+    graph = nx.Graph()
+    graph.add_weighted_edges_from([(ifgs[k].master, ifgs[k].slave,
+                                    ifgs[k].nan_fraction) for k in indices])
+    return graph
+
+
+class PackedMstTests(unittest.TestCase):
+    """
+    Tests the bit-packed MST matrix
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(4)
+        self.mst = rng.rand(11, 5, 6) > 0.5
+        self.packed = mst.PackedMst.pack(self.mst)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_packed_size(self):
+        self.assertEqual(self.packed.packed.nbytes, 2 * 5 * 6)
+        self.assertEqual(self.packed.shape, self.mst.shape)
+
+    def test_indexing(self):
+        np.testing.assert_array_equal(self.packed[:, 2, 3], self.mst[:, 2, 3])
+        np.testing.assert_array_equal(self.packed[:, 1], self.mst[:, 1])
+        np.testing.assert_array_equal(self.packed[3:9, 1:4, 2],
+                                      self.mst[3:9, 1:4, 2])
+        np.testing.assert_array_equal(np.asarray(self.packed), self.mst)
+
+    def test_setitem(self):
+        self.packed[:, 0, 0] = False
+        self.mst[:, 0, 0] = False
+        np.testing.assert_array_equal(self.packed[:], self.mst)
+
+    def test_setitem_mask(self):
+        mask = np.random.RandomState(5).rand(*self.mst.shape) > 0.7
+        self.packed[mask] = 0
+        self.mst[mask] = 0
+        np.testing.assert_array_equal(self.packed[:], self.mst)
+        self.packed[mask] = True
+        self.mst[mask] = True
+        np.testing.assert_array_equal(self.packed[:], self.mst)
+
+    def test_save_load(self):
+        path = os.path.join(self.tmp_dir, 'mst_mat_0.npz')
+        self.packed.save(path)
+        np.testing.assert_array_equal(mst.PackedMst.load(path)[:], self.mst)
+
+
 class IfgPartTest(unittest.TestCase):
 
     def setUp(self):
@@ -34,10 +34,13 @@ from scipy.linalg import lstsq
 from .common import small5_mock_ifgs, MockIfg
 from pyrate import algorithm
 from pyrate import config as cf
+from pyrate import ifgconstants as ifc
+from pyrate import shared
 from pyrate.orbital import INDEPENDENT_METHOD, NETWORK_METHOD, PLANAR, \
     QUADRATIC, PART_CUBIC
 from pyrate.orbital import OrbitalError, orbital_correction
 from pyrate.orbital import get_design_matrix, get_network_design_matrix
+from pyrate.orbital import network_normal_equations, OrbitalFit
 from pyrate.orbital import _get_num_params, remove_orbital_error
 from pyrate.shared import Ifg
 from pyrate.shared import nanmedian
@@ -249,6 +252,44 @@ class IndependentCorrectionTests(unittest.TestCase):
     def test_independent_correction_partcubic_offsets(self):
         self.check_correction(PART_CUBIC, INDEPENDENT_METHOD, True, decimal=1)
 
+    def test_orbital_fit_matches_lstsq(self):
+        ifg = self.ifgs[0]
+        dm = get_design_matrix(ifg, PLANAR, True)
+        fit = OrbitalFit(dm)
+        vphase = ifg.phase_data.reshape(ifg.num_cells).astype(np.float64)
+        # NaN moments subtracted from the full grid
+        for nnan in [0, 4, 8]:
+            data = vphase.copy()
+            data[:nnan] = nan
+            valid = ~isnan(data)
+            exp = lstsq(dm[valid].astype(np.float64), data[valid])[0]
+            assert_array_almost_equal(fit.solve(data), exp, decimal=4)
+
+        # more than half the cells NaN, the moments of the valid cells
+        data = vphase.copy()
+        data[np.random.RandomState(2).rand(len(data)) < 0.7] = nan
+        self.assertGreater(2 * np.count_nonzero(isnan(data)), len(data))
+        valid = ~isnan(data)
+        exp = lstsq(dm[valid].astype(np.float64), data[valid])[0]
+        assert_array_almost_equal(fit.solve(data), exp, decimal=4)
+
+    def test_orbital_fit_singular_design(self):
+        ifg = self.ifgs[0]
+        dm = get_design_matrix(ifg, PLANAR, True)
+        fit = OrbitalFit(dm)
+        phase = ifg.phase_data.astype(np.float64)
+        # all valid cells on one row or one column, so the offset and one
+        # of the slopes can't be told apart and lstsq is the fallback
+        row = np.argmax(np.sum(~isnan(phase), axis=1))
+        col = np.argmax(np.sum(~isnan(phase), axis=0))
+        for sel in [np.s_[row, :], np.s_[:, col]]:
+            data = np.empty_like(phase) * nan
+            data[sel] = phase[sel]
+            data = data.reshape(ifg.num_cells)
+            valid = ~isnan(data)
+            exp = lstsq(dm[valid].astype(np.float64), data[valid])[0]
+            assert_array_almost_equal(fit.solve(data), exp, decimal=4)
+
 
 class ErrorTests(unittest.TestCase):
     """Tests for the networked correction method"""
@@ -393,6 +434,27 @@ class NetworkDesignMatrixTests(unittest.TestCase):
                 assert_array_equal(0, dm[ib1:ib2, np:ip1]) # cols before offset col
                 assert_array_equal(0, dm[ib1:ib2, ip1 + 1:]) # cols after offset col
 
+    def test_normal_equations(self):
+        data = concatenate([i.phase_data.reshape(self.ncells)
+                            for i in self.ifgs])
+        for deg in [PLANAR, QUADRATIC, PART_CUBIC]:
+            for offset in [False, True]:
+                dm = get_network_design_matrix(self.ifgs, deg, offset)
+                dm = dm[~isnan(data)].astype(np.float64)
+                norm_mat, rhs = network_normal_equations(self.ifgs, deg,
+                                                         offset)
+                assert_array_almost_equal(norm_mat, dm.T.dot(dm))
+                assert_array_almost_equal(rhs, dm.T.dot(data[~isnan(data)]))
+
+    def test_normal_equations_of_subsets_add_up(self):
+        ids = get_date_ids(self.ifgs)
+        exp = network_normal_equations(self.ifgs, QUADRATIC, True)
+        parts = [network_normal_equations(self.ifgs[k:k + 2], QUADRATIC, True,
+                                          ids, range(k, k + 2), self.nifgs)
+                 for k in range(0, self.nifgs, 2)]
+        assert_array_almost_equal(sum(p[0] for p in parts), exp[0])
+        assert_array_almost_equal(sum(p[1] for p in parts), exp[1])
+
 
 # components for network correction testing
 def network_correction(ifgs, deg, off, ml_ifgs=None, tol=1e-6):
@@ -407,10 +469,12 @@ def network_correction(ifgs, deg, off, ml_ifgs=None, tol=1e-6):
         ml_nc = ml_ifgs[0].num_cells
         ml_data = concatenate([i.phase_data.reshape(ml_nc) for i in ml_ifgs])
         dm = get_network_design_matrix(ml_ifgs, deg, off)[~isnan(ml_data)]
+        dm = dm.astype(np.float64)
         fd = ml_data[~isnan(ml_data)].reshape((dm.shape[0], 1))
     else:
         data = concatenate([i.phase_data.reshape(ncells) for i in ifgs])
         dm = get_network_design_matrix(ifgs, deg, off)[~isnan(data)]
+        dm = dm.astype(np.float64)
         fd = data[~isnan(data)].reshape((dm.shape[0], 1))
 
     params = pinv(dm, tol).dot(fd)
@@ -746,6 +810,65 @@ class MatlabComparisonTestsOrbfitMethod1(unittest.TestCase):
         self.assertEqual(count, len(self.ifg_paths))
 
 
+class MatlabComparisonTestsOrbfitMethod1Parallel(
+        MatlabComparisonTestsOrbfitMethod1):
+    """
+    Matlab comparison of the independent method, correcting the
+    interferograms in parallel processes
+    """
+
+    def setUp(self):
+        super(MatlabComparisonTestsOrbfitMethod1Parallel, self).setUp()
+        self.params[cf.PARALLEL] = True
+        self.params[cf.PROCESSES] = 2
+
+
+class OrbfitStackTests(unittest.TestCase):
+    """
+    Tests the orbital corrections written through to an IfgStack
+    """
+
+    def setUp(self):
+        self.BASE_DIR = tempfile.mkdtemp()
+        self.params = cf.get_config_params(TEST_CONF_ROIPAC)
+        self.params[cf.ORBITAL_FIT_METHOD] = 1
+        self.params[cf.PARALLEL] = False
+        self.params[cf.TMPDIR] = join(self.BASE_DIR, cf.TMPDIR)
+        self.ifg_paths = []
+        for d in small_ifg_file_list():
+            d_copy = join(self.BASE_DIR, os.path.basename(d))
+            shutil.copy(d, d_copy)
+            os.chmod(d_copy, 0o660)
+            self.ifg_paths.append(d_copy)
+        ifg = Ifg(self.ifg_paths[0])
+        ifg.open()
+        self.tiles = shared.create_tiles(ifg.shape, 2, 3)
+        ifg.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.BASE_DIR)
+
+    def test_independent_correction_stack(self):
+        shared.save_numpy_phase(self.ifg_paths, self.tiles, self.params,
+                                convert=True)
+        stack = shared.IfgStack(self.params[cf.TMPDIR], self.tiles)
+        remove_orbital_error(self.ifg_paths, self.params, stack=stack)
+        for p in self.ifg_paths:
+            ifg = Ifg(p)
+            ifg.open()
+            self.assertIsNone(
+                ifg.dataset.GetMetadataItem(ifc.PYRATE_ORBITAL_ERROR))
+            ifg.close()
+
+        remove_orbital_error(self.ifg_paths, self.params)
+        for p in self.ifg_paths:
+            ifg = Ifg(p)
+            ifg.open()
+            assert_array_almost_equal(stack.read(p), ifg.phase_data,
+                                      decimal=4)
+            ifg.close()
+
+
 class MatlabComparisonTestsOrbfitMethod2(unittest.TestCase):
     """
     This is the matlab comparison test of orbital correction functionality.
@@ -443,6 +443,20 @@ class ThresholdTests(unittest.TestCase):
             res = resample(data, xscale=3, yscale=3, thresh=thresh)
             assert_array_equal(res, reshape(exp, res.shape))
 
+    @staticmethod
+    def test_resample_row_bands():
+        # averaging in bands of output rows matches the whole array, and
+        # cells beyond the last whole block are ignored
+        data = np.arange(17 * 11, dtype=np.float32).reshape(17, 11)
+        data[::4, 1::3] = nan
+        exp = resample(data, xscale=3, yscale=2, thresh=0.5)
+        assert exp.shape == (8, 3)
+        assert_array_almost_equal(exp[0, 0], np.mean([0, 2, 11, 12, 13]))
+        for band_rows in [1, 3, 8, 20]:
+            res = resample(data, xscale=3, yscale=2, thresh=0.5,
+                           band_rows=band_rows)
+            assert_array_equal(res, exp)
+
 
 class SameSizeTests(unittest.TestCase):
     """Tests aspects of the prepifg.py script, such as resampling."""
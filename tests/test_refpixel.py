@@ -21,9 +21,12 @@ import unittest
 import tempfile
 import shutil
 from numpy import nan, mean, std, isnan
+import numpy as np
 
 from pyrate import config as cf
-from pyrate.refpixel import ref_pixel, step
+from pyrate.refpixel import ref_pixel, step, chip_sds, dense_grid, \
+    ref_pixel_multi, ref_pixel_surface, ref_pixel_sds, chip_mean_sds, \
+    filter_means
 from pyrate.scripts import run_pyrate
 from tests.common import TEST_CONF_ROIPAC
 from tests.common import small_data_setup, MockIfg, small_ifg_file_list
@@ -194,6 +197,83 @@ class ReferencePixelTests(unittest.TestCase):
         res = ref_pixel(self.ifgs, self.params)
         self.assertEqual(res, exp_refpx)
 
+    def test_dense_ref_pixel(self):
+        # every third pixel is scored, compare against chip by chip means
+        self.params[cf.REF_CHIP_SIZE] = 5
+        self.params[cf.REF_STRIDE] = 3
+        res = ref_pixel(self.ifgs, self.params)
+
+        rows, cols = self.ifgs[0].shape
+        grid = dense_grid(rows, cols, 2, 3)
+        self.assertEqual(grid[0].tolist(), [2, 2])
+        self.assertEqual(grid[1].tolist(), [2, 5])
+        phase_data = [i.phase_data for i in self.ifgs]
+        thresh = MIN_FRAC * 25
+        means = [ref_pixel_multi(g, 2, phase_data, thresh, self.params)
+                 for g in grid]
+        self.assertEqual(res, tuple(grid[np.nanargmin(means)]))
+
+        surface = ref_pixel_surface(np.array(means), grid, (rows, cols))
+        np.testing.assert_array_almost_equal(surface[2:rows - 2:3,
+                                                     2:cols - 2:3].ravel(),
+                                             means, decimal=4)
+        self.assertTrue(isnan(surface[3, 3]))
+
+
+class ChipStatisticsTests(unittest.TestCase):
+    """
+    Tests the integral image chip statistics against chip by chip values
+    """
+
+    def test_chip_sds(self):
+        rng = np.random.RandomState(5)
+        data = rng.randn(30, 25) * 4 + 50
+        data[rng.rand(30, 25) < 0.2] = nan
+        data[:7, :7] = 1.5  # constant chips
+        half_patch_size = 2
+        ys, xs = np.meshgrid(np.arange(2, 28), np.arange(2, 23),
+                             indexing='ij')
+        count, sd = chip_sds(data, ys.ravel(), xs.ravel(), half_patch_size)
+        for y, x, c, s in zip(ys.ravel(), xs.ravel(), count, sd):
+            chip = data[y - half_patch_size:y + half_patch_size + 1,
+                        x - half_patch_size:x + half_patch_size + 1]
+            self.assertEqual(c, np.sum(~isnan(chip)))
+            self.assertAlmostEqual(s, std(chip[~isnan(chip)]))
+
+    def test_chip_sds_float32(self):
+        # gdal phase data is float32, flat and low variance patches far
+        # from the image mean are the chips the search selects
+        rng = np.random.RandomState(7)
+        half_patch_size = 3
+        phase_data = []
+        for _ in range(10):
+            data = (rng.randn(60, 80) * 3 + 40).astype(np.float32)
+            data[rng.rand(60, 80) < 0.1] = nan
+            data[5:25, 50:75] = 90 + rng.randn(20, 25) * 1e-3
+            data[38:45, 58:65] = -12.5  # one flat chip, centred at (41, 61)
+            phase_data.append(data)
+        grid = dense_grid(60, 80, half_patch_size, 1)
+        ys, xs = grid.T
+
+        count, sd = chip_sds(phase_data[0], ys, xs, half_patch_size)
+        exp = []
+        for y, x in grid:
+            chip = phase_data[0][y - half_patch_size:y + half_patch_size + 1,
+                                 x - half_patch_size:x + half_patch_size + 1]
+            exp.append(std(chip[~isnan(chip)].astype(np.float64)))
+        np.testing.assert_allclose(sd, exp, rtol=1e-6, atol=1e-8)
+        flat = np.flatnonzero(np.all(grid == [41, 61], axis=1))[0]
+        self.assertEqual(sd[flat], 0)
+
+        thresh = 0.5 * 49
+        sd_sum, ninvalid = ref_pixel_sds(grid, half_patch_size, phase_data,
+                                         thresh, None)
+        res = filter_means(chip_mean_sds(sd_sum, ninvalid, 10), grid)
+        means = [ref_pixel_multi(g, half_patch_size, phase_data, thresh, None)
+                 for g in grid]
+        self.assertEqual(res, (41, 61))
+        self.assertEqual(res, tuple(grid[np.nanargmin(means)]))
+
 
 def _expected_ref_pixel(ifgs, cs):
     """Helper function for finding reference pixel when refnx/y=2"""
@@ -19,9 +19,11 @@ This Python module contains tests for the shared.py PyRate module.
 
 import os
 import shutil
+import struct
 import sys
 import tempfile
 import unittest
+from datetime import date, time
 from itertools import product
 from numpy import isnan, where, nan
 from os.path import join, basename, exists
@@ -38,7 +40,7 @@ from pyrate import gamma
 from pyrate import ifgconstants as ifc
 from pyrate import prepifg
 from pyrate import shared
-from pyrate.scripts import run_prepifg
+from pyrate.scripts import run_prepifg, postprocessing
 from pyrate.shared import Ifg, DEM, RasterException
 from pyrate.shared import cell_size, utm_zone
 
@@ -491,6 +493,119 @@ class WriteUnwTest(unittest.TestCase):
                     geotif_or_data=g, dest_unw=dest_unw, ifg_proc=0)
 
 
+def _row_by_row_raw_data(data_path, ifg_proc, is_ifg, ncols, nrows):
+    """
+    Reads a GAMMA or ROI_PAC binary one row at a time with struct, as
+    write_geotiff did before the memory mapped reader
+    """
+    if ifg_proc == shared.GAMMA:
+        fmtstr, bytes_per_col = '!' + ('f' * ncols), 4
+    elif is_ifg:
+        fmtstr, bytes_per_col = '<' + ('f' * ncols), 4
+    else:
+        fmtstr, bytes_per_col = '<' + ('h' * ncols), 2
+    row_bytes = ncols * bytes_per_col
+    rows = []
+    with open(data_path, 'rb') as f:
+        for _ in range(nrows):
+            if ifg_proc == shared.ROIPAC and is_ifg:
+                f.seek(row_bytes, 1)  # skip interleaved amplitude band
+            rows.append(struct.unpack(fmtstr, f.read(row_bytes)))
+    return np.array(rows, dtype=np.float32 if bytes_per_col == 4
+                    else np.int16)
+
+
+class RawBinaryBlockTests(unittest.TestCase):
+    """
+    Tests the memory mapped binary reader of write_geotiff and the block
+    writer of write_unw_from_data_or_geotiff against row by row struct
+    conversion, with blocks that don't divide the number of rows
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.nrows, self.ncols = 100, 47
+        self.rng = np.random.RandomState(11)
+        self.block_bytes = shared.WRITE_BLOCK_BYTES
+        # blocks of 3 rows
+        shared.WRITE_BLOCK_BYTES = 3 * self.ncols * 4
+
+    def tearDown(self):
+        shared.WRITE_BLOCK_BYTES = self.block_bytes
+        shutil.rmtree(self.tmp_dir)
+
+    def _binary(self, ifg_proc, is_ifg):
+        path = join(self.tmp_dir, '{}_{}.bin'.format(ifg_proc, is_ifg))
+        shape = (self.nrows, self.ncols)
+        if ifg_proc == shared.GAMMA:
+            data = self.rng.randn(*shape).astype('>f4')
+        elif is_ifg:
+            # amplitude and phase rows interleaved
+            data = self.rng.randn(self.nrows, 2 * self.ncols).astype('<f4')
+        else:
+            data = self.rng.randint(-500, 3000, shape).astype('<i2')
+        data.tofile(path)
+        return path
+
+    def _header(self, ifg_proc, is_ifg):
+        header = {ifc.PYRATE_INSAR_PROCESSOR: ifg_proc,
+                  ifc.PYRATE_NCOLS: self.ncols, ifc.PYRATE_NROWS: self.nrows,
+                  ifc.PYRATE_LONG: 150.9, ifc.PYRATE_LAT: -34.2,
+                  ifc.PYRATE_X_STEP: 0.000833, ifc.PYRATE_Y_STEP: -0.000833,
+                  ifc.PYRATE_DATUM: 'WGS84'}
+        if is_ifg:
+            header.update({
+                ifc.PYRATE_WAVELENGTH_METRES: 0.0562,
+                ifc.PYRATE_TIME_SPAN: 0.287,
+                ifc.MASTER_DATE: date(2006, 6, 19),
+                ifc.SLAVE_DATE: date(2006, 10, 2), ifc.DATA_UNITS: 'RADIANS',
+                ifc.DATA_TYPE: ifc.ORIG, ifc.MASTER_TIME: time(10),
+                ifc.SLAVE_TIME: time(10), ifc.PYRATE_INCIDENCE_DEGREES: 34.6})
+        return header
+
+    def test_raw_data_matches_row_reader(self):
+        for ifg_proc, is_ifg in [(shared.GAMMA, True), (shared.ROIPAC, True),
+                                 (shared.ROIPAC, False)]:
+            path = self._binary(ifg_proc, is_ifg)
+            assert_array_equal(
+                shared._raw_data(path, ifg_proc, is_ifg, self.ncols,
+                                 self.nrows),
+                _row_by_row_raw_data(path, ifg_proc, is_ifg, self.ncols,
+                                     self.nrows))
+
+    def test_write_geotiff_matches_row_reader(self):
+        for ifg_proc, is_ifg in [(shared.GAMMA, True), (shared.ROIPAC, True),
+                                 (shared.ROIPAC, False)]:
+            path = self._binary(ifg_proc, is_ifg)
+            dest = join(self.tmp_dir, '{}_{}.tif'.format(ifg_proc, is_ifg))
+            shared.write_geotiff(self._header(ifg_proc, is_ifg), path, dest,
+                                 np.nan if is_ifg else 0)
+            ds = gdal.Open(dest)
+            assert_array_equal(ds.ReadAsArray(), _row_by_row_raw_data(
+                path, ifg_proc, is_ifg, self.ncols, self.nrows))
+            ds = None
+
+    def test_write_unw_matches_row_writer(self):
+        self.assertNotEqual(self.nrows % 3, 0)
+        data = self.rng.randn(self.nrows, self.ncols)
+        dest = join(self.tmp_dir, 'data.unw')
+        shared.write_unw_from_data_or_geotiff(data, dest, ifg_proc=1)
+        fmtstr = '!' + ('f' * self.ncols)
+        exp = b''.join(struct.pack(fmtstr, *row) for row in data)
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), exp)
+
+    def test_write_unw_from_geotiff_round_trip(self):
+        path = self._binary(shared.GAMMA, True)
+        tif = join(self.tmp_dir, 'gamma.tif')
+        shared.write_geotiff(self._header(shared.GAMMA, True), path, tif,
+                             np.nan)
+        dest = join(self.tmp_dir, 'gamma.unw')
+        shared.write_unw_from_data_or_geotiff(tif, dest, ifg_proc=1)
+        with open(dest, 'rb') as f, open(path, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+
 class GeodesyTests(unittest.TestCase):
 
     def test_utm_zone(self):
@@ -537,5 +652,236 @@ class GeodesyTests(unittest.TestCase):
                 self.assertTrue(s < exp_high, msg="size=%s" % s)
 
 
+class TileCubeTests(unittest.TestCase):
+    """
+    Tests the tile cubes written by save_numpy_phase and read by IfgPart
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.ifg_paths = []
+        for p in common.small_ifg_file_list()[:4]:
+            shutil.copy(p, self.tmp_dir)
+            self.ifg_paths.append(join(self.tmp_dir, basename(p)))
+        self.params = {cf.TMPDIR: join(self.tmp_dir, cf.TMPDIR)}
+        ifg = Ifg(self.ifg_paths[0])
+        ifg.open()
+        self.tiles = shared.create_tiles(ifg.shape, 2, 3)
+        ifg.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_ifg_part_reads_tile_cube(self):
+        shared.save_numpy_phase(self.ifg_paths, self.tiles, self.params)
+        ifg_dict = {shared.CUBE_INDEX:
+                    shared.tile_cube_index(self.params[cf.TMPDIR])}
+        phase = {}
+        for p in self.ifg_paths:
+            ifg = Ifg(p)
+            ifg.open()
+            phase[p] = ifg.phase_data
+            ifg_dict[p] = shared.PrereadIfg(
+                path=p, nan_fraction=ifg.nan_fraction, master=ifg.master,
+                slave=ifg.slave, time_span=ifg.time_span, nrows=ifg.nrows,
+                ncols=ifg.ncols, metadata=ifg.meta_data)
+            ifg.close()
+
+        for t in self.tiles:
+            for p in self.ifg_paths:
+                part = shared.IfgPart(p, t, ifg_dict)
+                self.assertIsInstance(part.phase_data, np.memmap)
+                assert_array_equal(
+                    part.phase_data,
+                    phase[p][t.top_left_y:t.bottom_right_y,
+                             t.top_left_x:t.bottom_right_x])
+
+    def test_ifg_stack_write_and_parts(self):
+        shared.save_numpy_phase(self.ifg_paths, self.tiles, self.params)
+        stack = shared.IfgStack(self.params[cf.TMPDIR], self.tiles)
+        ifg_dict = {shared.CUBE_INDEX: stack.index}
+        for p in self.ifg_paths:
+            ifg = Ifg(p)
+            ifg.open()
+            ifg_dict[p] = shared.PrereadIfg(
+                path=p, nan_fraction=ifg.nan_fraction, master=ifg.master,
+                slave=ifg.slave, time_span=ifg.time_span, nrows=ifg.nrows,
+                ncols=ifg.ncols, metadata=ifg.meta_data)
+            if p == self.ifg_paths[1]:
+                data = ifg.phase_data + 1.5
+            shape = ifg.shape
+            ifg.close()
+        self.assertEqual(stack.shape, (4,) + shape)
+        stack.write(self.ifg_paths[1], data)
+        for t in self.tiles:
+            parts = stack.parts(t, self.ifg_paths, ifg_dict)
+            self.assertEqual(len(parts), 4)
+            assert_array_equal(parts[1].phase_data,
+                               data[t.top_left_y:t.bottom_right_y,
+                                    t.top_left_x:t.bottom_right_x])
+            self.assertEqual(parts[1].master,
+                             ifg_dict[self.ifg_paths[1]].master)
+
+    def test_ifg_stack_read_converted(self):
+        self.params[cf.NAN_CONVERSION] = 1
+        self.params[cf.NO_DATA_VALUE] = 0.0
+        shared.save_numpy_phase(self.ifg_paths, self.tiles, self.params,
+                                convert=True)
+        stack = shared.IfgStack(self.params[cf.TMPDIR], self.tiles)
+        for p in self.ifg_paths:
+            ifg = shared.prepare_ifg(p, self.params)
+            data = stack.read(p)
+            self.assertEqual(data.shape, ifg.shape)
+            assert_array_equal(data, ifg.phase_data.astype(np.float32))
+            ifg.close()
+
+    def test_ifg_stack_read_nonzero_nodata(self):
+        # nodata cells are NaNs in the stack without nan conversion too
+        self.params[cf.NAN_CONVERSION] = 0
+        self.params[cf.NO_DATA_VALUE] = -99.0
+        ifg = Ifg(self.ifg_paths[0])
+        ifg.open(readonly=False)
+        data = ifg.phase_data
+        data[3:6, 2:9] = -99.0
+        ifg.write_modified_phase(data=data)
+        ifg.close()
+        shared.save_numpy_phase(self.ifg_paths, self.tiles, self.params,
+                                convert=True)
+        stack = shared.IfgStack(self.params[cf.TMPDIR], self.tiles)
+        ifg = shared.prepare_ifg(self.ifg_paths[0], self.params)
+        expected = ifg.phase_data.astype(np.float32)
+        ifg.close()
+        expected[3:6, 2:9] = np.nan
+        assert_array_equal(stack.read(self.ifg_paths[0]), expected)
+
+
+class GeotiffWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.ifg = Ifg(SML_TEST_TIF)
+        self.ifg.open(readonly=True)
+        self.data = np.random.rand(*self.ifg.shape).astype(np.float32)
+        self.md = {ifc.DATA_TYPE: ifc.LINRATE}
+        self.params = {cf.OUTPUT_TILED: 1, cf.OUTPUT_BLOCK_SIZE: 16,
+                       cf.OUTPUT_COMPRESSION: 'DEFLATE', cf.OUTPUT_COG: 0,
+                       cf.PROCESSES: 2}
+
+    def tearDown(self):
+        self.ifg.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_creation_options(self):
+        self.assertEqual(shared.geotiff_creation_options(None), [])
+        options = shared.geotiff_creation_options(self.params)
+        self.assertIn('TILED=YES', options)
+        self.assertIn('BLOCKXSIZE=16', options)
+        self.assertIn('COMPRESS=DEFLATE', options)
+        self.assertNotIn('COMPRESS=DEFLATE', shared.geotiff_creation_options(
+            self.params, tiled_only=True))
+
+    def _write_tiles(self, dest):
+        tiles = shared.create_tiles(self.ifg.shape, 3, 4)
+        gt = self.ifg.dataset.GetGeoTransform()
+        wkt = self.ifg.dataset.GetProjection()
+        writer = shared.GeotiffWriter(self.md, gt, wkt, self.ifg.shape, dest,
+                                      np.nan, self.params)
+        for t in tiles:
+            writer.write_tile(self.data[t.top_left_y:t.bottom_right_y,
+                                        t.top_left_x:t.bottom_right_x], t)
+        writer.close()
+        return gdal.Open(dest)
+
+    def test_tiled_compressed_output(self):
+        ds = self._write_tiles(join(self.tmpdir, 'tiled.tif'))
+        band = ds.GetRasterBand(1)
+        assert_array_equal(band.ReadAsArray(), self.data)
+        self.assertEqual(band.GetBlockSize(), [16, 16])
+        self.assertEqual(
+            ds.GetMetadata('IMAGE_STRUCTURE')['COMPRESSION'], 'DEFLATE')
+        self.assertEqual(ds.GetMetadataItem(ifc.DATA_TYPE), ifc.LINRATE)
+
+    def test_cloud_optimised_output(self):
+        self.params[cf.OUTPUT_COG] = 1
+        dest = join(self.tmpdir, 'cog.tif')
+        ds = self._write_tiles(dest)
+        band = ds.GetRasterBand(1)
+        assert_array_equal(band.ReadAsArray(), self.data)
+        self.assertGreater(band.GetOverviewCount(), 0)
+        self.assertFalse(exists(dest + '.tmp'))
+
+    def test_multi_band_output(self):
+        dates = ['2006-06-19', '2006-10-02', '2007-01-15']
+        cube = np.random.rand(*(self.ifg.shape + (3,))).astype(np.float32)
+        dest = join(self.tmpdir, 'cube.tif')
+        writer = shared.GeotiffWriter(
+            self.md, self.ifg.dataset.GetGeoTransform(),
+            self.ifg.dataset.GetProjection(), self.ifg.shape, dest, np.nan,
+            self.params, band_md=[{ifc.EPOCH_DATE: d} for d in dates])
+        for t in shared.create_tiles(self.ifg.shape, 3, 4):
+            writer.write_tile(cube[t.top_left_y:t.bottom_right_y,
+                                   t.top_left_x:t.bottom_right_x], t)
+        writer.close()
+        ds = gdal.Open(dest)
+        self.assertEqual(ds.RasterCount, 3)
+        for i, d in enumerate(dates):
+            band = ds.GetRasterBand(i + 1)
+            assert_array_equal(band.ReadAsArray(), cube[:, :, i])
+            self.assertEqual(band.GetMetadataItem(ifc.EPOCH_DATE), d)
+
+    def test_save_timeseries_cube(self):
+        dates = [date(2006, 6, 19), date(2006, 10, 2), date(2007, 1, 15),
+                 date(2007, 3, 26)]
+        params = dict(self.params)
+        params[cf.OUT_DIR] = self.tmpdir
+        params[cf.TMPDIR] = join(self.tmpdir, cf.TMPDIR)
+        os.mkdir(params[cf.TMPDIR])
+        tiles = shared.create_tiles(self.ifg.shape, 3, 4)
+        cube = np.random.rand(*(self.ifg.shape + (3,))).astype(np.float32)
+        for t in tiles:
+            np.save(join(params[cf.TMPDIR], 'tscuml_{}.npy'.format(t.index)),
+                    cube[t.top_left_y:t.bottom_right_y,
+                         t.top_left_x:t.bottom_right_x])
+        md = {ifc.DATA_TYPE: ifc.ORIG, 'SEQUENCE_POSITION': 1}
+        ifgs_dict = {
+            'gt': self.ifg.dataset.GetGeoTransform(), 'md': md,
+            'wkt': self.ifg.dataset.GetProjection(),
+            'epochlist': shared.EpochList(dates=dates),
+            SML_TEST_TIF: shared.PrereadIfg(
+                path=SML_TEST_TIF, nan_fraction=0.0, master=dates[0],
+                slave=dates[1], time_span=0.287, nrows=self.ifg.nrows,
+                ncols=self.ifg.ncols, metadata={})}
+        postprocessing.save_timeseries_cube(ifgs_dict, params, tiles,
+                                            'tscuml')
+        # the preread metadata is not modified
+        self.assertEqual(md, {ifc.DATA_TYPE: ifc.ORIG,
+                              'SEQUENCE_POSITION': 1})
+        ds = gdal.Open(join(self.tmpdir, 'tscuml.tif'))
+        self.assertEqual(ds.RasterCount, 3)
+        self.assertEqual(ds.GetMetadataItem(ifc.DATA_TYPE), ifc.CUML)
+        self.assertIsNone(ds.GetMetadataItem(ifc.EPOCH_DATE))
+        self.assertIsNone(ds.GetMetadataItem('SEQUENCE_POSITION'))
+        for i, d in enumerate(dates[1:]):
+            band = ds.GetRasterBand(i + 1)
+            self.assertEqual(band.GetMetadataItem(ifc.EPOCH_DATE), str(d))
+            self.assertEqual(band.GetMetadataItem('SEQUENCE_POSITION'),
+                             str(i + 1))
+            data = band.ReadAsArray()
+            for t in tiles:
+                ts_tile = np.load(join(params[cf.TMPDIR],
+                                       'tscuml_{}.npy'.format(t.index)))
+                assert_array_equal(data[t.top_left_y:t.bottom_right_y,
+                                        t.top_left_x:t.bottom_right_x],
+                                   ts_tile[:, :, i])
+
+    def test_untiled_output_matches_write_output_geotiff(self):
+        dest = join(self.tmpdir, 'full.tif')
+        shared.write_output_geotiff(self.md,
+                                    self.ifg.dataset.GetGeoTransform(),
+                                    self.ifg.dataset.GetProjection(),
+                                    self.data, dest, np.nan)
+        assert_array_equal(gdal.Open(dest).ReadAsArray(), self.data)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -34,8 +34,10 @@ from pyrate import mst
 from pyrate import ref_phs_est as rpe
 from pyrate import shared
 from pyrate import vcm
+from pyrate.vcm import VcmCache
 from pyrate.scripts import run_pyrate, run_prepifg
-from pyrate.timeseries import time_series
+from pyrate.timeseries import time_series, time_series_by_groups, \
+    time_series_by_pixel, LaplacianBank, _warm_cache
 
 
 def default_params():
@@ -126,6 +128,109 @@ class TimeSeriesTests(unittest.TestCase):
         assert_array_almost_equal(tscum, expected, decimal=2)
 
 
+class TimeSeriesByGroupsTests(unittest.TestCase):
+    """
+    Tests the mst pattern grouped SVD solver against the pixel by pixel
+    solver
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        imaster = asarray([0, 0, 1, 1, 2, 2, 3, 4])
+        islave = asarray([1, 3, 2, 3, 4, 5, 5, 5])
+        span = asarray([0.1, 0.5, 0.2, 0.3, 0.2])
+        self.nvelpar = len(span)
+        self.b0_mat = np.zeros((len(imaster), self.nvelpar))
+        for i, (m, s) in enumerate(zip(imaster, islave)):
+            self.b0_mat[i, m:s] = span[m:s]
+        self.ifg_data = rng.randn(len(imaster), 4, 5)
+        self.mst = np.ones(self.ifg_data.shape, dtype=bool)
+        self.mst[2, 1:3, :] = False
+        # disconnects the last epoch
+        self.mst[5:, 3, 2:] = False
+        self.mst[:6, 0, 4] = False  # below pthresh
+
+    def test_time_series_by_groups(self):
+        for interp in [0, 1]:
+            tsvel = time_series_by_groups(self.b0_mat, self.ifg_data,
+                                          self.mst, self.nvelpar, 3, interp)
+            for r in range(4):
+                for c in range(5):
+                    exp = time_series_by_pixel(
+                        r, c, self.b0_mat, None, None, self.ifg_data,
+                        self.mst, self.nvelpar, 3, None, 2, interp)
+                    assert_array_almost_equal(tsvel[r, c], exp)
+
+    def test_laplacian_by_groups(self):
+        rng = np.random.RandomState(1)
+        x = rng.randn(8, 8)
+        vcmt = x.dot(x.T) + 8 * np.eye(8)
+        bank = LaplacianBank(self.nvelpar, 2, 0.5)
+        tsvel = time_series_by_groups(
+            self.b0_mat, self.ifg_data, self.mst, self.nvelpar, 3, 1, 1,
+            VcmCache(vcmt), bank)
+        for r in range(4):
+            for c in range(5):
+                sel = np.nonzero(self.mst[:, r, c])[0]
+                if len(sel) < 3:
+                    self.assertTrue(np.isnan(tsvel[r, c]).all())
+                    continue
+                exp = dense_laplacian_solution(
+                    self.b0_mat[sel], self.ifg_data[sel, r, c],
+                    vcmt[sel, np.vstack(sel)], 2, 0.5)
+                assert_array_almost_equal(tsvel[r, c], exp, decimal=5)
+
+    def test_warm_cache_row_subsets(self):
+        rng = np.random.RandomState(1)
+        x = rng.randn(8, 8)
+        vcmt = x.dot(x.T) + 8 * np.eye(8)
+        bank = LaplacianBank(self.nvelpar, 2, 0.5)
+        for interp in [0, 1]:
+            exp = time_series_by_groups(
+                self.b0_mat, self.ifg_data, self.mst, self.nvelpar, 3,
+                interp, 1, VcmCache(vcmt), bank)
+            cache = VcmCache(vcmt)
+            _warm_cache(self.b0_mat, self.mst, self.nvelpar, 3, interp, 1,
+                        cache, bank)
+            self.assertGreater(len(cache), 0)
+            for r in range(4):
+                # the subset of a row has every operator its pixels need
+                sub = cache.subset(self.mst[:, r])
+                tsvel = time_series_by_groups(
+                    self.b0_mat, self.ifg_data[:, r:r + 1],
+                    self.mst[:, r:r + 1], self.nvelpar, 3, interp, 1, sub,
+                    bank)
+                for c in range(5):
+                    pixel = time_series_by_pixel(
+                        r, c, self.b0_mat, 0.5, 2, self.ifg_data, self.mst,
+                        self.nvelpar, 3, vcmt, 1, interp, sub, bank)
+                    np.testing.assert_array_equal(pixel, exp[r, c])
+                self.assertEqual(sub.misses, 0)
+                np.testing.assert_array_equal(tsvel[0], exp[r])
+
+
+def dense_laplacian_solution(b_mat, ifgv, vcm, smorder, smfactor):
+    """
+    Laplacian smoothing solution with the full weight matrix, as in Matlab
+    Pirate 'tsinvlap.m'
+    """
+    nvelpar = b_mat.shape[1]
+    nlap = nvelpar - smorder
+    b_lap = np.zeros((nlap + 2, nvelpar))
+    b_lap[0] = - 1.0 / (nvelpar - 1)
+    b_lap[0, 0] = 1.0
+    for i in range(nlap):
+        b_lap[i + 1, i:i + 3] = np.array([1, -2, 1]) * smfactor
+    b_lap[-1] = - 1.0 / (nvelpar - 1)
+    b_lap[-1, -1] = 1.0
+    mat_b = np.concatenate((b_mat, b_lap))
+    obsv = np.concatenate((ifgv, np.zeros(nlap + 2)))
+    vcm_tmp = np.eye(len(obsv))
+    vcm_tmp[:len(ifgv), :len(ifgv)] = vcm
+    w = np.linalg.cholesky(np.linalg.pinv(vcm_tmp)).T
+    return np.linalg.pinv(w.dot(mat_b), rcond=1e-8).dot(w.dot(obsv))
+
+
 class MatlabTimeSeriesEquality(unittest.TestCase):
     """
     Checks the python function to that of Matlab Pirate ts.m and tsinvlap.m
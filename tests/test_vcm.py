@@ -24,12 +24,14 @@ import unittest
 from numpy import array
 import numpy as np
 from numpy.testing import assert_array_almost_equal
+from scipy.linalg import cholesky
 
 from pyrate import config as cf
 from pyrate import ref_phs_est as rpe
 from pyrate import shared
 from pyrate.scripts import run_pyrate, run_prepifg
-from pyrate.vcm import cvd, get_vcmt
+from pyrate.vcm import cvd, get_vcmt, vcm_factor, delete_from_factor, \
+    VcmCache, CvdContext, multilook_variance_factor, _autocorr, vcm_pattern
 import pyrate.orbital
 from tests.common import small5_mock_ifgs, small5_ifgs, TEST_CONF_ROIPAC
 from tests.common import small_data_setup, prepare_ifgs_without_phase
@@ -90,6 +92,63 @@ class CovarianceTests(unittest.TestCase):
         # Discrepancies observed in distance calculations.
         assert_array_almost_equal(act_alpha, exp_alpha, decimal=1)
 
+    def test_covariance_shared_context(self):
+        context = CvdContext.from_ifg(self.ifgs[0])
+        for i in self.ifgs[:4]:
+            exp = cvd(i, self.params, calc_alpha=True)
+            act = cvd(i, self.params, calc_alpha=True, context=context)
+            assert_array_almost_equal(act, exp)
+
+    def test_covariance_phase_data(self):
+        context = CvdContext.from_ifg(self.ifgs[0])
+        for i in self.ifgs[:4]:
+            exp = cvd(i, self.params, calc_alpha=True)
+            act = cvd(i.phase_data, self.params, calc_alpha=True,
+                      context=context)
+            assert_array_almost_equal(act, exp)
+        self.assertRaises(ValueError, cvd, self.ifgs[0].phase_data,
+                          self.params)
+
+    def test_covariance_context_shape_mismatch(self):
+        ifg = self.ifgs[0]
+        context = CvdContext(ifg.nrows + 1, ifg.ncols, ifg.x_centre,
+                             ifg.y_centre, ifg.x_size, ifg.y_size)
+        self.assertRaises(ValueError, cvd, ifg, self.params, False, context)
+
+
+class AutocorrTests(unittest.TestCase):
+
+    def test_autocorr_circular(self):
+        rng = np.random.RandomState(3)
+        for shape in [(6, 5), (5, 8)]:
+            phase = rng.randn(*shape)
+            exp = np.empty(shape)
+            for y in range(shape[0]):
+                for x in range(shape[1]):
+                    shifted = np.roll(np.roll(phase, -y, axis=0), -x, axis=1)
+                    exp[y, x] = np.sum(phase * shifted)
+            assert_array_almost_equal(_autocorr(phase), exp)
+
+
+class MultilookVarianceTests(unittest.TestCase):
+
+    def test_variance_factor(self):
+        alpha, xlooks, ylooks, x_size, y_size = 0.5, 3, 4, 80.0, 95.0
+        cells = [(x * x_size, y * y_size) for x in range(xlooks)
+                 for y in range(ylooks)]
+        exp = np.mean([np.exp(-alpha * np.hypot(p[0] - q[0], p[1] - q[1])
+                              / 1000) for p in cells for q in cells])
+        self.assertAlmostEqual(
+            multilook_variance_factor(alpha, xlooks, ylooks, x_size, y_size),
+            exp)
+
+    def test_variance_factor_limits(self):
+        # no multi-looking, and uncorrelated cells
+        self.assertAlmostEqual(multilook_variance_factor(0.3, 1, 1, 90, 90),
+                               1.0)
+        self.assertAlmostEqual(multilook_variance_factor(1e9, 2, 3, 90, 90),
+                               1.0 / 6)
+
 
 class VCMTests(unittest.TestCase):
 
@@ -110,6 +169,14 @@ class VCMTests(unittest.TestCase):
         act = get_vcmt(ifgs, maxvar)
         assert_array_almost_equal(act, exp, decimal=3)
 
+    def test_vcm_pattern_swapped_epochs(self):
+        # a->b and b->a link master and slave both ways, still -0.5
+        act = vcm_pattern(np.array([0, 1, 0]), np.array([1, 0, 2]))
+        exp = np.array([[1.0, -0.5, 0.5],
+                        [-0.5, 1.0, -0.5],
+                        [0.5, -0.5, 1.0]])
+        assert_array_almost_equal(act, exp)
+
     def test_vcm_17ifgs(self):
         # TODO: maxvar should be calculated by vcm.cvd
         maxvar = [2.879, 4.729, 22.891, 4.604, 3.290, 6.923, 2.519, 13.177,
@@ -158,6 +225,84 @@ class VCMTests(unittest.TestCase):
         assert_array_almost_equal(act, exp, decimal=3)
 
 
+class VcmFactorTests(unittest.TestCase):
+    """
+    Tests the VCM factor and its update when observations are removed
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        x = rng.randn(7, 7)
+        self.vcm = x.dot(x.T) + 7 * np.eye(7)
+
+    def test_vcm_factor(self):
+        factor = vcm_factor(self.vcm)
+        assert_array_almost_equal(np.triu(factor), factor)
+        assert_array_almost_equal(factor.dot(factor.T), self.vcm)
+        assert_array_almost_equal(np.linalg.inv(factor),
+                                  cholesky(np.linalg.inv(self.vcm)))
+
+    def test_delete_from_factor(self):
+        factor = vcm_factor(self.vcm)
+        for k in [0, 3, 6]:
+            exp = np.delete(np.delete(self.vcm, k, axis=0), k, axis=1)
+            assert_array_almost_equal(delete_from_factor(factor, k),
+                                      vcm_factor(exp))
+
+
+class VcmCacheTests(unittest.TestCase):
+    """
+    Tests the least recently used cache of VCM factorisations
+    """
+
+    def setUp(self):
+        rng = np.random.RandomState(5)
+        x = rng.randn(6, 6)
+        self.vcm = x.dot(x.T) + 6 * np.eye(6)
+        # one 4x4 float64 factor is 128 bytes
+        self.cache = VcmCache(self.vcm, max_mb=256.0 / 2**20)
+
+    def test_factor(self):
+        ind = np.array([0, 2, 3, 5])
+        assert_array_almost_equal(self.cache.factor(ind),
+                                  vcm_factor(self.vcm[ind, np.vstack(ind)]))
+        assert_array_almost_equal(
+            self.cache.inverse_factor(ind),
+            cholesky(np.linalg.inv(self.vcm[ind, np.vstack(ind)])))
+
+    def test_counters(self):
+        ind = np.array([0, 1, 2, 3])
+        first = self.cache.factor(ind)
+        self.assertIs(self.cache.factor(ind), first)
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.evictions, 0)
+        self.assertEqual(self.cache.nbytes, first.nbytes)
+
+    def test_lru_eviction(self):
+        a, b, c = [0, 1, 2, 3], [1, 2, 3, 4], [2, 3, 4, 5]
+        self.cache.factor(a)
+        self.cache.factor(b)
+        self.cache.factor(a)  # b is now the least recently used
+        self.cache.factor(c)
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(len(self.cache), 2)
+        self.cache.factor(a)
+        self.assertEqual(self.cache.hits, 2)
+        self.cache.factor(b)
+        self.assertEqual(self.cache.misses, 4)
+
+    def test_subset(self):
+        self.cache.factor([0, 1, 2, 3])
+        self.cache.factor([2, 3, 4, 5])
+        mask = np.zeros((6, 2, 2), dtype=bool)
+        mask[:4] = True
+        sub = self.cache.subset(mask)
+        self.assertEqual(len(sub), 1)
+        sub.factor([0, 1, 2, 3])
+        self.assertEqual(sub.hits, 1)
+
+
 matlab_maxvar = [15.4156637191772,
                  2.85829424858093,
                  34.3486289978027,
@@ -0,0 +1,86 @@
+# This Python module is part of the PyRate software package
+#
+# Copyright 2017 Geoscience Australia
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+python utility to compare the multi-looked maxvar estimates
+(maxvarlksx/maxvarlksy) against the full resolution estimates
+
+Run prepifg with the config file first. Example usage:
+python utils/maxvar_benchmark.py -c tests/test_data/small_test/conf/pyrate_roipac_test.conf
+-l '2 3 4'
+"""
+from __future__ import print_function
+from optparse import OptionParser
+import time
+
+import numpy as np
+
+from pyrate import config as cf
+from pyrate import vcm
+from pyrate.shared import Ifg
+
+
+def full_resolution_cvd(ifg_paths, params):
+    maxvar, alpha = [], []
+    context = None
+    for p in ifg_paths:
+        ifg = Ifg(p)
+        ifg.open(readonly=True)
+        if context is None:
+            context = vcm.CvdContext.from_ifg(ifg)
+        m, a = vcm.cvd(ifg, params, calc_alpha=True, context=context)
+        ifg.close()
+        maxvar.append(m)
+        alpha.append(a)
+    return np.array(maxvar), np.array(alpha)
+
+
+def benchmark(config_file, looks):
+    _, dest_paths, params = cf.get_ifg_paths(config_file)
+    dest_paths = sorted(dest_paths)
+
+    start = time.time()
+    maxvar, alpha = full_resolution_cvd(dest_paths, params)
+    full_time = time.time() - start
+    print('looks  time(s)  speedup  maxvar rel err (mean/max)  '
+          'alpha rel err (mean/max)')
+    print('{:>5}  {:7.2f}  {:7.1f}'.format(1, full_time, 1.0))
+
+    for lks in looks:
+        start = time.time()
+        ml_maxvar, ml_alpha = vcm.multilooked_cvd(dest_paths, params,
+                                                  lks, lks)
+        ml_time = time.time() - start
+        maxvar_err = np.abs(np.array(ml_maxvar) - maxvar) / maxvar
+        alpha_err = np.abs(np.array(ml_alpha) - alpha) / np.abs(alpha)
+        print('{:>5}  {:7.2f}  {:7.1f}  {:12.3f} / {:<12.3f}'
+              '{:12.3f} / {:.3f}'.format(lks, ml_time, full_time / ml_time,
+                                         maxvar_err.mean(), maxvar_err.max(),
+                                         alpha_err.mean(), alpha_err.max()))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog -c config_file -l looks\n'
+                                'Compare multi-looked maxvar estimates '
+                                'against full resolution.')
+    parser.add_option('-c', '--config', type=str, dest='config_file',
+                      help='name of the PyRate config file')
+    parser.add_option('-l', '--looks', type=str, dest='looks',
+                      default='2 4 8',
+                      help='multi-look factors to compare, in quotes')
+    options, args = parser.parse_args()
+    if not options.config_file:  # if config file is not given
+        parser.error('Config file must be provided')
+    benchmark(options.config_file, [int(l) for l in options.looks.split()])
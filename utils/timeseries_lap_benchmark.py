@@ -0,0 +1,122 @@
+# This Python module is part of the PyRate software package
+#
+# Copyright 2017 Geoscience Australia
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+python utility to time the Laplacian smoothing time series inversion
+(tsmethod=1) on a synthetic stack, one unique interferogram selection per
+pixel. The cholesky operator is compared against the dense per pixel
+solution with the full weight matrix and against the pinv operator.
+
+Example usage:
+python utils/timeseries_lap_benchmark.py -e 200 -p 20
+"""
+from __future__ import print_function
+from optparse import OptionParser
+import time
+
+import numpy as np
+from numpy import dot
+from numpy.linalg import pinv, cholesky
+
+from pyrate import timeseries
+from pyrate.vcm import VcmCache, vcm_pattern
+
+
+def synthetic_stack(nepochs, npixels, seed=0):
+    """
+    Interferograms linking each epoch to its next three, and one random
+    spanning tree of them per pixel, as selected by the MST.
+    """
+    rng = np.random.RandomState(seed)
+    pairs = [(m, s) for m in range(nepochs)
+             for s in range(m + 1, min(m + 4, nepochs))]
+    masters, slaves = np.array(pairs).T
+    b0_mat = np.zeros((len(pairs), nepochs - 1))
+    for k, (m, s) in enumerate(pairs):
+        b0_mat[k, m:s] = 12.0
+    std = np.sqrt(rng.rand(len(pairs)) * 5 + 1)[:, np.newaxis]
+    vcmt = std * std.T * vcm_pattern(masters, slaves)
+    index = {p: k for k, p in enumerate(pairs)}
+    sels = [np.array(sorted(index[(rng.randint(max(0, s - 3), s), s)]
+                            for s in range(1, nepochs)))
+            for _ in range(npixels)]
+    return b0_mat, vcmt, sels, rng.randn(len(pairs))
+
+
+def dense_solution(mat_b, ifgv, vcm, b_lap):
+    """Per pixel solution with the full weight matrix, as in tsinvlap.m"""
+    m, nlap = len(ifgv), b_lap.shape[0]
+    vcm_tmp = np.eye(m + nlap)
+    vcm_tmp[:m, :m] = vcm
+    w = cholesky(pinv(vcm_tmp)).T
+    obsv = np.concatenate((ifgv, np.zeros(nlap)))
+    return dot(pinv(dot(w, np.concatenate((mat_b, b_lap))), rcond=1e-8),
+               dot(w, obsv))
+
+
+def pinv_operator(mat_b, bank, sel, cache):
+    """Operator from the pseudo inverse of the weighted design matrix"""
+    w = cache.inverse_factor(sel)
+    wb = np.concatenate((dot(w, mat_b), bank.design(mat_b.shape[1])))
+    return dot(pinv(wb, rcond=1e-8)[:, :len(sel)], w)
+
+
+def benchmark(nepochs, npixels):
+    b0_mat, vcmt, sels, ifgv = synthetic_stack(nepochs, npixels)
+    nvelpar = nepochs - 1
+    velflag = np.ones(nvelpar)
+    bank = timeseries.LaplacianBank(nvelpar, 2, 0.5)
+
+    start = time.time()
+    dense = [dense_solution(b0_mat[s], ifgv[s], vcmt[s, np.vstack(s)],
+                            bank.design(nvelpar)) for s in sels]
+    dense_time = (time.time() - start) / npixels
+
+    # fresh caches, the vcm factorisations are timed too
+    cache = VcmCache(vcmt)
+    start = time.time()
+    ops = [pinv_operator(b0_mat[s], bank, s, cache) for s in sels]
+    pinv_time = (time.time() - start) / npixels
+
+    cache = VcmCache(vcmt)
+    start = time.time()
+    chol = [timeseries._lap_operator(velflag, b0_mat[s], bank, s, cache)
+            for s in sels]
+    chol_time = (time.time() - start) / npixels
+
+    op_err = max(np.abs(c - o).max() / np.abs(o).max()
+                 for c, o in zip(chol, ops))
+    sol_err = max(np.abs(dot(c, ifgv[s]) - d).max() / np.abs(d).max()
+                  for c, d, s in zip(chol, dense, sels))
+    print('{} epochs, {} ifgs per pixel'.format(nepochs, len(sels[0])))
+    print('method    ms/pixel  speedup')
+    print('dense     {:8.1f}  {:7.1f}'.format(dense_time * 1e3, 1.0))
+    print('pinv      {:8.1f}  {:7.1f}'.format(pinv_time * 1e3,
+                                             dense_time / pinv_time))
+    print('cholesky  {:8.1f}  {:7.1f}'.format(chol_time * 1e3,
+                                             dense_time / chol_time))
+    print('max rel difference to pinv {:.1e}, '
+          'to dense {:.1e}'.format(op_err, sol_err))
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog -e epochs -p pixels\n'
+                                'Time the Laplacian smoothing inversion.')
+    parser.add_option('-e', '--epochs', type=int, dest='nepochs',
+                      default=200, help='number of epochs')
+    parser.add_option('-p', '--pixels', type=int, dest='npixels',
+                      default=20, help='number of unique pixel selections')
+    options, args = parser.parse_args()
+    benchmark(options.nepochs, options.npixels)